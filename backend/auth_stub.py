@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Emergent auth session-data endpoint
+
+Point the backend at it with AUTH_API_URL=http://127.0.0.1:8002/auth/v1/env/oauth/session-data
+Any session_id is accepted and mapped to a stable fake user. Failure injection:
+  X-Session-ID: invalid_*   -> 404 (rejected session)
+  --fail-rate 0.2           -> 20% of calls answer 503
+  --latency 0.05            -> add 50 ms to every call
+
+Usage (from backend/): python auth_stub.py [--port 8002] [--fail-rate 0.0] [--latency 0.0]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+
+from fastapi import FastAPI, Header, HTTPException
+
+stub_app = FastAPI()
+stub_app.state.fail_rate = 0.0
+stub_app.state.latency = 0.0
+stub_app.state.calls = 0
+
+
+@stub_app.get("/auth/v1/env/oauth/session-data")
+async def session_data(x_session_id: str = Header(...)):
+    """Return deterministic user data for a session id"""
+    stub_app.state.calls += 1
+    if stub_app.state.latency:
+        await asyncio.sleep(stub_app.state.latency)
+    if random.random() < stub_app.state.fail_rate:
+        raise HTTPException(status_code=503, detail="Injected failure")
+    if x_session_id.startswith("invalid"):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    key = hashlib.sha1(x_session_id.encode()).hexdigest()[:10]
+    return {
+        "id": f"stub_{key}",
+        "email": f"stub_{key}@example.com",
+        "name": f"Stub User {key[:4]}",
+        "picture": None,
+        "session_token": f"stub_token_{hashlib.sha1(key.encode()).hexdigest()[:24]}"
+    }
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local auth provider stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    args = parser.parse_args()
+
+    stub_app.state.fail_rate = args.fail_rate
+    stub_app.state.latency = args.latency
+    uvicorn.run(stub_app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Request-coalescing check: fires bursts of identical concurrent reads (session lookup, discovery,
+connections, profile) against an in-memory database with a simulated round trip and reports how
+many database reads each burst cost with the single-flight layer on and off.
+Exits non-zero if coalescing does not cut the reads of a duplicate burst.
+
+Usage (from backend/):
+  python -m benchmarks.coalescing
+  python -m benchmarks.coalescing --concurrency 200 --latency 0.01
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+from starlette.requests import Request
+
+import server
+from server import User
+from benchmarks.fakedb import FakeDB
+from benchmarks.synthetic import generate_population
+
+
+class NoCoalescing:
+    """Drop-in for server.single_flight that runs every call on its own"""
+
+    async def do(self, key, fn, not_before=None):
+        return await fn()
+
+
+def make_request(path, query="", cookie=None, accept=None):
+    headers = [(b"host", b"bench")]
+    if cookie:
+        headers.append((b"cookie", f"session_token={cookie}".encode()))
+    if accept:
+        headers.append((b"accept", accept.encode()))
+    # Arrival time as InstrumentationMiddleware records it; the whole burst arrives at once
+    return Request({
+        "type": "http", "method": "GET", "scheme": "http", "path": path,
+        "query_string": query.encode(), "headers": headers, "server": ("bench", 80),
+        "state": {"received_at": time.monotonic()},
+    })
+
+
+async def seed(fake, users):
+    population, routes, sessions = generate_population(users, seed=users)
+    await fake.users.insert_many(population)
+    await fake.routes.insert_many(routes)
+    await fake.user_sessions.insert_many(sessions)
+    viewer, others = population[0], population[1:6]
+    now = datetime.now(timezone.utc)
+    await fake.connections.insert_many([{
+        "connection_id": f"conn_{uuid.uuid4().hex[:12]}", "user1_id": viewer["user_id"],
+        "user2_id": other["user_id"], "status": "accepted", "created_at": now, "updated_at": now,
+    } for other in others])
+    return User(**viewer), sessions[0]["session_token"], others[0]["user_id"]
+
+
+def scenarios(viewer, token, profile_id):
+    return {
+        "session lookup": lambda: server.get_current_user(make_request("/api/auth/me", cookie=token)),
+        "discovery": lambda: server.get_matches(make_request("/api/discovery/matches"), current_user=viewer),
+        "connections": lambda: server.get_connections(make_request("/api/connections/list"), status=None,
+                                                      current_user=viewer),
+        "profile": lambda: server.get_user_profile(profile_id, make_request(f"/api/profile/{profile_id}"),
+                                                   current_user=viewer),
+    }
+
+
+async def run(args):
+    fake = FakeDB(latency=args.latency)
+    viewer, token, profile_id = await seed(fake, args.users)
+    server.db = server.read_db = server.fast_db = fake
+    server.RATE_LIMITS["discovery"] = "off"  # a burst from one viewer is the point here
+    server.untiled_routes_remain = False  # every seeded route has tiles
+    coalescing = server.single_flight
+
+    results = {}
+    for name, call in scenarios(viewer, token, profile_id).items():
+        for mode, flight in (("off", NoCoalescing()), ("on", coalescing)):
+            server.single_flight = flight
+            fake.counter.clear()
+            await asyncio.gather(*(call() for _ in range(args.concurrency)))
+            results[(name, mode)] = sum(fake.counter.values())
+    server.single_flight = coalescing
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=100, help="identical requests per burst")
+    parser.add_argument("--users", type=int, default=2000, help="synthetic users (one route each)")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated DB round trip in seconds")
+    args = parser.parse_args()
+
+    original_db = server.db, server.read_db, server.fast_db
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        server.db, server.read_db, server.fast_db = original_db
+
+    print(f"{args.concurrency} concurrent identical requests per burst, database reads per burst:")
+    failures = []
+    for name in dict.fromkeys(name for name, _ in results):
+        off, on = results[(name, "off")], results[(name, "on")]
+        print(f"  {name:16} without coalescing {off:>6}   with coalescing {on:>6}")
+        if on >= off:
+            failures.append(name)
+    if failures:
+        print(f"FAIL: coalescing did not reduce reads for {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Minimal in-memory stand-in for the Motor database, for benchmarks that should measure
+server code rather than MongoDB. Supports the query shapes server.py uses on reads
+(equality, $ne, $in, $exists, $or, $and, $gte/$lt, prefix patterns in $in and simple projections) and
+counts every command. Equality and $in lookups on user_id / *_id fields and route via_tiles use a
+hash index, and prefix lookups on route tiles a sorted one, like the real indexes would.
+"""
+
+import asyncio
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Hashable
+
+INDEXED_FIELDS = ("user_id", "route_id", "connection_id", "message_id", "via_tiles")
+PREFIX_INDEXED_FIELDS = ("start_tile", "end_tile")
+
+
+_TYPES = {"string": str, "array": list, "bool": bool}
+
+
+def _is_pattern(arg):
+    return hasattr(arg, "match")
+
+
+class _Members:
+    """An $in / $nin list: plain values in a set, plus prefixes from compiled "^..." patterns"""
+
+    def __init__(self, args):
+        self.values = {arg for arg in args if not _is_pattern(arg)}
+        # Patterns are anchored prefixes ("^abc"), so str.startswith can test them all at once
+        self.prefixes = tuple(arg.pattern.lstrip("^") for arg in args if _is_pattern(arg))
+
+    def __contains__(self, value):
+        if isinstance(value, list):
+            # Array fields match when any element does
+            if not self.prefixes:
+                return not self.values.isdisjoint(value)
+            return any(item in self for item in value)
+        if isinstance(value, Hashable) and value in self.values:
+            return True
+        return bool(self.prefixes) and isinstance(value, str) and value.startswith(self.prefixes)
+
+
+def _compile(query):
+    """Turn every $in / $nin list into a _Members once per query instead of once per document"""
+    compiled = {}
+    for key, cond in query.items():
+        if key in ("$or", "$and"):
+            compiled[key] = [_compile(sub) for sub in cond]
+        elif isinstance(cond, dict):
+            compiled[key] = {op: _Members(arg) if op in ("$in", "$nin") else arg for op, arg in cond.items()}
+        else:
+            compiled[key] = cond
+    return compiled
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(_matches(doc, sub) for sub in cond):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(cond, dict):
+            for op, arg in cond.items():
+                if op == "$ne" and value == arg:
+                    return False
+                if op == "$exists" and (key in doc) != bool(arg):
+                    return False
+                if op == "$type" and not isinstance(value, _TYPES[arg]):
+                    return False
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$nin" and value in arg:
+                    return False
+                if op == "$gte" and not (value is not None and value >= arg):
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$lte" and not (value is not None and value <= arg):
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        return {k: doc[k] for k in include if k in doc}
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+async def _round_trip(latency):
+    if latency:
+        await asyncio.sleep(latency)
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection, counter, latency=0.0):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._limit = 0
+        self._sort = None
+        self._counter = counter
+        self._latency = latency
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def sort(self, key, direction=1):
+        self._sort = (key, direction)
+        return self
+
+    def _iter(self):
+        self._counter["find"] += 1
+        query = _compile(self._query)
+        docs = (d for d in self._collection.candidates(self._query) if _matches(d, query))
+        if self._sort:
+            key, direction = self._sort
+            docs = iter(sorted(docs, key=lambda d: d.get(key), reverse=direction < 0))
+        for i, doc in enumerate(docs):
+            if self._limit and i >= self._limit:
+                return
+            yield _project(doc, self._projection)
+
+    async def to_list(self, length=None):
+        await _round_trip(self._latency)
+        rows = []
+        for doc in self._iter():
+            if length and len(rows) >= length:
+                break
+            rows.append(doc)
+        return rows
+
+    def __aiter__(self):
+        self._it = None
+        return self
+
+    async def __anext__(self):
+        if self._it is None:
+            await _round_trip(self._latency)
+            self._it = self._iter()
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, counter, latency=0.0):
+        self.docs = []
+        self.counter = counter
+        self.latency = latency
+        self.indexes = {field: defaultdict(list) for field in INDEXED_FIELDS}
+        self.sorted_indexes = {}
+
+    def _add(self, doc):
+        doc = dict(doc)
+        self.docs.append(doc)
+        self.sorted_indexes.clear()
+        for field, index in self.indexes.items():
+            if field in doc:
+                # Array fields are indexed under each element, like a multikey index
+                for key in doc[field] if isinstance(doc[field], list) else [doc[field]]:
+                    index[key].append(doc)
+
+    def candidates(self, query):
+        """Narrow the scan through a hash index when the query pins an indexed field"""
+        for field, index in self.indexes.items():
+            cond = query.get(field)
+            if cond is None or (isinstance(cond, dict) and "$in" not in cond):
+                continue
+            keys = cond["$in"] if isinstance(cond, dict) else [cond]
+            return list({id(doc): doc for key in dict.fromkeys(keys) for doc in index.get(key, ())}.values())
+        # Like the query planner, read the prefix index that narrows the query most; a query that
+        # requires some field to be a string can read a partial index of the documents that have it
+        partial = next((f for f, c in query.items() if isinstance(c, dict) and c.get("$type") == "string"), None)
+        best = None
+        for field in PREFIX_INDEXED_FIELDS:
+            cond = query.get(field)
+            if isinstance(cond, dict) and cond.get("$in") and all(map(_is_pattern, cond["$in"])):
+                keys, docs = self._sorted_index(field, partial)
+                ranges = []
+                for pattern in cond["$in"]:
+                    prefix = pattern.pattern.lstrip("^")
+                    ranges.append((bisect_left(keys, prefix), bisect_left(keys, prefix + "\uffff")))
+                size = sum(end - start for start, end in ranges)
+                if best is None or size < best[0]:
+                    best = (size, docs, ranges)
+        if best is not None:
+            _, docs, ranges = best
+            return [doc for start, end in ranges for doc in docs[start:end]]
+        for sub in query.get("$and", ()):
+            found = self.candidates(sub)
+            if found is not self.docs:
+                return found
+        if "$or" in query:
+            # Each branch through its own index, as MongoDB plans $or; a branch without one scans
+            branches = [self.candidates(sub) for sub in query["$or"]]
+            if all(found is not self.docs for found in branches):
+                return list({id(doc): doc for found in branches for doc in found}.values())
+        return self.docs
+
+    def _sorted_index(self, field, partial=None):
+        if (field, partial) not in self.sorted_indexes:
+            docs = sorted(
+                (d for d in self.docs if isinstance(d.get(field), str) and (partial is None or isinstance(d.get(partial), str))),
+                key=lambda d: d[field]
+            )
+            self.sorted_indexes[field, partial] = ([d[field] for d in docs], docs)
+        return self.sorted_indexes[field, partial]
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query or {}, projection, self.counter, self.latency)
+
+    async def find_one(self, query=None, projection=None):
+        await _round_trip(self.latency)
+        self.counter["find_one"] += 1
+        compiled = _compile(query or {})
+        for doc in self.candidates(query or {}):
+            if _matches(doc, compiled):
+                return _project(doc, projection)
+        return None
+
+    async def insert_many(self, docs, ordered=True):
+        self.counter["insert"] += 1
+        for doc in docs:
+            self._add(doc)
+
+    async def insert_one(self, doc):
+        self.counter["insert"] += 1
+        self._add(doc)
+
+
+class FakeDB:
+    """Attribute/item access creates collections on demand, like Motor
+
+    `latency` adds a simulated round trip (seconds) to every read so concurrent callers overlap.
+    """
+
+    def __init__(self, latency=0.0):
+        self.counter = Counter()
+        self.latency = latency
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self.counter, self.latency)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the RouteBuddy backend
+Seeds a synthetic commuter population straight into MongoDB, then drives a running server
+(discovery, send message, conversation reads, Socket.IO chat) at a fixed concurrency and
+reports p50/p95/p99 latency and requests/sec as JSON.
+
+Start the server first with rate limits off
+(RATE_LIMIT_DISCOVERY=off RATE_LIMIT_MESSAGING=off python serve.py --port 8001), then from backend/:
+  python -m benchmarks.load --users 2000 --concurrency 32 --requests 500 --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import socketio
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.synthetic import generate_population, BENCH_EMAIL_DOMAIN
+
+load_dotenv(Path(__file__).parent.parent / '.env')
+
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+DB_NAME = os.environ.get('DB_NAME', 'test_database')
+
+SCENARIOS = ["discovery", "send_message", "conversation", "socket_chat"]
+
+
+# Every collection a benchmark user leaves rows in, and the fields that point back at the user
+USER_FIELDS = [
+    ("user_sessions", ["user_id"]),
+    ("connections", ["user1_id", "user2_id"]),
+    ("messages", ["sender_id", "receiver_id"]),
+    ("blocks", ["blocker_id", "blocked_id"]),
+    ("notification_queue", ["user_id"]),
+    ("devices", ["user_id"]),
+    ("tasks", ["payload.user_id"]),
+    ("id_verifications", ["_id"]),
+    ("match_snapshots", ["_id"]),
+]
+VERSION_KEYS = ["profile", "routes", "connections"]
+
+
+async def clear_population(db):
+    """Remove every benchmark user and whatever the previous run left behind for them"""
+    users = await db.users.find({"email": {"$regex": f"@{BENCH_EMAIL_DOMAIN}$"}}, {"_id": 0, "user_id": 1}).to_list(None)
+    user_ids = [u["user_id"] for u in users]
+    if not user_ids:
+        return
+    members = set(user_ids)
+    for name, fields in USER_FIELDS:
+        await db[name].delete_many({"$or": [{field: {"$in": user_ids}} for field in fields]})
+    # Buckets and archive chunks are keyed by "<lower>|<higher>" user pairs
+    for name in ("message_buckets", "message_archive"):
+        conversations = [c for c in await db[name].distinct("conversation") if members & set(c.split("|"))]
+        await db[name].delete_many({"conversation": {"$in": conversations}})
+    await db.data_versions.delete_many({"_id": {"$in": [f"{kind}:{u}" for kind in VERSION_KEYS for u in user_ids]}})
+
+    # Places are shared by address, so only drop the ones no other route points at
+    place_ids = set()
+    for field in ("start_place_id", "end_place_id"):
+        place_ids.update(await db.routes.distinct(field, {"user_id": {"$in": user_ids}}))
+    await db.routes.delete_many({"user_id": {"$in": user_ids}})
+    for field in ("start_place_id", "end_place_id"):
+        place_ids.difference_update(await db.routes.distinct(field, {field: {"$in": list(place_ids)}}))
+    await db.places.delete_many({"place_id": {"$in": list(place_ids)}})
+    await db.users.delete_many({"user_id": {"$in": user_ids}})
+
+
+async def seed_population(db, users, routes_per_user, seed):
+    """Insert users, sessions, routes and one accepted connection per user; return (tokens, pairs)"""
+    await clear_population(db)
+    user_docs, route_docs, session_docs = generate_population(users, routes_per_user, seed=seed)
+    await db.users.insert_many(user_docs, ordered=False)
+    await db.user_sessions.insert_many(session_docs, ordered=False)
+    await db.routes.insert_many(route_docs, ordered=False)
+
+    # Pair neighbours so send/conversation/socket scenarios have a peer to talk to
+    user_ids = [u["user_id"] for u in user_docs]
+    pairs = list(zip(user_ids[0::2], user_ids[1::2]))
+    if pairs:
+        await db.connections.insert_many([{
+            "connection_id": f"conn_{uuid.uuid4().hex[:12]}",
+            "user1_id": a,
+            "user2_id": b,
+            "status": "accepted",
+            "created_at": datetime.now(timezone.utc)
+        } for a, b in pairs], ordered=False)
+
+    tokens = {s["user_id"]: s["session_token"] for s in session_docs}
+    return tokens, pairs
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+
+    def pct(p):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 2)
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2) if ordered else None,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else None,
+    }
+
+
+async def drive(operation, total, concurrency):
+    """Run `operation(i)` `total` times with `concurrency` workers; return summary"""
+    latencies, errors = [], 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                await operation(i)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def make_http_operation(name, http, tokens, pairs, rng):
+    user_ids = list(tokens)
+
+    def auth(user_id):
+        return {"Authorization": f"Bearer {tokens[user_id]}"}
+
+    if name == "discovery":
+        async def op(i):
+            user_id = rng.choice(user_ids)
+            r = await http.get("/api/discovery/matches", headers=auth(user_id))
+            r.raise_for_status()
+    elif name == "send_message":
+        async def op(i):
+            a, b = rng.choice(pairs)
+            r = await http.post("/api/messages/send", headers=auth(a), json={"receiver_id": b, "content": f"bench {i}"})
+            r.raise_for_status()
+    else:
+        async def op(i):
+            a, b = rng.choice(pairs)
+            r = await http.get(f"/api/messages/conversation/{b}", headers=auth(a))
+            r.raise_for_status()
+    return op
+
+
+async def socket_chat_scenario(base_url, tokens, pairs, concurrency, total, rng):
+    """One socket per worker; each op emits send_message and waits for the server's message_sent ack"""
+    latencies, errors = [], 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        sio = socketio.AsyncClient(reconnection=False)
+        acks = asyncio.Queue()
+        sio.on("message_sent", lambda data: acks.put_nowait(data))
+        a, b = rng.choice(pairs)
+        await sio.connect(base_url, transports=["websocket"], auth={"token": tokens[a]})
+        try:
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    await sio.emit("send_message", {"receiver_id": b, "content": f"bench socket {i}"})
+                    await asyncio.wait_for(acks.get(), timeout=10)
+                    latencies.append(time.perf_counter() - started)
+                except Exception:
+                    errors += 1
+        finally:
+            await sio.disconnect()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run(args):
+    mongo = AsyncIOMotorClient(MONGO_URL)
+    db = mongo[DB_NAME]
+    rng = random.Random(args.seed)
+    try:
+        started = time.perf_counter()
+        tokens, pairs = await seed_population(db, args.users, args.routes_per_user, args.seed)
+        seed_seconds = time.perf_counter() - started
+
+        results = {}
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30) as http:
+            for name in args.scenarios:
+                if name == "socket_chat":
+                    results[name] = await socket_chat_scenario(args.base_url, tokens, pairs, args.concurrency, args.requests, rng)
+                else:
+                    op = make_http_operation(name, http, tokens, pairs, rng)
+                    await drive(op, min(args.concurrency, args.requests), args.concurrency)  # warm-up
+                    results[name] = await drive(op, args.requests, args.concurrency)
+
+        return {
+            "config": {
+                "base_url": args.base_url,
+                "users": args.users,
+                "routes": args.users * args.routes_per_user,
+                "concurrency": args.concurrency,
+                "requests_per_scenario": args.requests,
+                "seed": args.seed,
+            },
+            "seed_seconds": round(seed_seconds, 2),
+            "scenarios": results,
+        }
+    finally:
+        if not args.keep_data:
+            await clear_population(db)
+        mongo.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--routes-per-user", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=300, help="requests per scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-data", action="store_true", help="leave the synthetic population in MongoDB")
+    parser.add_argument("--output", help="write the JSON report here as well as stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the discovery matching path
+Measures haversine_distance, time_difference_minutes, calculate_match_score and the whole
+get_matches scoring loop (1k/10k/100k routes in an in-memory collection), with the hub cache
+cold for every viewer and for members of one dense hub (a station everyone commutes from).
+Every figure is taken relative to a reference run in the same process, so the gate does not
+depend on how fast the host is: the primitives against a textbook haversine on plain floats, and
+get_matches against the same requests with MATCH_SEARCH=scan (one bounded read of 1000 routes).
+The ratios are compared against the committed baseline; a drop that holds up when re-measured,
+or a missing baseline, fails. tests/test_matching_benchmark.py runs the same gate under pytest.
+
+Usage (from backend/):
+  python -m benchmarks.matching --save-baseline          # record benchmarks/matching_baseline.json
+  python -m benchmarks.matching                          # compare, fail if a ratio drops >20%
+  python -m benchmarks.matching --max-regression 0.1 --sizes 1000 10000
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import time
+from math import asin, cos, radians, sin, sqrt
+from pathlib import Path
+from statistics import median
+
+from starlette.requests import Request
+
+import server
+from server import Coordinates, Route, User, haversine_distance, time_difference_minutes, calculate_match_score
+from benchmarks.fakedb import FakeDB
+from benchmarks.synthetic import generate_population
+
+DEFAULT_BASELINE = Path(__file__).parent / "matching_baseline.json"
+DEFAULT_SIZES = [1000, 10000, 100000]
+PRIMITIVES = ["haversine_distance", "time_difference_minutes", "calculate_match_score"]
+MATCH_BENCHMARKS = ["get_matches", "get_matches_hub"]
+
+
+def paired_rates(rounds, calls):
+    """(best calls/sec, median ratio to the reference) from (seconds, reference seconds) per round
+
+    Each round times both back to back, so a ratio only compares timings taken under the same load.
+    """
+    return calls / min(seconds for seconds, _ in rounds), median(reference / seconds for seconds, reference in rounds)
+
+
+def timed(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return time.perf_counter() - started
+
+
+def reference_haversine(a, b):
+    """Textbook haversine on (lat, lng) tuples: the host-speed yardstick for the primitives"""
+    dlat, dlng = radians(b[0] - a[0]), radians(b[1] - a[1])
+    h = sin(dlat / 2) ** 2 + cos(radians(a[0])) * cos(radians(b[0])) * sin(dlng / 2) ** 2
+    return 12742 * asin(sqrt(h))
+
+
+def bench_primitives(repeat, only=None):
+    """{name: (calls/sec, ratio to the reference)} for the primitives (all, or those in `only`)"""
+    _, routes, _ = generate_population(2, seed=7)
+    a, b = Route(**routes[0]), Route(**routes[1])
+    # Make the pair compatible so calculate_match_score runs to completion
+    b = b.model_copy(update={"start_coords": Coordinates(lat=a.start_coords.lat + 0.01, lng=a.start_coords.lng),
+                             "end_coords": a.end_coords, "departure_time": a.departure_time,
+                             "days_of_week": a.days_of_week})
+    benches = {
+        "haversine_distance": lambda: haversine_distance(a.start_coords, b.start_coords),
+        "time_difference_minutes": lambda: time_difference_minutes("08:15", "08:40"),
+        "calculate_match_score": lambda: calculate_match_score(a, b),
+    }
+    points = (a.start_coords.lat, a.start_coords.lng), (b.start_coords.lat, b.start_coords.lng)
+    reference = lambda: reference_haversine(*points)  # noqa: E731
+    gc.collect()
+    gc.disable()
+    try:
+        # Short rounds, many of them, so a disturbance by the host only spoils a few
+        return {
+            name: paired_rates([(timed(fn, 10000), timed(reference, 10000)) for _ in range(repeat * 10)], 10000)
+            for name, fn in benches.items() if only is None or name in only
+        }
+    finally:
+        gc.enable()
+
+
+def matches_request():
+    return Request({
+        "type": "http", "method": "GET", "scheme": "http", "path": "/api/discovery/matches",
+        "query_string": b"", "headers": [(b"host", b"bench")], "server": ("bench", 80),
+    })
+
+
+def use_search(mode):
+    server.MATCH_SEARCH = mode
+    server.hub_region_keys.cache_clear()  # its keys depend on the search mode
+
+
+async def seed(size, dense):
+    """A FakeDB with `size` synthetic routes; with `dense`, the first routes all share one hub"""
+    fake = FakeDB()
+    users, routes, _ = generate_population(size, seed=size)
+    if dense:
+        hub = routes[0]
+        for route in routes[:dense]:
+            route.update({key: hub[key] for key in ("start_coords", "end_coords", "start_tile", "end_tile",
+                                                    "via_tiles", "departure_time", "days_of_week")})
+    await fake.users.insert_many(users)
+    await fake.routes.insert_many(routes)
+    server.db = server.read_db = server.fast_db = fake
+    return [User(**u) for u in users]
+
+
+async def time_pass(viewers, cold_per_viewer):
+    """(adaptive, scan) seconds for one get_matches call per viewer, the hub cache cold for every
+    viewer or for the pass; the two searches take turns viewer by viewer, so host noise hits both"""
+    caches = {mode: server.LRUCache(server.MATCH_HUB_CACHE_SIZE) for mode in ("adaptive", "scan")}
+    seconds = dict.fromkeys(caches, 0.0)
+    # Like timeit, without the collector: with a 100k-document collection in memory a full collection
+    # takes longer than a request and lands on whichever search happens to be running
+    gc.collect()
+    gc.disable()
+    try:
+        for viewer in viewers:
+            for mode in caches:
+                use_search(mode)
+                server.hub_matcher.cache = server.LRUCache(server.MATCH_HUB_CACHE_SIZE) if cold_per_viewer else caches[mode]
+                started = time.perf_counter()
+                await server.get_matches(matches_request(), current_user=viewer)
+                seconds[mode] += time.perf_counter() - started
+    finally:
+        gc.enable()
+    return seconds["adaptive"], seconds["scan"]
+
+
+async def bench_get_matches(size, repeat, requests, dense):
+    """paired_rates of adaptive get_matches against scan, for random viewers or members of one dense hub"""
+    viewers = (await seed(size, requests if dense else 0))[:requests]
+    return paired_rates([await time_pass(viewers, cold_per_viewer=not dense) for _ in range(repeat)], len(viewers))
+
+
+def run_benchmarks(sizes, repeat, requests, only=None):
+    """{name: (calls/sec, ratio to the reference)} per benchmark (all of them, or just the names in `only`)"""
+    results = bench_primitives(repeat, only)
+    original = (server.db, server.read_db, server.fast_db, server.MATCH_SEARCH, server.untiled_routes_remain,
+                server.hub_matcher.cache)
+    server.untiled_routes_remain = False  # every seeded route has tiles
+    try:
+        for size in sizes:
+            for kind in MATCH_BENCHMARKS:
+                name = f"{kind}[{size}]"
+                if only is None or name in only:
+                    results[name] = asyncio.run(bench_get_matches(size, repeat, requests, dense=kind == "get_matches_hub"))
+    finally:
+        (server.db, server.read_db, server.fast_db, server.MATCH_SEARCH, server.untiled_routes_remain,
+         server.hub_matcher.cache) = original
+        server.hub_region_keys.cache_clear()
+    return results
+
+
+def compare(results, baseline, max_regression):
+    failures = []
+    for name, (rate, ratio) in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"  {name:26} {rate:>12,.0f}/s  {ratio:7.2f}x reference  (not in baseline)")
+            continue
+        change = ratio / base - 1
+        flag = "REGRESSION" if change < -max_regression else "ok"
+        print(f"  {name:26} {rate:>12,.0f}/s  {ratio:7.2f}x reference  baseline {base:7.2f}x  {change:+7.1%}  {flag}")
+        if flag == "REGRESSION":
+            failures.append(name)
+    return failures
+
+
+def check(sizes, repeat, requests, baseline, max_regression, only=None):
+    """Names whose ratio to the reference dropped more than max_regression below the baseline, after a re-measure"""
+    results = run_benchmarks(sizes, repeat, requests, only)
+    failures = compare(results, baseline, max_regression)
+    if failures:
+        # Timings on a shared machine are noisy; only a drop that survives a second, longer measurement fails
+        print(f"Re-measuring {', '.join(failures)}:")
+        retry = run_benchmarks(sizes, repeat * 2, requests, only=set(failures))
+        best = {name: max(rates, results[name], key=lambda pair: pair[1]) for name, rates in retry.items()}
+        failures = compare(best, baseline, max_regression)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="routes in the collection")
+    parser.add_argument("--repeat", type=int, default=5, help="timed rounds (x10 for the primitives)")
+    parser.add_argument("--requests", type=int, default=20, help="get_matches calls per timing sample")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed drop of a ratio (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    server.RATE_LIMITS["discovery"] = "off"  # every viewer calls get_matches once per repeat
+    if args.save_baseline:
+        results = run_benchmarks(args.sizes, args.repeat, args.requests)
+        for name, (rate, ratio) in results.items():
+            print(f"{name:28} {rate:>14,.1f} ops/s  {ratio:7.2f}x reference")
+        args.baseline.write_text(json.dumps({name: ratio for name, (_, ratio) in results.items()}, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        sys.exit(f"No baseline at {args.baseline}; run with --save-baseline first")
+
+    print(f"Comparing against {args.baseline} (max regression {args.max_regression:.0%}):")
+    baseline = json.loads(args.baseline.read_text())
+    failures = check(args.sizes, args.repeat, args.requests, baseline, args.max_regression)
+    if failures:
+        print(f"Throughput regressed: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
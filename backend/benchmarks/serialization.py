@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Serialization micro-benchmark for RouteBuddy read endpoints
+Compares the old model + jsonable_encoder + json path against direct orjson encoding
+
+Usage (from backend/): python -m benchmarks.serialization [--rows 200] [--repeat 200]
+"""
+
+import argparse
+import json
+import timeit
+from datetime import datetime, timezone
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from server import User, Route, Message, public_fields
+
+# Motor hands back naive UTC datetimes, so benchmark with the same shape
+NOW = datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def make_user(i):
+    return {
+        "user_id": f"user_{i:012d}",
+        "email": f"commuter{i}@example.com",
+        "name": f"Commuter {i}",
+        "picture": f"https://example.com/{i}.jpg",
+        "profile_images": [],
+        "bio": "Daily train from the suburbs",
+        "verified": i % 2 == 0,
+        "id_verification_image": None,
+        "blocked_users": [],
+        "created_at": NOW
+    }
+
+
+def make_route(i):
+    return {
+        "route_id": f"route_{i:012d}",
+        "user_id": f"user_{i:012d}",
+        "start_coords": {"lat": 40.7 + i * 1e-4, "lng": -74.0},
+        "end_coords": {"lat": 40.75, "lng": -73.98 - i * 1e-4},
+        "start_address": "Central Station",
+        "end_address": "Business District",
+        "departure_time": "08:15",
+        "days_of_week": ["monday", "tuesday", "wednesday", "thursday", "friday"],
+        "active": True,
+        "created_at": NOW
+    }
+
+
+def make_message(i):
+    return {
+        "message_id": f"msg_{i:012d}",
+        "sender_id": "user_a",
+        "receiver_id": "user_b",
+        "content": "See you on the 8:15 platform 3?",
+        "timestamp": NOW,
+        "read": bool(i % 3)
+    }
+
+
+def make_match(i):
+    return {
+        "user_id": f"user_{i:012d}",
+        "name": f"Commuter {i}",
+        "picture": None,
+        "bio": "Daily train from the suburbs",
+        "verified": True,
+        "route_match_score": 87.5,
+        "distance_to_start": 0.42,
+        "distance_to_end": 1.1
+    }
+
+
+def make_connection(i):
+    return {
+        "connection_id": f"conn_{i:012d}",
+        "user1_id": "user_a",
+        "user2_id": f"user_{i:012d}",
+        "status": "accepted",
+        "created_at": NOW,
+        "other_user": {"user_id": f"user_{i:012d}", "name": f"Commuter {i}", "picture": None, "verified": True}
+    }
+
+
+def legacy_encode(content, model=None):
+    """Old path: build models, run jsonable_encoder, then stdlib json"""
+    if model is not None:
+        content = [model(**doc) for doc in content] if isinstance(content, list) else model(**content)
+    return json.dumps(jsonable_encoder(content)).encode()
+
+
+def fast_encode(content, model=None):
+    """New path: project the Mongo documents onto the model's fields, as the endpoints do, and encode them directly"""
+    if model is not None:
+        content = [public_fields(model, doc) for doc in content] if isinstance(content, list) else public_fields(model, content)
+    return orjson.dumps(content)
+
+
+def build_cases(rows):
+    return {
+        "GET /api/profile/me": (make_user(0), User),
+        "GET /api/routes/my-routes": ([make_route(i) for i in range(min(rows, 100))], Route),
+        "GET /api/discovery/matches": ([make_match(i) for i in range(min(rows, 50))], None),
+        "GET /api/connections/list": ([make_connection(i) for i in range(rows)], None),
+        "GET /api/messages/conversation/{id}": ([make_message(i) for i in range(rows)], Message),
+    }
+
+
+def run(rows, repeat):
+    results = {}
+    for endpoint, (content, model) in build_cases(rows).items():
+        assert json.loads(legacy_encode(content, model)) == json.loads(fast_encode(content, model))
+        legacy = min(timeit.repeat(lambda: legacy_encode(content, model), number=repeat, repeat=3)) / repeat
+        fast = min(timeit.repeat(lambda: fast_encode(content, model), number=repeat, repeat=3)) / repeat
+        results[endpoint] = {
+            "legacy_us": round(legacy * 1e6, 1),
+            "orjson_us": round(fast * 1e6, 1),
+            "speedup": round(legacy / fast, 1)
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200, help="list length for list endpoints")
+    parser.add_argument("--repeat", type=int, default=200, help="encodes per timing sample")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat)
+    print(f"{'endpoint':40} {'legacy µs':>12} {'orjson µs':>12} {'speedup':>8}")
+    for endpoint, r in results.items():
+        print(f"{endpoint:40} {r['legacy_us']:>12} {r['orjson_us']:>12} {r['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Match snapshot freshness check: replays a mix of Discover reads and writes (route moves, profile
+edits, blocks by random users) against an in-memory MongoDB, with the task queue drained after every
+operation, and reports how many default first pages were served from the queue's snapshot instead of
+being recomputed. Compared: one global version that every write moves (the snapshot is stale after any
+write), versions of the cells the snapshot's hubs read, and those plus MATCH_SNAPSHOT_MAX_AGE.
+Exits non-zero if the scoped versions do not serve more reads from snapshots than the global one.
+
+Usage (from backend/):
+  python -m benchmarks.snapshot_freshness
+  python -m benchmarks.snapshot_freshness --users 500 --operations 500 --write-share 0.2
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from server import User
+from benchmarks.coalescing import make_request
+from benchmarks.synthetic import generate_population
+
+
+async def seed(db, users, seed):
+    population, routes, _ = generate_population(users, seed=seed)
+    await db.users.insert_many([dict(doc) for doc in population])
+    await db.routes.insert_many([dict(doc) for doc in routes])
+    return [User(**doc) for doc in population], {route["user_id"]: route for route in routes}
+
+
+async def drain_tasks():
+    """Run the match warmups the writes queued, as the task workers would"""
+    while (task := await server.claim_task()) is not None:
+        await server.run_task(task)
+
+
+async def write(rng, people, routes):
+    user = rng.choice(people)
+    kind = rng.choices(["route", "profile", "block"], weights=[6, 3, 1])[0]
+    if kind == "route":
+        route = routes[user.user_id]
+        start, end = route["start_coords"], route["end_coords"]
+        moved = server.RouteCreate(
+            start_coords=server.Coordinates(lat=start["lat"] + rng.uniform(-0.005, 0.005), lng=start["lng"]),
+            end_coords=server.Coordinates(**end), start_address="Home", end_address="Work",
+            departure_time=route["departure_time"], days_of_week=route["days_of_week"],
+        )
+        await server.update_route(route["route_id"], moved, current_user=user)
+    elif kind == "profile":
+        await server.update_profile(server.ProfileUpdate(bio=f"bio {rng.random()}"), current_user=user)
+    else:
+        await server.block_user(rng.choice([other for other in people if other is not user]).user_id, current_user=user)
+
+
+async def run(args):
+    """Counts of reads served fresh, served stale (within MATCH_SNAPSHOT_MAX_AGE) and computed, and of
+    pages the queue recomputed"""
+    db = AsyncMongoMockClient()["snapshot_freshness"]
+    server.db = server.read_db = server.fast_db = db
+    server.hub_matcher.cache = server.LRUCache(server.MATCH_HUB_CACHE_SIZE)
+    people, routes = await seed(db, args.users, args.users)
+    readers = people[:args.readers]
+    for reader in readers:
+        await server.recompute_matches({"user_id": reader.user_id})
+    await db.tasks.delete_many({})
+
+    counts = {"fresh": 0, "stale": 0, "computed": 0, "recomputed": 0}
+    calls = {"compute": 0, "warmup": 0}
+    compute_matches, schedule_match_warmup = server.compute_matches, server.schedule_match_warmup
+
+    async def counting_compute_matches(*call_args, **kwargs):
+        calls["compute"] += 1
+        return await compute_matches(*call_args, **kwargs)
+
+    async def counting_warmup(user_id):
+        calls["warmup"] += 1
+        await schedule_match_warmup(user_id)
+
+    server.compute_matches, server.schedule_match_warmup = counting_compute_matches, counting_warmup
+    rng = random.Random(args.seed)
+    try:
+        for _ in range(args.operations):
+            if rng.random() < args.write_share:
+                await write(rng, people, routes)
+            else:
+                before = dict(calls)
+                await server.get_matches(make_request("/api/discovery/matches"), current_user=rng.choice(readers))
+                if calls["compute"] > before["compute"]:
+                    counts["computed"] += 1
+                else:
+                    counts["stale" if calls["warmup"] > before["warmup"] else "fresh"] += 1
+            before = calls["compute"]
+            await drain_tasks()
+            counts["recomputed"] += calls["compute"] - before
+    finally:
+        server.compute_matches, server.schedule_match_warmup = compute_matches, schedule_match_warmup
+    return counts
+
+
+async def global_run(args):
+    """run() as before scoped versions: every write also moves "discovery", which every snapshot depends on"""
+    bump_versions, match_dependencies = server.bump_versions, server.match_dependencies
+
+    async def bump_all(*keys):
+        await bump_versions(*keys, server.DISCOVERY_VERSION_KEY)
+
+    async def global_dependencies(user_id, user_routes, versions):
+        return [server.DISCOVERY_VERSION_KEY]
+
+    server.bump_versions, server.match_dependencies = bump_all, global_dependencies
+    try:
+        return await run(args)
+    finally:
+        server.bump_versions, server.match_dependencies = bump_versions, match_dependencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="synthetic users (one route each)")
+    parser.add_argument("--readers", type=int, default=40, help="users opening Discover")
+    parser.add_argument("--operations", type=int, default=200, help="reads and writes in total")
+    parser.add_argument("--write-share", type=float, default=0.05, help="fraction of operations that write")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    original = (server.db, server.read_db, server.fast_db, server.emit_event, server.untiled_routes_remain,
+                server.MATCH_SNAPSHOT_MAX_AGE)
+    max_age = server.MATCH_SNAPSHOT_MAX_AGE
+    server.RATE_LIMITS["discovery"] = "off"
+    server.untiled_routes_remain = False  # every seeded route has tiles
+
+    async def no_socket(*call_args, **kwargs):
+        pass
+
+    server.emit_event = no_socket
+    results = {}
+    try:
+        server.MATCH_SNAPSHOT_MAX_AGE = 0
+        results["global version"] = asyncio.run(global_run(args))
+        results["scoped versions"] = asyncio.run(run(args))
+        server.MATCH_SNAPSHOT_MAX_AGE = max_age
+        results[f"scoped, {max_age:g}s max age"] = asyncio.run(run(args))
+    finally:
+        (server.db, server.read_db, server.fast_db, server.emit_event, server.untiled_routes_remain,
+         server.MATCH_SNAPSHOT_MAX_AGE) = original
+
+    print(f"{args.operations} operations, {args.write_share:.0%} writes, {args.readers} readers of "
+          f"{args.users} users; default first pages:")
+    served = {name: counts["fresh"] + counts["stale"] for name, counts in results.items()}
+    for name, counts in results.items():
+        reads = served[name] + counts["computed"]
+        print(f"  {name:24} from snapshot {served[name]:>4} / {reads:<4} ({served[name] / max(reads, 1):4.0%}, "
+              f"{counts['stale']} stale)   computed {counts['computed']:>4}   recomputed by the queue {counts['recomputed']:>4}")
+    if any(count <= served["global version"] for name, count in served.items() if name != "global version"):
+        print("FAIL: scoped versions did not serve more pages from snapshots")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Synthetic commuter population for benchmarks
+Homes cluster around suburban hubs and workplaces around a few business districts,
+so route density looks like a real metro area rather than uniform noise.
+"""
+
+import random
+import uuid
+from datetime import datetime, timezone, timedelta
+from math import cos, sin, radians, pi
+
+from geo import geohash, via_tiles
+
+# Roughly central Manhattan; only the shape of the distribution matters
+CITY_CENTER = (40.7549, -73.9840)
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+BENCH_EMAIL_DOMAIN = "bench.routebuddy.local"
+
+
+def offset(center, km_north, km_east):
+    lat, lng = center
+    return (lat + km_north / 111.0, lng + km_east / (111.0 * cos(radians(lat))))
+
+
+def make_hubs(rng, count, min_km, max_km):
+    hubs = []
+    for _ in range(count):
+        distance = rng.uniform(min_km, max_km)
+        bearing = rng.uniform(0, 2 * pi)
+        hubs.append(offset(CITY_CENTER, distance * cos(bearing), distance * sin(bearing)))
+    return hubs
+
+
+def jitter(rng, hub, spread_km):
+    return offset(hub, rng.gauss(0, spread_km), rng.gauss(0, spread_km))
+
+
+def departure_time(rng):
+    """Morning peak around 08:00, quarter-hour granularity like the route picker"""
+    minutes = int(min(max(rng.gauss(8 * 60, 45), 5 * 60), 11 * 60))
+    minutes -= minutes % 15
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def generate_population(users, routes_per_user=1, home_hubs=40, work_hubs=8, seed=42):
+    """Return (users, routes, sessions) documents shaped like the ones server.py writes"""
+    rng = random.Random(seed)
+    homes = make_hubs(rng, home_hubs, 5, 25)
+    works = make_hubs(rng, work_hubs, 0, 4)
+    # A handful of hubs (big stations, big employers) attract most commuters
+    home_weights = [1 / (i + 1) for i in range(home_hubs)]
+    work_weights = [1 / (i + 1) for i in range(work_hubs)]
+    now = datetime.now(timezone.utc)
+
+    user_docs, route_docs, session_docs = [], [], []
+    for i in range(users):
+        user_id = f"user_{uuid.UUID(int=rng.getrandbits(128)).hex[:12]}"
+        user_docs.append({
+            "user_id": user_id,
+            "email": f"commuter{i}@{BENCH_EMAIL_DOMAIN}",
+            "name": f"Commuter {i}",
+            "picture": None,
+            "profile_images": [],
+            "bio": None,
+            "verified": rng.random() < 0.3,
+            "id_verification_image": None,
+            "blocked_users": [],
+            "created_at": now
+        })
+        session_docs.append({
+            "user_id": user_id,
+            "session_token": f"bench_session_{user_id}",
+            "expires_at": now + timedelta(days=7),
+            "created_at": now
+        })
+
+        home = rng.choices(homes, home_weights)[0]
+        work = rng.choices(works, work_weights)[0]
+        for r in range(routes_per_user):
+            start = jitter(rng, home, 0.8)
+            end = jitter(rng, work, 0.4)
+            route_docs.append({
+                "route_id": f"route_{uuid.UUID(int=rng.getrandbits(128)).hex[:12]}",
+                "user_id": user_id,
+                "start_coords": {"lat": start[0], "lng": start[1]},
+                "end_coords": {"lat": end[0], "lng": end[1]},
+                "start_tile": geohash(start[0], start[1]),
+                "end_tile": geohash(end[0], end[1]),
+                "via_tiles": via_tiles(start, end),
+                "start_address": f"Home hub {homes.index(home)}",
+                "end_address": f"Work hub {works.index(work)}",
+                "departure_time": departure_time(rng),
+                "days_of_week": WEEKDAYS if rng.random() < 0.8 else rng.sample(WEEKDAYS, 3),
+                "active": True,
+                "created_at": now
+            })
+
+    return user_docs, route_docs, session_docs
@@ -0,0 +1,85 @@
+"""
+Geohash tiles for routes, shared by the server, the migrations and the benchmark seeding
+Route documents carry start_tile / end_tile (their endpoints' cells) and via_tiles (the cells their
+straight line crosses); everything that writes routes computes them here so the tiles agree with
+the server's queries. Importing this module does not touch the database.
+"""
+
+import os
+from math import atan2, ceil, cos, radians, sin, sqrt
+from pathlib import Path
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv(Path(__file__).parent / '.env')
+
+# Route endpoints are snapped to geohash tiles of PLACE_TILE_PRECISION characters (7 = ~150 m)
+PLACE_TILE_PRECISION = int(os.environ.get('PLACE_TILE_PRECISION', '7'))
+# Routes are indexed by the MATCH_VIA_PRECISION cells (6 = ~1 km) their line crosses, leaving out
+# the stretch within MATCH_PICKUP_DISTANCE km of either end
+MATCH_VIA_PRECISION = int(os.environ.get('MATCH_VIA_PRECISION', '6'))
+MATCH_PICKUP_DISTANCE = float(os.environ.get('MATCH_PICKUP_DISTANCE', '1'))  # km
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+Point = Tuple[float, float]  # (lat, lng)
+
+
+def geohash(lat: float, lng: float, precision: int = PLACE_TILE_PRECISION) -> str:
+    """Standard geohash; every character narrows the cell, so prefixes are coarser tiles"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, use_lng = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lng_range, lng) if use_lng else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if coord >= mid:
+            value = value * 2 + 1
+            rng[0] = mid
+        else:
+            value *= 2
+            rng[1] = mid
+        use_lng = not use_lng
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return "".join(chars)
+
+
+def geohash_cell_km(precision: int, lat: float) -> Tuple[float, float]:
+    """(width, height) in km of a geohash cell at this latitude"""
+    lng_bits, lat_bits = (5 * precision + 1) // 2, 5 * precision // 2
+    height = 180 / 2 ** lat_bits * 110.574
+    width = 360 / 2 ** lng_bits * 111.320 * cos(radians(lat))
+    return width, height
+
+
+def distance_km(start: Point, end: Point) -> float:
+    """Great-circle distance in km (Haversine formula)"""
+    lat1, lon1 = radians(start[0]), radians(start[1])
+    lat2, lon2 = radians(end[0]), radians(end[1])
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    return 6371 * c
+
+
+def via_tiles(start: Point, end: Point) -> List[str]:
+    """The MATCH_VIA_PRECISION cells along the straight line from start to end, for finding pickups
+
+    The stretch within MATCH_PICKUP_DISTANCE of either end is left out: routes starting near a trip
+    are found through their endpoint tiles, and leaving them out keeps everyone leaving a busy hub
+    from matching every pickup query there.
+    """
+    length = distance_km(start, end)
+    width, height = geohash_cell_km(MATCH_VIA_PRECISION, start[0])
+    steps = min(1000, max(1, ceil(length / (min(width, height) / 2))))
+    margin = MATCH_PICKUP_DISTANCE / length if length else 1.0
+    return sorted({
+        geohash(
+            start[0] + (end[0] - start[0]) * step / steps,
+            start[1] + (end[1] - start[1]) * step / steps,
+            MATCH_VIA_PRECISION
+        )
+        for step in range(steps + 1) if margin < step / steps < 1 - margin
+    })
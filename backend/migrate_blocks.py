@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Backfill the blocks collection from users.blocked_users
+Discovery filters blocks through db.blocks. The server runs this backfill at startup until it has
+completed once; run it by hand to do that ahead of a deploy. Edges are upserted, and once a backfill
+has completed later runs do nothing.
+
+Usage (from backend/): python migrate_blocks.py [--batch-size 1000]
+"""
+
+import argparse
+import asyncio
+
+from server import backfill_block_edges, client, ensure_block_indexes
+
+
+async def backfill(batch_size):
+    await ensure_block_indexes()
+    return await backfill_block_edges(batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000, help="edges per bulk write")
+    args = parser.parse_args()
+    try:
+        users, edges = asyncio.run(backfill(args.batch_size))
+    finally:
+        client.close()
+    print(f"Backfilled {edges} block edges from {users} users")
+
+
+if __name__ == "__main__":
+    main()
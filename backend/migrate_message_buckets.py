@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Copy per-message documents into per-conversation buckets (MESSAGE_STORAGE=buckets)
+Each conversation's messages are grouped, oldest first, into buckets of MESSAGE_BUCKET_SIZE.
+Buckets are only inserted, never overwritten, so re-running is safe; with --delete the migrated
+message documents are removed and a re-run only picks up messages sent since.
+
+Typical switch-over: deploy with MESSAGE_STORAGE=buckets, then run
+  python migrate_message_buckets.py --delete
+
+Usage (from backend/): python migrate_message_buckets.py [--delete] [--concurrency 8]
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from server import client, db, conversation_key, ensure_message_indexes, MESSAGE_BUCKET_SIZE
+
+# Both orderings of a pair map to the same "<lower>|<higher>" key, like conversation_key()
+CONVERSATION_KEY_EXPR = {
+    "$cond": [
+        {"$lt": ["$sender_id", "$receiver_id"]},
+        {"$concat": ["$sender_id", "|", "$receiver_id"]},
+        {"$concat": ["$receiver_id", "|", "$sender_id"]},
+    ]
+}
+
+
+async def conversations():
+    pipeline = [{"$group": {"_id": CONVERSATION_KEY_EXPR}}]
+    async for row in db.messages.aggregate(pipeline, allowDiskUse=True):
+        yield row["_id"]
+
+
+def bucket_update(conversation, messages):
+    unread = Counter(m["receiver_id"] for m in messages if not m.get("read"))
+    return UpdateOne(
+        {"_id": f"{conversation}:{messages[0]['message_id']}"},
+        {"$setOnInsert": {
+            "conversation": conversation,
+            "first_ts": messages[0]["timestamp"],
+            "last_ts": messages[-1]["timestamp"],
+            "count": len(messages),
+            "unread": dict(unread),
+            "messages": messages,
+        }},
+        upsert=True
+    )
+
+
+async def migrate_conversation(conversation, bucket_size, delete):
+    user_a, user_b = conversation.split("|", 1)
+    assert conversation_key(user_a, user_b) == conversation
+    messages = await db.messages.find(
+        {"$or": [{"sender_id": user_a, "receiver_id": user_b}, {"sender_id": user_b, "receiver_id": user_a}]},
+        {"_id": 0}
+    ).sort("timestamp", 1).to_list(None)
+    if not messages:
+        return 0
+
+    chunks = [messages[i:i + bucket_size] for i in range(0, len(messages), bucket_size)]
+    await db.message_buckets.bulk_write([bucket_update(conversation, chunk) for chunk in chunks], ordered=False)
+    if delete:
+        await db.messages.delete_many({"message_id": {"$in": [m["message_id"] for m in messages]}})
+    return len(messages)
+
+
+async def migrate(bucket_size, concurrency, delete):
+    await ensure_message_indexes()
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+    totals = Counter()
+
+    async def worker():
+        while (conversation := await queue.get()) is not None:
+            totals["messages"] += await migrate_conversation(conversation, bucket_size, delete)
+            totals["conversations"] += 1
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    async for conversation in conversations():
+        await queue.put(conversation)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    return totals["conversations"], totals["messages"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket-size", type=int, default=MESSAGE_BUCKET_SIZE)
+    parser.add_argument("--concurrency", type=int, default=8, help="conversations migrated in parallel")
+    parser.add_argument("--delete", action="store_true", help="remove message documents once bucketed")
+    args = parser.parse_args()
+    try:
+        conversation_count, message_count = asyncio.run(migrate(args.bucket_size, args.concurrency, args.delete))
+    finally:
+        client.close()
+    print(f"Bucketed {message_count} messages from {conversation_count} conversations")
+
+
+if __name__ == "__main__":
+    main()
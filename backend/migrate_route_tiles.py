@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Backfill start_tile / end_tile / via_tiles on routes saved before they existed, and zero-pad their
+departure and return times
+The adaptive candidate search (MATCH_SEARCH=adaptive) finds routes through their tiles; while
+routes without endpoint tiles remain, every search also scans for them, and routes without
+via_tiles never offer a pickup along the way. It also compares times as "HH:MM" strings, so a
+route saved as "8:00" is never found. Run this once after upgrading. Safe to re-run: only routes
+still missing a tile or with an unpadded time are touched.
+
+Usage (from backend/): python migrate_route_tiles.py [--batch-size 1000]
+"""
+
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from geo import geohash, via_tiles
+from server import bump_versions, client, clock_time, db, ensure_place_indexes, route_region_keys
+
+PADDED_TIME = {"$regex": "^[0-9]{2}:[0-9]{2}$"}
+
+
+async def backfill(batch_size):
+    await ensure_place_indexes()
+    routes = 0
+    ops = []
+    cursor = db.routes.find(
+        {"$or": [{field: {"$exists": False}} for field in ("start_tile", "end_tile", "via_tiles")]},
+        {"_id": 0, "route_id": 1, "start_coords": 1, "end_coords": 1, "start_tile": 1, "end_tile": 1, "via_tiles": 1}
+    )
+    async for route in cursor:
+        start, end = route["start_coords"], route["end_coords"]
+        # Tiles already set came from the route's places; keep them
+        tiles = {
+            "start_tile": geohash(start["lat"], start["lng"]),
+            "end_tile": geohash(end["lat"], end["lng"]),
+            "via_tiles": via_tiles((start["lat"], start["lng"]), (end["lat"], end["lng"])),
+        }
+        ops.append(UpdateOne(
+            {"route_id": route["route_id"]},
+            {"$set": {field: value for field, value in tiles.items() if field not in route}}
+        ))
+        if len(ops) >= batch_size:
+            await db.routes.bulk_write(ops, ordered=False)
+            routes += len(ops)
+            ops = []
+    if ops:
+        await db.routes.bulk_write(ops, ordered=False)
+        routes += len(ops)
+    return routes
+
+
+async def normalize_times(batch_size):
+    """Rewrite departure and return times as zero-padded "HH:MM"; times that do not parse are reported and left alone"""
+    routes = 0
+    ops, keys = [], set()
+    cursor = db.routes.find(
+        {"$or": [{"departure_time": {"$not": PADDED_TIME}},
+                 {"return_time": {"$type": "string", "$not": PADDED_TIME}}]},
+        {"_id": 0}
+    )
+    async for route in cursor:
+        times = {}
+        for field in ("departure_time", "return_time"):
+            if isinstance(route.get(field), str):
+                try:
+                    times[field] = clock_time(route[field])
+                except ValueError:
+                    print(f"Route {route['route_id']}: cannot read {field} {route[field]!r}")
+        times = {field: value for field, value in times.items() if value != route[field]}
+        if not times:
+            continue
+        ops.append(UpdateOne({"route_id": route["route_id"]}, {"$set": times}))
+        # The route now shows up in searches of its regions, so results cached for them are out of date
+        keys.update(route_region_keys(route), [f"routes:{route['user_id']}"])
+        if len(ops) >= batch_size:
+            await db.routes.bulk_write(ops, ordered=False)
+            routes += len(ops)
+            ops = []
+    if ops:
+        await db.routes.bulk_write(ops, ordered=False)
+        routes += len(ops)
+    await bump_versions(*keys)
+    return routes
+
+
+async def migrate(batch_size):
+    # Tiles first, so the versions the time pass moves are those of the routes' cells
+    return await backfill(batch_size), await normalize_times(batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000, help="routes per bulk write")
+    args = parser.parse_args()
+    try:
+        routes, retimed = asyncio.run(migrate(args.batch_size))
+    finally:
+        client.close()
+    print(f"Backfilled tiles on {routes} routes")
+    print(f"Zero-padded the times of {retimed} routes")
+
+
+if __name__ == "__main__":
+    main()
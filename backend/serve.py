@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the RouteBuddy backend
+Serves server:socket_app (FastAPI + Socket.IO) with multiple uvicorn workers
+
+Configuration (environment):
+  HOST / PORT                 bind address (0.0.0.0:8001)
+  WEB_CONCURRENCY             worker processes (defaults to CPU count)
+  KEEP_ALIVE_TIMEOUT          idle keep-alive seconds (75, above typical LB idle timeouts)
+  BACKLOG                     listen backlog (4096)
+  GRACEFUL_TIMEOUT            seconds to drain in-flight requests on SIGTERM (30)
+  LIMIT_MAX_REQUESTS          recycle a worker after this many requests (unset = never)
+  FORWARDED_ALLOW_IPS         proxies trusted for X-Forwarded-* ("*")
+  PROMETHEUS_MULTIPROC_DIR    shared metrics directory so /metrics covers every worker (cleared on start)
+
+Usage (from backend/): python serve.py [--workers N] [--port 8001]
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import shutil
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def pick(module, fallback="auto"):
+    """Use the fast implementation when it is installed"""
+    return module if importlib.util.find_spec(module) else fallback
+
+
+def prepare_metrics_dir():
+    """Multiprocess Prometheus metrics need an empty shared directory before workers start"""
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def build_config(args):
+    workers = args.workers or env_int("WEB_CONCURRENCY", os.cpu_count() or 1)
+
+    if workers > 1:
+        # Polling requests from one client may hit different workers; stick to websockets
+        os.environ.setdefault("SOCKETIO_TRANSPORTS", "websocket")
+        if not os.environ.get("SOCKETIO_MESSAGE_QUEUE"):
+            logger.warning(
+                "Running %d workers without SOCKETIO_MESSAGE_QUEUE: socket events only reach "
+                "clients connected to the emitting worker", workers
+            )
+
+    return dict(
+        app=args.app,
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=pick("uvloop"),
+        http=pick("httptools"),
+        ws="websockets",
+        lifespan="on",
+        proxy_headers=True,
+        forwarded_allow_ips=os.environ.get("FORWARDED_ALLOW_IPS", "*"),
+        timeout_keep_alive=env_int("KEEP_ALIVE_TIMEOUT", 75),
+        backlog=env_int("BACKLOG", 4096),
+        timeout_graceful_shutdown=env_int("GRACEFUL_TIMEOUT", 30),
+        limit_max_requests=env_int("LIMIT_MAX_REQUESTS", None),
+        access_log=os.environ.get("ACCESS_LOG", "false").lower() == "true",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the RouteBuddy backend")
+    parser.add_argument("--app", default="server:socket_app", help="ASGI app import string")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=env_int("PORT", 8001))
+    parser.add_argument("--workers", type=int, default=None, help="overrides WEB_CONCURRENCY")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    prepare_metrics_dir()
+    config = build_config(args)
+    logger.info(
+        "Serving %s on %s:%d with %d worker(s), loop=%s http=%s",
+        config["app"], config["host"], config["port"], config["workers"], config["loop"], config["http"]
+    )
+    uvicorn.run(**config)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,362 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Depends, Query
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse, FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReadPreference, ReturnDocument, WriteConcern, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo import monitoring
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
 import socketio
 import os
 import logging
 import httpx
+import orjson
+import hashlib
+import asyncio
+import random
+import time
+import hmac
+import io
+import re
+import cProfile
+import functools
+import base64
+import heapq
+import importlib
+import platform
+import zlib
+from http.cookies import SimpleCookie
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict, deque
+from pydantic import BaseModel, Field, field_validator
+from typing import List, Optional, Dict, Any, AsyncIterator, Awaitable, Callable, Hashable, NamedTuple, Set, Tuple, Annotated
 import uuid
 from datetime import datetime, timezone, timedelta
-from math import radians, sin, cos, sqrt, atan2
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from math import radians, sin, cos, sqrt, atan2, ceil, hypot
+from geo import (
+    GEOHASH_ALPHABET, MATCH_PICKUP_DISTANCE, MATCH_VIA_PRECISION, PLACE_TILE_PRECISION,
+    geohash, geohash_cell_km, via_tiles,
+)
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # Brotli is optional, gzip covers every client
+    BrotliMiddleware = None
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # Fall back to cProfile (.pstats output)
+    Profiler = None
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # Uploaded images are stored as sent
+    Image = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics (set PROMETHEUS_MULTIPROC_DIR to aggregate across serve.py workers)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # optional bearer token for /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'MongoDB time spent per HTTP request', ['method', 'route'], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_DB_COMMANDS = Histogram(
+    'http_request_db_commands', 'MongoDB round trips per HTTP request', ['method', 'route'],
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    'mongodb_command_duration_seconds', 'MongoDB command latency', ['command'], buckets=LATENCY_BUCKETS
+)
+MONGO_COMMAND_FAILURES = Counter('mongodb_command_failures_total', 'Failed MongoDB commands', ['command'])
+
+SOCKET_CONNECTIONS = Gauge('socketio_connections', 'Connected Socket.IO clients', multiprocess_mode='livesum')
+SOCKET_EVENTS = Counter('socketio_events_total', 'Socket.IO events received', ['event'])
+SOCKET_EVENT_SECONDS = Histogram(
+    'socketio_event_duration_seconds', 'Socket.IO handler latency', ['event'], buckets=LATENCY_BUCKETS
+)
+SOCKET_EMITS = Counter('socketio_emits_total', 'Socket.IO events emitted', ['event'])
+SOCKET_QUEUE_DEPTH = Histogram(
+    'socketio_send_queue_depth', 'Packets waiting to be written, sampled per client on every sweep',
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+SOCKET_QUEUE_MAX = Gauge('socketio_send_queue_max', 'Deepest client send queue at the last sweep', multiprocess_mode='max')
+SOCKET_SLOW_DISCONNECTS = Counter('socketio_slow_consumer_disconnects_total', 'Clients dropped for not draining their queue')
+
+RATE_LIMITED = Counter('rate_limited_total', 'Requests rejected by the per-user rate limiter', ['endpoint_class'])
+REQUESTS_SHED = Counter('admission_shed_total', 'Requests shed by admission control', ['reason'])
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being handled', multiprocess_mode='livesum')
+EVENT_LOOP_LAG = Gauge('event_loop_lag_seconds', 'Event loop scheduling delay at the last probe', multiprocess_mode='max')
+
+MATCH_SEARCH_RADIUS = Histogram(
+    'match_search_radius_km', 'Ring at which an adaptive candidate search stopped', buckets=(1, 2.5, 5, 10, 25, 50, 100)
+)
+MATCH_CANDIDATES_EXAMINED = Histogram(
+    'match_candidates_examined', 'Routes scored by one candidate search', buckets=(10, 50, 100, 250, 500, 1000, 2000, 5000)
+)
+MESSAGES_ARCHIVED = Counter('messages_archived_total', 'Messages moved from the hot collection to the archive')
+TASKS_RUN = Counter('tasks_total', 'Background tasks run, by kind and outcome', ['kind', 'result'])
+TASK_SECONDS = Histogram('task_duration_seconds', 'Background task handler time', ['kind'])
+PUSH_NOTIFICATIONS = Counter('push_notifications_total', 'Push deliveries by provider and outcome', ['provider', 'result'])
+
+class RequestTiming:
+    """Mongo round trips attributed to the request running in the current context"""
+    __slots__ = ('db_commands', 'db_seconds')
+    
+    def __init__(self):
+        self.db_commands = 0
+        self.db_seconds = 0.0
+
+request_timing: ContextVar[Optional[RequestTiming]] = ContextVar('request_timing', default=None)
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Record every Mongo command; Motor copies the caller's context into its executor threads"""
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        self._record(event)
+    
+    def failed(self, event):
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+        self._record(event)
+    
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(seconds)
+        timing = request_timing.get()
+        if timing is not None:
+            timing.db_commands += 1
+            timing.db_seconds += seconds
+
+# On-demand request profiling, off (and not even installed as middleware) unless a token is set
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', '/tmp/routebuddy-profiles'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))  # sampling interval, seconds
+
+# Rate limiting: "<burst>/<per minute>" token buckets per user and endpoint class ("off" disables)
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')  # shared buckets across workers when set
+RATE_LIMITS = {
+    "discovery": os.environ.get('RATE_LIMIT_DISCOVERY', '5/20'),
+    "messaging": os.environ.get('RATE_LIMIT_MESSAGING', '20/60'),
+}
+
+# Admission control: shed load with 429 before the event loop drowns (0 disables a check)
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '256'))
+ADMISSION_MAX_LOOP_LAG = float(os.environ.get('ADMISSION_MAX_LOOP_LAG', '0.2'))  # seconds
+LOOP_LAG_PROBE_INTERVAL = float(os.environ.get('LOOP_LAG_PROBE_INTERVAL', '0.5'))  # seconds
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '10'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '20000'))
+MONGO_WARM_CONNECTIONS = int(os.environ.get('MONGO_WARM_CONNECTIONS', str(MONGO_MIN_POOL_SIZE)))
+# Read-only endpoints (profile views, discovery) may be served by secondaries
+MONGO_SECONDARY_READS = os.environ.get('MONGO_SECONDARY_READS', 'true').lower() == 'true'
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))
+# Write concern for user, session, route and connection writes
+MONGO_WRITE_CONCERN = os.environ.get('MONGO_WRITE_CONCERN', 'majority')
+
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    retryWrites=True,
+    event_listeners=[MongoCommandTimer()],
+)
+
+# Durable writes (users, sessions, routes, connections) go through db
+db = client.get_database(
+    os.environ['DB_NAME'],
+    write_concern=WriteConcern(w=int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN)
+)
+# High-volume, loss-tolerant writes (chat messages, read receipts, version counters)
+fast_db = client.get_database(os.environ['DB_NAME'], write_concern=WriteConcern(w=1))
+# Read-only endpoints that tolerate a little replication lag
+read_db = client.get_database(
+    os.environ['DB_NAME'],
+    read_preference=SecondaryPreferred(max_staleness=MONGO_MAX_STALENESS_SECONDS) if MONGO_SECONDARY_READS else ReadPreference.PRIMARY
+)
+
+async def warm_db_pool():
+    """Fail fast if Mongo is unreachable and open pooled connections before traffic arrives"""
+    await client.admin.command("ping")
+    await asyncio.gather(*[client.admin.command("ping") for _ in range(MONGO_WARM_CONNECTIONS)])
+    logger.info(
+        f"MongoDB pool ready (min={MONGO_MIN_POOL_SIZE}, max={MONGO_MAX_POOL_SIZE}, "
+        f"warmed={MONGO_WARM_CONNECTIONS}, secondary_reads={MONGO_SECONDARY_READS})"
+    )
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+
+# External auth provider
+AUTH_API_URL = os.environ.get('AUTH_API_URL', 'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data')
+AUTH_TIMEOUT = float(os.environ.get('AUTH_TIMEOUT', '5'))  # seconds per attempt
+AUTH_CONNECT_TIMEOUT = float(os.environ.get('AUTH_CONNECT_TIMEOUT', '2'))
+AUTH_MAX_CONNECTIONS = int(os.environ.get('AUTH_MAX_CONNECTIONS', '100'))
+AUTH_MAX_KEEPALIVE = int(os.environ.get('AUTH_MAX_KEEPALIVE', '20'))
+AUTH_RETRIES = int(os.environ.get('AUTH_RETRIES', '2'))
+AUTH_RETRY_BASE_DELAY = float(os.environ.get('AUTH_RETRY_BASE_DELAY', '0.1'))  # seconds
+AUTH_BREAKER_THRESHOLD = int(os.environ.get('AUTH_BREAKER_THRESHOLD', '5'))  # consecutive failures
+AUTH_BREAKER_RESET = float(os.environ.get('AUTH_BREAKER_RESET', '30'))  # seconds
+
+# Message retention: messages older than MESSAGE_HOT_DAYS move to compressed per-conversation
+# chunks in message_archive (0 disables archiving)
+MESSAGE_HOT_DAYS = int(os.environ.get('MESSAGE_HOT_DAYS', '90'))
+MESSAGE_ARCHIVE_INTERVAL = float(os.environ.get('MESSAGE_ARCHIVE_INTERVAL', '3600'))  # seconds between runs
+MESSAGE_ARCHIVE_BATCH = int(os.environ.get('MESSAGE_ARCHIVE_BATCH', '1000'))  # messages per archive pass
+# Message storage: "documents" (one document per message) or "buckets" (per-conversation documents
+# of up to MESSAGE_BUCKET_SIZE messages; migrate existing messages with migrate_message_buckets.py)
+MESSAGE_STORAGE = os.environ.get('MESSAGE_STORAGE', 'documents')
+MESSAGE_BUCKETS = MESSAGE_STORAGE == 'buckets'
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '150'))
+
+# Places: route endpoints are snapped to geohash tiles of PLACE_TILE_PRECISION characters
+# (7 = ~150 m, set in geo.py) and their addresses interned in db.places
+PLACE_CACHE_SIZE = int(os.environ.get('PLACE_CACHE_SIZE', '10000'))
+# Optional "module:attribute" of a geocoder object/factory to use instead of LocalGeocoder
+GEOCODER = os.environ.get('GEOCODER')
+
+# Discovery hubs: routes whose endpoints fall in the same MATCH_HUB_PRECISION-character geohash
+# cells (7 = ~150 m) with the same schedule share one scored candidate list
+MATCH_HUB_PRECISION = int(os.environ.get('MATCH_HUB_PRECISION', '7'))
+MATCH_HUB_CACHE_SIZE = int(os.environ.get('MATCH_HUB_CACHE_SIZE', '2000'))
+# Candidate search: "adaptive" reads routes starting near the hub through the tile index, widening
+# through MATCH_RADIUS_RINGS (km) until MATCH_TARGET_COUNT users match or MATCH_MAX_CANDIDATES
+# routes have been examined; "scan" scores the first 1000 active routes
+MATCH_SEARCH = os.environ.get('MATCH_SEARCH', 'adaptive')
+MATCH_RADIUS_RINGS = [float(r) for r in os.environ.get('MATCH_RADIUS_RINGS', '1,2.5,5,10,25').split(',')]
+MATCH_TARGET_COUNT = int(os.environ.get('MATCH_TARGET_COUNT', '50'))
+MATCH_MAX_CANDIDATES = int(os.environ.get('MATCH_MAX_CANDIDATES', '1000'))
+# Compatibility limits; rings wider than MATCH_MAX_DISTANCE stretch the distance limits to the ring
+MATCH_MAX_DISTANCE = float(os.environ.get('MATCH_MAX_DISTANCE', '5'))  # km
+MATCH_MAX_TIME_DIFF = float(os.environ.get('MATCH_MAX_TIME_DIFF', '30'))  # minutes
+# Pickups along the way: a route whose straight line passes within MATCH_PICKUP_DISTANCE km of both
+# ends of a trip can carry it part way. Routes are indexed by the MATCH_VIA_PRECISION cells
+# (6 = ~1 km) their line crosses (both set in geo.py), and drivers are taken to cover it at
+# MATCH_TRAVEL_SPEED_KMH, so they may leave up to MATCH_PICKUP_MAX_LEAD minutes before the trip
+MATCH_TRAVEL_SPEED_KMH = float(os.environ.get('MATCH_TRAVEL_SPEED_KMH', '30'))
+MATCH_PICKUP_MAX_LEAD = float(os.environ.get('MATCH_PICKUP_MAX_LEAD', '60'))  # minutes
+# The task queue's precomputed first Discover page is served while the versions it was computed from
+# are unchanged; after a route or profile change in the cells its hubs read it is still served, while
+# a recomputation is queued, up to MATCH_SNAPSHOT_MAX_AGE seconds after it was computed. The user's
+# own route and block changes always skip it. A stale page is the first read after a change in its
+# cells (the read queues the recomputation, so the next one is fresh); it can list a commuter whose
+# route has since moved, so the window is short enough for that to be a single visit's worth.
+MATCH_SNAPSHOT_MAX_AGE = float(os.environ.get('MATCH_SNAPSHOT_MAX_AGE', '60'))  # seconds
+
+# Push notifications: queued per (recipient, conversation) in db.notification_queue and delivered
+# in batches by a background worker; a burst within NOTIFICATION_COLLAPSE_SECONDS becomes one push
+NOTIFICATION_WORKER = os.environ.get('NOTIFICATION_WORKER', 'true').lower() == 'true'
+NOTIFICATION_COLLAPSE_SECONDS = float(os.environ.get('NOTIFICATION_COLLAPSE_SECONDS', '3'))
+NOTIFICATION_POLL_INTERVAL = float(os.environ.get('NOTIFICATION_POLL_INTERVAL', '1'))  # seconds when idle
+NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', '500'))  # queue entries per claim
+NOTIFICATION_LEASE_SECONDS = float(os.environ.get('NOTIFICATION_LEASE_SECONDS', '60'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', '5'))
+NOTIFICATION_RETRY_BASE_DELAY = float(os.environ.get('NOTIFICATION_RETRY_BASE_DELAY', '5'))  # seconds
+EXPO_PUSH_URL = os.environ.get('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+PUSH_STUB_FAIL_RATE = float(os.environ.get('PUSH_STUB_FAIL_RATE', '0'))  # simulated outages for the stub provider
+
+# Background tasks (db.tasks): each API process runs TASK_WORKERS of them in-process; set it to 0
+# when worker.py runs them instead
+TASK_WORKERS = int(os.environ.get('TASK_WORKERS', '2'))
+TASK_VISIBILITY_TIMEOUT = float(os.environ.get('TASK_VISIBILITY_TIMEOUT', '60'))  # seconds, renewed while running
+TASK_MAX_ATTEMPTS = int(os.environ.get('TASK_MAX_ATTEMPTS', '5'))
+TASK_RETRY_BASE_DELAY = float(os.environ.get('TASK_RETRY_BASE_DELAY', '10'))  # seconds
+TASK_POLL_INTERVAL = float(os.environ.get('TASK_POLL_INTERVAL', '1'))  # seconds when idle
+TASK_FAILED_RETENTION_DAYS = int(os.environ.get('TASK_FAILED_RETENTION_DAYS', '7'))
+# Uploaded images are re-encoded as JPEG within these sizes (needs Pillow)
+ID_IMAGE_MAX_SIDE = int(os.environ.get('ID_IMAGE_MAX_SIDE', '2000'))
+PROFILE_IMAGE_MAX_SIDE = int(os.environ.get('PROFILE_IMAGE_MAX_SIDE', '1080'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '80'))
+
+# Identifies this process when taking job leases
+WORKER_ID = f"{platform.node()}:{os.getpid()}"
+
+# Shared outbound HTTP client, opened and closed by the app lifespan
+http_client: Optional[httpx.AsyncClient] = None
+
+def create_http_client() -> httpx.AsyncClient:
+    """Pooled client so logins reuse warm TCP/TLS connections to the auth provider"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(AUTH_TIMEOUT, connect=AUTH_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=AUTH_MAX_CONNECTIONS, max_keepalive_connections=AUTH_MAX_KEEPALIVE),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared clients on startup and close them on shutdown"""
+    global http_client
+    await warm_db_pool()
+    await ensure_block_indexes()
+    await backfill_block_edges()
+    await ensure_message_indexes()
+    await ensure_place_indexes()
+    await ensure_notification_indexes()
+    await ensure_task_indexes()
+    http_client = create_http_client()
+    queue_monitor = asyncio.create_task(monitor_socket_queues())
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    archiver = asyncio.create_task(run_message_archiver()) if MESSAGE_HOT_DAYS > 0 else None
+    notifier = asyncio.create_task(run_notification_worker()) if NOTIFICATION_WORKER else None
+    task_workers = asyncio.create_task(run_task_workers(TASK_WORKERS)) if TASK_WORKERS > 0 else None
+    try:
+        yield
+    finally:
+        queue_monitor.cancel()
+        lag_monitor.cancel()
+        if archiver:
+            archiver.cancel()
+        if notifier:
+            notifier.cancel()
+        if task_workers:
+            task_workers.cancel()
+        await http_client.aclose()
+        http_client = None
+        client.close()
 
 # Socket.IO setup
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+SOCKET_MAX_QUEUE = int(os.environ.get('SOCKET_MAX_QUEUE', '500'))  # queued packets before a client is dropped
+SOCKET_QUEUE_CHECK_INTERVAL = float(os.environ.get('SOCKET_QUEUE_CHECK_INTERVAL', '5'))  # seconds
+# With several workers, emits must fan out through a shared queue (e.g. redis://redis:6379/0)
+# and long-polling has to be disabled because its requests can land on another worker.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+SOCKETIO_TRANSPORTS = os.environ.get('SOCKETIO_TRANSPORTS', 'polling,websocket').split(',')
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins='*',
+    client_manager=socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None,
+    transports=SOCKETIO_TRANSPORTS
+)
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Socket.IO ASGI app
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
@@ -66,22 +396,36 @@ class SessionDataResponse(BaseModel):
     picture: Optional[str] = None
     session_token: str
 
+def clock_time(value: str) -> str:
+    """A time of day as zero-padded "HH:MM" (the candidate search compares them as strings)"""
+    try:
+        return datetime.strptime(value.strip(), "%H:%M").strftime("%H:%M")
+    except ValueError:
+        raise ValueError(f"time must be HH:MM, got {value!r}") from None
+
 class RouteCreate(BaseModel):
     start_coords: Coordinates
     end_coords: Coordinates
-    start_address: str
-    end_address: str
+    start_address: str = ""  # blank = ask the geocoder
+    end_address: str = ""
     departure_time: str  # Format: "HH:MM"
+    return_time: Optional[str] = None  # "HH:MM" of the trip back, end to start
     days_of_week: List[str]  # ["monday", "tuesday", etc.]
 
+    @field_validator("departure_time", "return_time")
+    @classmethod
+    def normalize_time(cls, value: Optional[str]) -> Optional[str]:
+        return None if value is None else clock_time(value)
+
 class Route(BaseModel):
     route_id: str
     user_id: str
     start_coords: Coordinates
     end_coords: Coordinates
-    start_address: str
-    end_address: str
+    start_address: Optional[str] = None  # filled in from the place when read back
+    end_address: Optional[str] = None
     departure_time: str
+    return_time: Optional[str] = None
     days_of_week: List[str]
     active: bool = True
     created_at: datetime
@@ -125,6 +469,10 @@ class ReportCreate(BaseModel):
 class IDVerificationUpload(BaseModel):
     id_image: str  # base64
 
+class DeviceRegistration(BaseModel):
+    token: str
+    provider: str = "expo"
+
 class MatchedUser(BaseModel):
     user_id: str
     name: str
@@ -134,6 +482,7 @@ class MatchedUser(BaseModel):
     route_match_score: float
     distance_to_start: float  # km
     distance_to_end: float  # km
+    match_type: str = "direct"  # "direct", "return" (a return leg is shared) or "pickup"
 
 # ==================== UTILITY FUNCTIONS ====================
 
@@ -162,13 +511,16 @@ def time_difference_minutes(time1: str, time2: str) -> int:
     
     return abs(total1 - total2)
 
-def calculate_match_score(user_route: Route, other_route: Route) -> Dict[str, float]:
+class MatchLimits(NamedTuple):
+    """Farthest start and end distance (km) and departure gap (minutes) that still match"""
+    start_km: float
+    end_km: float
+    time_minutes: float
+
+DEFAULT_MATCH_LIMITS = MatchLimits(MATCH_MAX_DISTANCE, MATCH_MAX_DISTANCE, MATCH_MAX_TIME_DIFF)
+
+def calculate_match_score(user_route: Route, other_route: Route, limits: MatchLimits = DEFAULT_MATCH_LIMITS) -> Dict[str, float]:
     """Calculate compatibility score between two routes"""
-    # Distance thresholds
-    MAX_START_DISTANCE = 5  # km
-    MAX_END_DISTANCE = 5  # km
-    MAX_TIME_DIFF = 30  # minutes
-    
     # Calculate distances
     start_distance = haversine_distance(user_route.start_coords, other_route.start_coords)
     end_distance = haversine_distance(user_route.end_coords, other_route.end_coords)
@@ -176,20 +528,33 @@ def calculate_match_score(user_route: Route, other_route: Route) -> Dict[str, fl
     # Calculate time difference
     time_diff = time_difference_minutes(user_route.departure_time, other_route.departure_time)
     
+    return combine_match_score(
+        start_distance, end_distance, time_diff, user_route.days_of_week, other_route.days_of_week, limits
+    )
+
+def combine_match_score(start_distance: float, end_distance: float, time_diff: int,
+                        user_days: List[str], other_days: List[str],
+                        limits: MatchLimits = DEFAULT_MATCH_LIMITS) -> Optional[Dict[str, float]]:
+    """Score (0-100) from the distance, time and day components, or None if the routes are incompatible
+
+    `limits` only decides compatibility; components are always scaled by the default limits so
+    scores from a widened search compare with the rest.
+    """
     # Check if routes are compatible
-    if start_distance > MAX_START_DISTANCE or end_distance > MAX_END_DISTANCE or time_diff > MAX_TIME_DIFF:
+    if start_distance > limits.start_km or end_distance > limits.end_km or time_diff > limits.time_minutes:
         return None
     
     # Check if they share any common days
-    common_days = set(user_route.days_of_week) & set(other_route.days_of_week)
+    common_days = set(user_days) & set(other_days)
     if not common_days:
         return None
     
     # Calculate score (0-100)
-    start_score = max(0, 100 - (start_distance / MAX_START_DISTANCE * 100))
-    end_score = max(0, 100 - (end_distance / MAX_END_DISTANCE * 100))
-    time_score = max(0, 100 - (time_diff / MAX_TIME_DIFF * 100))
-    day_score = (len(common_days) / len(user_route.days_of_week)) * 100
+    scale = DEFAULT_MATCH_LIMITS
+    start_score = max(0, 100 - (start_distance / scale.start_km * 100))
+    end_score = max(0, 100 - (end_distance / scale.end_km * 100))
+    time_score = max(0, 100 - (time_diff / scale.time_minutes * 100))
+    day_score = (len(common_days) / len(user_days)) * 100
     
     total_score = (start_score * 0.3 + end_score * 0.3 + time_score * 0.25 + day_score * 0.15)
     
@@ -200,22 +565,380 @@ def calculate_match_score(user_route: Route, other_route: Route) -> Dict[str, fl
         "time_diff": time_diff
     }
 
-# ==================== AUTH HELPERS ====================
-
-async def get_current_user(request: Request) -> Optional[User]:
-    """Get current authenticated user from session token"""
-    # Check cookie first
-    session_token = request.cookies.get("session_token")
-    
-    # Fallback to Authorization header
-    if not session_token:
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            session_token = auth_header.replace("Bearer ", "")
-    
-    if not session_token:
+class RouteLeg(NamedTuple):
+    """One direction of a route: the trip out, or the trip back at return_time"""
+    origin: Coordinates
+    destination: Coordinates
+    time: str
+    days: List[str]
+    returning: bool = False
+
+def route_legs(route: Route) -> List[RouteLeg]:
+    """The route's outbound leg, plus its return leg when it has a return time"""
+    legs = [RouteLeg(route.start_coords, route.end_coords, route.departure_time, route.days_of_week)]
+    if route.return_time:
+        legs.append(RouteLeg(route.end_coords, route.start_coords, route.return_time, route.days_of_week, True))
+    return legs
+
+def position_on_segment(point: Coordinates, start: Coordinates, end: Coordinates) -> Tuple[float, float]:
+    """(distance in km from point to the segment start-end, fraction of the way along it), on a local flat projection"""
+    kx, ky = 111.320 * cos(radians(start.lat)), 110.574
+    vx, vy = (end.lng - start.lng) * kx, (end.lat - start.lat) * ky
+    px, py = (point.lng - start.lng) * kx, (point.lat - start.lat) * ky
+    length_sq = vx * vx + vy * vy
+    fraction = min(1.0, max(0.0, (px * vx + py * vy) / length_sq)) if length_sq else 0.0
+    return hypot(px - fraction * vx, py - fraction * vy), fraction
+
+def pickup_match_score(trip: RouteLeg, leg: RouteLeg, limits: MatchLimits = DEFAULT_MATCH_LIMITS) -> Optional[Dict[str, Any]]:
+    """Score for `trip` riding part of `leg`, or None unless the leg passes near both its ends in order
+
+    The distances are the detours to the leg's line, and the time is compared with when the leg
+    passes the pickup point.
+    """
+    pickup_km, pickup_at = position_on_segment(trip.origin, leg.origin, leg.destination)
+    dropoff_km, dropoff_at = position_on_segment(trip.destination, leg.origin, leg.destination)
+    if max(pickup_km, dropoff_km) > MATCH_PICKUP_DISTANCE or pickup_at >= dropoff_at:
         return None
+
+    lead = pickup_at * haversine_distance(leg.origin, leg.destination) / MATCH_TRAVEL_SPEED_KMH * 60
+    leg_hours, leg_minutes = map(int, leg.time.split(':'))
+    trip_hours, trip_minutes = map(int, trip.time.split(':'))
+    time_diff = round(abs(trip_hours * 60 + trip_minutes - (leg_hours * 60 + leg_minutes + lead)))
+
+    result = combine_match_score(pickup_km, dropoff_km, time_diff, trip.days, leg.days, limits)
+    if result:
+        result["match_type"] = "pickup"
+    return result
+
+def trip_match_score(trip: RouteLeg, other_route: Route, limits: MatchLimits = DEFAULT_MATCH_LIMITS) -> Optional[Dict[str, Any]]:
+    """Best way for `trip` to share either leg of other_route, or None
+
+    Riding along end to end ("direct", or "return" when either side is on its way back), or, when
+    an endpoint is farther than MATCH_PICKUP_DISTANCE, being picked up and dropped off on the way.
+    """
+    best = None
+    for leg in route_legs(other_route):
+        result = combine_match_score(
+            haversine_distance(trip.origin, leg.origin),
+            haversine_distance(trip.destination, leg.destination),
+            time_difference_minutes(trip.time, leg.time),
+            trip.days, leg.days, limits
+        )
+        if result:
+            result["match_type"] = "return" if trip.returning or leg.returning else "direct"
+        if result is None or max(result["start_distance"], result["end_distance"]) > MATCH_PICKUP_DISTANCE:
+            pickup = pickup_match_score(trip, leg, limits)
+            if pickup and (result is None or pickup["score"] > result["score"]):
+                result = pickup
+        if result and (best is None or result["score"] > best["score"]):
+            best = result
+    return best
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 50  # Rows enriched per user lookup when streaming
+
+def wants_ndjson(request: Request) -> bool:
+    """Check whether the client asked for a streamed NDJSON response"""
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+async def ndjson_stream(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Encode each row as one JSON line as soon as it is produced"""
+    async for row in rows:
+        yield orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+
+def fast_json(content: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    """Encode plain dicts/lists straight to bytes, skipping FastAPI's jsonable_encoder pass"""
+    return ORJSONResponse(content, status_code=status_code, headers=headers)
+
+def public_fields(model: type, doc: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored document as the response model returns it: the model's fields only, defaults filled in"""
+    return {
+        name: doc[name] if name in doc else field.get_default(call_default_factory=True)
+        for name, field in model.model_fields.items()
+    }
+
+def ndjson_response(rows: AsyncIterator[Dict[str, Any]], headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """Wrap an async row generator in a streaming NDJSON response"""
+    return StreamingResponse(ndjson_stream(rows), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+class SingleFlight:
+    """Coalesce identical concurrent reads: callers with the same key share one in-flight computation.
+
+    The work runs in its own task, so a caller that disconnects does not cancel it for the others.
+    Results are shared objects and must be treated as read-only. A caller passing `not_before`
+    (a time.monotonic() value) only joins a computation that started at or after it.
+    """
+    
+    def __init__(self):
+        self.calls: Dict[Hashable, Tuple[asyncio.Task, float]] = {}
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], not_before: Optional[float] = None) -> Any:
+        task, started = self.calls.get(key, (None, 0.0))
+        if task is None or (not_before is not None and started < not_before):
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = (task, time.monotonic())
+            task.add_done_callback(lambda done: self.forget(key, done))
+        return await asyncio.shield(task)
+    
+    def forget(self, key: Hashable, task: asyncio.Task):
+        # A newer computation may have taken over the key; leave that one in place
+        if self.calls.get(key, (None,))[0] is task:
+            del self.calls[key]
+
+single_flight = SingleFlight()
+
+# ==================== DATA VERSIONS & ETAGS ====================
+
+# Version keys: "profile:<user_id>", "routes:<user_id>", "connections:<user_id>",
+# "matches:<user_id>" (blocks in either direction), "discovery:<cell>" keys for the tiles a route,
+# or its owner's profile, changes in and every coarser cell around them (see route_region_keys),
+# "discovery:*", which bulk loads move to invalidate every cell at once, and the global "discovery"
+# key, which moves on every route or profile change that the scan search (MATCH_SEARCH=scan) or
+# the scan for untiled routes could see.
+DISCOVERY_VERSION_KEY = "discovery"
+ALL_REGIONS_VERSION_KEY = "discovery:*"
+
+async def bump_versions(*keys: str):
+    """Increment data version counters so cached ETags for them stop matching"""
+    if not keys:
+        return
+    await fast_db.data_versions.bulk_write(
+        [UpdateOne({"_id": key}, {"$inc": {"v": 1}}, upsert=True) for key in set(keys)],
+        ordered=False
+    )
+
+async def bump_profile_versions(user_id: str):
+    """A profile change shows up in the profile, every connected user's list and the matches of
+    whoever searches the regions the user's routes are in"""
+    connections = await db.connections.find(
+        {"$or": [{"user1_id": user_id}, {"user2_id": user_id}]},
+        {"_id": 0, "user1_id": 1, "user2_id": 1}
+    ).to_list(None)
+    routes = await load_active_routes(user_id)
     
+    keys = [f"profile:{user_id}", *(key for route in routes for key in route_region_keys(route))]
+    for conn in connections:
+        other_user_id = conn["user2_id"] if conn["user1_id"] == user_id else conn["user1_id"]
+        keys.append(f"connections:{other_user_id}")
+    
+    await bump_versions(*keys)
+
+async def load_versions(keys: List[str], source=None) -> Dict[str, int]:
+    """Current versions of these keys (absent ones are 0)"""
+    source = db if source is None else source
+    docs = await source.data_versions.find({"_id": {"$in": list(keys)}}).to_list(None)
+    return {doc["_id"]: doc["v"] for doc in docs}
+
+def versions_digest(keys: List[str], versions: Dict[str, int]) -> str:
+    """Short fingerprint of these keys' versions, to tag data computed from them"""
+    parts = [f"{key}={versions.get(key, 0)}" for key in keys]
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=12).hexdigest()
+
+async def request_versions(request: Request, keys: Tuple[str, ...], source=None) -> Dict[str, int]:
+    """Current versions of these keys for this request, also kept as request.state.data_versions"""
+    # Read versions with the same read preference as the data they describe
+    source = db if source is None else source
+    # Only share a read that started after this request arrived, so it sees the caller's own last write
+    versions = await single_flight.do(
+        ("data_versions", source is read_db, keys),
+        lambda: load_versions(keys, source),
+        not_before=getattr(request.state, "received_at", None)
+    )
+    request.state.data_versions = versions
+    return versions
+
+def versions_etag(request: Request, viewer_id: str, keys: Tuple[str, ...], versions: Dict[str, int]) -> str:
+    """Weak ETag from the viewer, the query string and these versions of the keys"""
+    parts = [request.url.path, str(request.url.query), viewer_id, request.headers.get("accept", "")]
+    parts += [f"{key}={versions.get(key, 0)}" for key in keys]
+    digest = hashlib.blake2b("|".join(parts).encode(), digest_size=12).hexdigest()
+    
+    return f'W/"{digest}"'
+
+async def data_etag(request: Request, viewer_id: str, *keys: str, source=None) -> str:
+    """Build a weak ETag from the viewer, the query string and the current data versions"""
+    return versions_etag(request, viewer_id, keys, await request_versions(request, keys, source))
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of the request's If-None-Match against the current ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def etag_headers(etag: str) -> Dict[str, str]:
+    """Clients may cache but must revalidate every time"""
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def not_modified(etag: str) -> Response:
+    """Empty 304 carrying the unchanged ETag"""
+    return Response(status_code=304, headers=etag_headers(etag))
+
+# ==================== BLOCK GRAPH ====================
+
+# One document per (blocker_id, blocked_id) edge, indexed from both ends so a user's
+# blocks and blockers come back in a single query. users.blocked_users is kept in sync
+# for clients that read it, but filtering goes through this collection. Blocks made before
+# it only exist in users.blocked_users; startup backfills their edges until that has
+# completed once (migrate_blocks.py runs the same backfill by hand).
+
+async def ensure_block_indexes():
+    """Create the block edge indexes (no-op when they already exist)"""
+    await db.blocks.create_index([("blocker_id", ASCENDING), ("blocked_id", ASCENDING)], unique=True)
+    await db.blocks.create_index([("blocked_id", ASCENDING)])
+
+async def backfill_block_edges(batch_size: int = 1000) -> Tuple[int, int]:
+    """Upsert an edge for every users.blocked_users entry, unless a backfill has completed before;
+    returns (users, edges) written. Safe to run from several workers at once."""
+    if await db.migrations.find_one({"_id": "block_edges"}):
+        return 0, 0
+    now = datetime.now(timezone.utc)
+    users = edges = 0
+    ops = []
+    
+    async def flush():
+        try:
+            await db.blocks.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Another worker inserted the same edge between our upsert's match and insert
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+    
+    async for user in db.users.find({"blocked_users.0": {"$exists": True}}, {"_id": 0, "user_id": 1, "blocked_users": 1}):
+        users += 1
+        for blocked_id in set(user["blocked_users"]):
+            ops.append(UpdateOne(
+                {"blocker_id": user["user_id"], "blocked_id": blocked_id},
+                {"$setOnInsert": {"created_at": now}},
+                upsert=True
+            ))
+        if len(ops) >= batch_size:
+            await flush()
+            edges += len(ops)
+            ops = []
+    if ops:
+        await flush()
+        edges += len(ops)
+    await db.migrations.update_one({"_id": "block_edges"}, {"$set": {"completed_at": now}}, upsert=True)
+    return users, edges
+
+async def load_block_set(user_id: str) -> Set[str]:
+    """Users hidden from each other with `user_id`: everyone they blocked and everyone who blocked them"""
+    edges = await db.blocks.find(
+        {"$or": [{"blocker_id": user_id}, {"blocked_id": user_id}]},
+        {"_id": 0, "blocker_id": 1, "blocked_id": 1}
+    ).to_list(None)
+    return {e["blocked_id"] if e["blocker_id"] == user_id else e["blocker_id"] for e in edges}
+
+async def add_block(blocker_id: str, blocked_id: str):
+    """Record a block edge"""
+    await db.blocks.update_one(
+        {"blocker_id": blocker_id, "blocked_id": blocked_id},
+        {"$setOnInsert": {"created_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def remove_block(blocker_id: str, blocked_id: str):
+    """Delete a block edge"""
+    await db.blocks.delete_one({"blocker_id": blocker_id, "blocked_id": blocked_id})
+
+# ==================== AUTH HELPERS ====================
+
+class CircuitBreaker:
+    """Fail fast while a dependency keeps failing, then let one probe through after a cool-down"""
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+    
+    def allow(self) -> bool:
+        """Whether a call may go out right now"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+    
+    def release_probe(self):
+        """End a probe that neither succeeded nor failed (e.g. it was cancelled), so another can go out"""
+        self.probing = False
+
+auth_breaker = CircuitBreaker(AUTH_BREAKER_THRESHOLD, AUTH_BREAKER_RESET)
+
+class AuthProviderError(Exception):
+    """Auth provider unreachable or erroring (as opposed to rejecting the session)"""
+
+async def fetch_session_data(session_id: str) -> Dict[str, Any]:
+    """Look up session data with the auth provider, retrying transient failures with jitter"""
+    global http_client
+    if http_client is None:
+        http_client = create_http_client()
+    
+    if not auth_breaker.allow():
+        raise AuthProviderError("circuit open")
+    is_probe = auth_breaker.probing
+    
+    try:
+        for attempt in range(AUTH_RETRIES + 1):
+            try:
+                auth_response = await http_client.get(AUTH_API_URL, headers={"X-Session-ID": session_id})
+                if auth_response.status_code < 500:
+                    # Provider answered; a 4xx means the session itself is bad
+                    auth_breaker.record_success()
+                    auth_response.raise_for_status()
+                    return auth_response.json()
+                error = f"status {auth_response.status_code}"
+            except httpx.TransportError as e:
+                error = repr(e)
+            
+            logger.warning(f"Auth API attempt {attempt + 1} failed: {error}")
+            if attempt < AUTH_RETRIES:
+                # Full jitter so a login storm does not retry in lockstep
+                await asyncio.sleep(random.uniform(0, AUTH_RETRY_BASE_DELAY * 2 ** attempt))
+    except httpx.HTTPStatusError:
+        raise
+    except Exception as e:
+        # Anything else going wrong with the call (e.g. an undecodable response) counts against the provider
+        auth_breaker.record_failure()
+        raise AuthProviderError(repr(e)) from e
+    finally:
+        # A half-open probe that ends any other way (cancelled) must not keep blocking every later call
+        if is_probe:
+            auth_breaker.release_probe()
+    
+    auth_breaker.record_failure()
+    raise AuthProviderError(error)
+
+async def load_session_user(session_token: str) -> Optional[User]:
+    """Resolve a session token to its user (expired sessions are removed)"""
     # Check session in database
     session = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
     if not session:
@@ -237,12 +960,139 @@ async def get_current_user(request: Request) -> Optional[User]:
     
     return User(**user_doc)
 
+async def get_current_user(request: Request) -> Optional[User]:
+    """Get current authenticated user from session token"""
+    # Check cookie first
+    session_token = request.cookies.get("session_token")
+    
+    # Fallback to Authorization header
+    if not session_token:
+        auth_header = request.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            session_token = auth_header.replace("Bearer ", "")
+    
+    if not session_token:
+        return None
+    
+    # A request that arrives after a logout or profile update must not get a lookup started before it
+    return await single_flight.do(
+        ("session", session_token),
+        lambda: load_session_user(session_token),
+        not_before=getattr(request.state, "received_at", None)
+    )
+
 def require_auth(user: Optional[User] = Depends(get_current_user)) -> User:
     """Dependency to require authentication"""
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
+# ==================== RATE LIMITING ====================
+
+def parse_rate_limit(spec: str):
+    """'<burst>/<per minute>' -> (capacity, tokens per second)"""
+    burst, per_minute = spec.split('/')
+    return float(burst), float(per_minute) / 60
+
+class InMemoryRateLimiter:
+    """Token buckets in this worker's memory"""
+    
+    MAX_BUCKETS = 100_000
+    
+    def __init__(self):
+        # key -> (tokens, updated, capacity, rate); each bucket keeps its own class's limits
+        self.buckets: Dict[str, tuple] = {}
+    
+    async def acquire(self, key: str, capacity: float, rate: float) -> float:
+        """Take one token; return 0 if allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        tokens, updated, _, _ = self.buckets.get(key, (capacity, now, capacity, rate))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        
+        if len(self.buckets) >= self.MAX_BUCKETS and key not in self.buckets:
+            self.prune(now)
+        self.buckets[key] = (tokens, now, capacity, rate)
+        return wait
+    
+    def prune(self, now: float):
+        """Forget buckets that have refilled completely; they behave like new ones"""
+        self.buckets = {
+            k: bucket for k, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]
+        }
+
+class RedisRateLimiter:
+    """Token buckets in Redis, shared by every worker; fails open if Redis is unavailable"""
+    
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+    
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+        self.redis = aioredis.from_url(url)
+        self.script = self.redis.register_script(self.SCRIPT)
+    
+    async def acquire(self, key: str, capacity: float, rate: float) -> float:
+        try:
+            return float(await self.script(keys=[f"ratelimit:{key}"], args=[capacity, rate]))
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable, allowing request: {e}")
+            return 0.0
+
+rate_limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else InMemoryRateLimiter()
+
+async def check_rate_limit(endpoint_class: str, user_id: str) -> float:
+    """Seconds the caller must wait before the next call of this class (0 = go ahead)"""
+    spec = RATE_LIMITS[endpoint_class]
+    if spec == "off":
+        return 0.0
+    
+    capacity, rate = parse_rate_limit(spec)
+    wait = await rate_limiter.acquire(f"{endpoint_class}:{user_id}", capacity, rate)
+    if wait > 0:
+        RATE_LIMITED.labels(endpoint_class).inc()
+    return wait
+
+async def enforce_rate_limit(endpoint_class: str, user_id: str):
+    """429 with Retry-After once the user's bucket for this class is empty"""
+    wait = await check_rate_limit(endpoint_class, user_id)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, round(wait)))}
+        )
+
+def rate_limited(endpoint_class: str):
+    """Dependency: authenticated user, throttled per endpoint class"""
+    async def dependency(current_user: User = Depends(require_auth)) -> User:
+        await enforce_rate_limit(endpoint_class, current_user.user_id)
+        return current_user
+    return dependency
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/auth/exchange-session")
@@ -255,17 +1105,14 @@ async def exchange_session(request: Request, response: Response):
         raise HTTPException(status_code=400, detail="session_id required")
     
     # Call Emergent Auth API
-    async with httpx.AsyncClient() as client:
-        try:
-            auth_response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
-            )
-            auth_response.raise_for_status()
-            user_data = auth_response.json()
-        except Exception as e:
-            logger.error(f"Auth API error: {e}")
-            raise HTTPException(status_code=400, detail="Invalid session_id")
+    try:
+        user_data = await fetch_session_data(session_id)
+    except AuthProviderError as e:
+        logger.error(f"Auth API unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Authentication service unavailable")
+    except Exception as e:
+        logger.error(f"Auth API error: {e}")
+        raise HTTPException(status_code=400, detail="Invalid session_id")
     
     # Generate user_id if new user
     existing_user = await db.users.find_one({"email": user_data["email"]}, {"_id": 0})
@@ -317,7 +1164,7 @@ async def exchange_session(request: Request, response: Response):
 @api_router.get("/auth/me")
 async def get_me(current_user: User = Depends(require_auth)):
     """Get current user info"""
-    return current_user
+    return fast_json(current_user.model_dump())
 
 @api_router.post("/auth/logout")
 async def logout(request: Request, response: Response, current_user: User = Depends(require_auth)):
@@ -334,7 +1181,7 @@ async def logout(request: Request, response: Response, current_user: User = Depe
 @api_router.get("/profile/me")
 async def get_my_profile(current_user: User = Depends(require_auth)):
     """Get my complete profile"""
-    return current_user
+    return fast_json(current_user.model_dump())
 
 @api_router.put("/profile/update")
 async def update_profile(profile_data: ProfileUpdate, current_user: User = Depends(require_auth)):
@@ -354,6 +1201,13 @@ async def update_profile(profile_data: ProfileUpdate, current_user: User = Depen
             {"user_id": current_user.user_id},
             {"$set": update_fields}
         )
+        await bump_profile_versions(current_user.user_id)
+    if profile_data.profile_images:
+        await enqueue_task(
+            "process_profile_images",
+            {"user_id": current_user.user_id, "images": update_fields["profile_images"]},
+            dedupe_key=f"profile_images:{current_user.user_id}"
+        )
     
     # Return updated user
     updated_user = await db.users.find_one({"user_id": current_user.user_id}, {"_id": 0})
@@ -361,22 +1215,174 @@ async def update_profile(profile_data: ProfileUpdate, current_user: User = Depen
 
 @api_router.post("/profile/verify-id")
 async def verify_id(verification_data: IDVerificationUpload, current_user: User = Depends(require_auth)):
-    """Upload ID verification image"""
-    await db.users.update_one(
-        {"user_id": current_user.user_id},
-        {"$set": {"id_verification_image": verification_data.id_image, "verified": True}}
+    """Upload ID verification image (checked by a background task, which then marks the user verified)"""
+    # The image waits on the user's verification document; the task only carries who to check
+    await db.id_verifications.update_one(
+        {"_id": current_user.user_id},
+        {"$set": {"image": verification_data.id_image, "status": "pending", "submitted_at": datetime.now(timezone.utc)}},
+        upsert=True
     )
+    await enqueue_task("verify_id", {"user_id": current_user.user_id}, dedupe_key=f"verify_id:{current_user.user_id}")
     
-    return {"message": "ID verification submitted successfully", "verified": True}
+    # `verified` stays as it was until the task has checked the image
+    return {"message": "ID verification submitted successfully", "status": "pending", "verified": current_user.verified}
 
 @api_router.get("/profile/{user_id}")
-async def get_user_profile(user_id: str, current_user: User = Depends(require_auth)):
+async def get_user_profile(user_id: str, request: Request, current_user: User = Depends(require_auth)):
     """Get another user's profile"""
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "id_verification_image": 0, "blocked_users": 0})
+    etag = await data_etag(request, current_user.user_id, f"profile:{user_id}", source=read_db)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    # The public profile is the same for every viewer, so concurrent viewers share one read
+    version = request.state.data_versions.get(f"profile:{user_id}", 0)
+    user = await single_flight.do(
+        ("profile", user_id, version),
+        lambda: read_db.users.find_one({"user_id": user_id}, {"_id": 0, "id_verification_image": 0, "blocked_users": 0})
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return user
+    return fast_json(user, headers=etag_headers(etag))
+
+# ==================== PLACES ====================
+
+# A place is a geohash tile (geo.geohash) plus a normalized address. Route documents keep only
+# place ids and tiles; addresses are stored once in db.places and filled back in when routes are read.
+
+def clean_address(address: str) -> str:
+    """Collapse whitespace and drop empty comma-separated parts (e.g. ", , NY" from reverse geocoding)"""
+    parts = (re.sub(r"\s+", " ", part).strip() for part in address.split(","))
+    return ", ".join(part for part in parts if part)
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+    
+    def get(self, key: Hashable) -> Any:
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+    
+    def put(self, key: Hashable, value: Any):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+class LocalGeocoder:
+    """Stand-in geocoder: names a point after a place already known in its tile"""
+    
+    async def reverse(self, lat: float, lng: float) -> Optional[str]:
+        place = await read_db.places.find_one({"tile": geohash(lat, lng)}, {"_id": 0, "address": 1})
+        return place["address"] if place else None
+
+def load_geocoder(spec: Optional[str]):
+    """GEOCODER="module:attribute" names an object with `async reverse(lat, lng)`, or a factory for one"""
+    if not spec:
+        return LocalGeocoder()
+    module_name, _, attribute = spec.partition(":")
+    geocoder = getattr(importlib.import_module(module_name), attribute)
+    return geocoder() if callable(geocoder) and not hasattr(geocoder, "reverse") else geocoder
+
+class PlaceService:
+    """Snap points to tiles, intern their addresses in db.places and cache both directions"""
+    
+    def __init__(self, geocoder, cache_size: int):
+        self.geocoder = geocoder
+        self.by_key = LRUCache(cache_size)  # (tile, folded address) -> place
+        self.by_id = LRUCache(cache_size)  # place_id -> place
+    
+    def remember(self, place: Dict[str, Any]) -> Dict[str, Any]:
+        self.by_key.put((place["tile"], place["address"].casefold()), place)
+        self.by_id.put(place["place_id"], place)
+        return place
+    
+    async def normalize(self, points: List[Tuple[Coordinates, str]]) -> List[Dict[str, Any]]:
+        """Resolve (Coordinates, address) pairs to places, writing only the ones not seen before"""
+        places, new_places = [], {}
+        for coords, address in points:
+            tile = geohash(coords.lat, coords.lng)
+            address = clean_address(address or "")
+            if not address:
+                address = await self.geocoder.reverse(coords.lat, coords.lng) or f"{coords.lat:.5f}, {coords.lng:.5f}"
+            place = self.by_key.get((tile, address.casefold()))
+            if place is None:
+                digest = hashlib.blake2b(f"{tile}|{address.casefold()}".encode(), digest_size=8).hexdigest()
+                place = {"place_id": f"place_{digest}", "tile": tile, "address": address,
+                         "lat": coords.lat, "lng": coords.lng}
+                new_places[place["place_id"]] = place
+            places.append(place)
+        
+        if new_places:
+            # Ids are derived from tile + address, so concurrent creators converge on one document;
+            # read it back so the first writer's spelling of the address wins everywhere
+            await db.places.bulk_write(
+                [UpdateOne({"place_id": pid}, {"$setOnInsert": place}, upsert=True) for pid, place in new_places.items()],
+                ordered=False
+            )
+            async for place in db.places.find({"place_id": {"$in": list(new_places)}}, {"_id": 0}):
+                self.remember(place)
+        return [self.by_id.get(place["place_id"]) or place for place in places]
+    
+    async def resolve(self, place_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Batch place lookup by id through the cache"""
+        found = {pid: place for pid in set(place_ids) if (place := self.by_id.get(pid)) is not None}
+        missing = [pid for pid in set(place_ids) if pid not in found]
+        if missing:
+            async for place in read_db.places.find({"place_id": {"$in": missing}}, {"_id": 0}):
+                found[place["place_id"]] = self.remember(place)
+        return found
+
+place_service = PlaceService(load_geocoder(GEOCODER), PLACE_CACHE_SIZE)
+
+async def ensure_place_indexes():
+    """Place lookups by id and tile, and routes by endpoint tiles (either way round) and the cells they pass"""
+    await db.places.create_index([("place_id", ASCENDING)], unique=True)
+    await db.places.create_index([("tile", ASCENDING)])
+    await db.routes.create_index([("start_tile", ASCENDING), ("end_tile", ASCENDING)])
+    await db.routes.create_index(
+        [("end_tile", ASCENDING), ("start_tile", ASCENDING)],
+        partialFilterExpression={"return_time": {"$type": "string"}}
+    )
+    await db.routes.create_index([("via_tiles", ASCENDING)])
+
+async def route_fields(route_data: RouteCreate) -> Dict[str, Any]:
+    """Stored route fields, with both endpoints snapped to shared places"""
+    start, end = await place_service.normalize([
+        (route_data.start_coords, route_data.start_address),
+        (route_data.end_coords, route_data.end_address),
+    ])
+    return {
+        "start_coords": route_data.start_coords.model_dump(),
+        "end_coords": route_data.end_coords.model_dump(),
+        "start_place_id": start["place_id"],
+        "end_place_id": end["place_id"],
+        "start_tile": start["tile"],
+        "end_tile": end["tile"],
+        "via_tiles": via_tiles(
+            (route_data.start_coords.lat, route_data.start_coords.lng),
+            (route_data.end_coords.lat, route_data.end_coords.lng)
+        ),
+        "departure_time": route_data.departure_time,
+        "return_time": route_data.return_time,
+        "days_of_week": route_data.days_of_week,
+    }
+
+async def hydrate_routes(routes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fill start_address/end_address in from places (routes saved before places keep their own)"""
+    place_ids = [r[f"{end}_place_id"] for r in routes for end in ("start", "end") if r.get(f"{end}_place_id")]
+    places = await place_service.resolve(place_ids) if place_ids else {}
+    for route in routes:
+        for end in ("start", "end"):
+            place = places.get(route.get(f"{end}_place_id"))
+            if place and not route.get(f"{end}_address"):
+                route[f"{end}_address"] = place["address"]
+    return routes
 
 # ==================== ROUTE ENDPOINTS ====================
 
@@ -388,25 +1394,27 @@ async def create_route(route_data: RouteCreate, current_user: User = Depends(req
     route = {
         "route_id": route_id,
         "user_id": current_user.user_id,
-        "start_coords": route_data.start_coords.dict(),
-        "end_coords": route_data.end_coords.dict(),
-        "start_address": route_data.start_address,
-        "end_address": route_data.end_address,
-        "departure_time": route_data.departure_time,
-        "days_of_week": route_data.days_of_week,
+        **await route_fields(route_data),
         "active": True,
         "created_at": datetime.now(timezone.utc)
     }
     
-    await db.routes.insert_one(route)
+    await db.routes.insert_one({**route})
+    await bump_versions(f"routes:{current_user.user_id}", *route_region_keys(route))
+    await schedule_match_warmup(current_user.user_id)
     
-    return Route(**route)
+    return Route(**(await hydrate_routes([route]))[0])
 
 @api_router.get("/routes/my-routes")
-async def get_my_routes(current_user: User = Depends(require_auth)):
+async def get_my_routes(request: Request, current_user: User = Depends(require_auth)):
     """Get all my routes"""
-    routes = await db.routes.find({"user_id": current_user.user_id}, {"_id": 0}).to_list(100)
-    return [Route(**route) for route in routes]
+    etag = await data_etag(request, current_user.user_id, f"routes:{current_user.user_id}")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    routes = await db.routes.find({"user_id": current_user.user_id}, {"_id": 0, "via_tiles": 0}).to_list(100)
+    routes = [public_fields(Route, route) for route in await hydrate_routes(routes)]
+    return fast_json(routes, headers=etag_headers(etag))
 
 @api_router.put("/routes/{route_id}")
 async def update_route(route_id: str, route_data: RouteCreate, current_user: User = Depends(require_auth)):
@@ -415,105 +1423,542 @@ async def update_route(route_id: str, route_data: RouteCreate, current_user: Use
     if not route:
         raise HTTPException(status_code=404, detail="Route not found")
     
-    update_data = route_data.dict()
-    update_data["start_coords"] = update_data["start_coords"]
-    update_data["end_coords"] = update_data["end_coords"]
-    
+    fields = await route_fields(route_data)
     await db.routes.update_one(
         {"route_id": route_id},
-        {"$set": update_data}
+        {"$set": fields, "$unset": {"start_address": "", "end_address": ""}}
+    )
+    # The route leaves the regions it was in and enters the new ones
+    await bump_versions(
+        f"routes:{current_user.user_id}", *route_region_keys(route), *route_region_keys(fields)
     )
+    await schedule_match_warmup(current_user.user_id)
     
     updated_route = await db.routes.find_one({"route_id": route_id}, {"_id": 0})
-    return Route(**updated_route)
+    return Route(**(await hydrate_routes([updated_route]))[0])
 
 @api_router.delete("/routes/{route_id}")
 async def delete_route(route_id: str, current_user: User = Depends(require_auth)):
     """Delete a route"""
-    result = await db.routes.delete_one({"route_id": route_id, "user_id": current_user.user_id})
-    if result.deleted_count == 0:
+    route = await db.routes.find_one_and_delete({"route_id": route_id, "user_id": current_user.user_id}, {"_id": 0})
+    if route is None:
         raise HTTPException(status_code=404, detail="Route not found")
     
+    await bump_versions(f"routes:{current_user.user_id}", *route_region_keys(route))
+    await schedule_match_warmup(current_user.user_id)
+    
     return {"message": "Route deleted successfully"}
 
-# ==================== DISCOVERY ENDPOINTS ====================
+# ==================== MATCH HUBS ====================
+
+# Transit hubs and large employers put hundreds of routes on nearly the same endpoints. Route legs
+# (the trip out, and the trip back for routes with a return time) whose ends fall in the same
+# geohash cells and that share a departure time and days form a hub: its candidates are scored
+# once, from the cell centers, and every member reads the same ranked list. Members then only
+# drop themselves and their blocks, and the rows they return are re-scored exactly, so a dense hub
+# costs one scoring pass instead of one per member.
+
+def geohash_center(cell: str) -> Coordinates:
+    """Center point of a geohash cell"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    use_lng = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lng_range if use_lng else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if value >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            use_lng = not use_lng
+    return Coordinates(lat=(lat_range[0] + lat_range[1]) / 2, lng=(lng_range[0] + lng_range[1]) / 2)
+
+def hub_key(leg: RouteLeg) -> tuple:
+    """(origin cell, destination cell, time, days): legs with the same key share their matches"""
+    return (
+        geohash(leg.origin.lat, leg.origin.lng, MATCH_HUB_PRECISION),
+        geohash(leg.destination.lat, leg.destination.lng, MATCH_HUB_PRECISION),
+        leg.time,
+        tuple(sorted(set(leg.days))),
+    )
 
-@api_router.get("/discovery/matches")
-async def get_matches(current_user: User = Depends(require_auth)):
-    """Get matched users based on routes"""
-    # Get user's active routes
-    user_routes = await db.routes.find({"user_id": current_user.user_id, "active": True}, {"_id": 0}).to_list(100)
-    
-    if not user_routes:
+def route_region_keys(route: Dict[str, Any]) -> Set[str]:
+    """Version keys a change to this route document moves: every prefix of its end and via tiles, so
+    each search cell that holds one of them is among the keys"""
+    start, end = route["start_coords"], route["end_coords"]
+    tiles = [
+        route.get("start_tile") or geohash(start["lat"], start["lng"]),
+        route.get("end_tile") or geohash(end["lat"], end["lng"]),
+        *(route.get("via_tiles") or via_tiles((start["lat"], start["lng"]), (end["lat"], end["lng"]))),
+    ]
+    keys = {f"{DISCOVERY_VERSION_KEY}:{tile[:length]}" for tile in tiles for length in range(1, len(tile) + 1)}
+    if MATCH_SEARCH != "adaptive" or not route.get("start_tile"):
+        keys.add(DISCOVERY_VERSION_KEY)  # the scan, and the scan for untiled routes, read from anywhere
+    return keys
+
+@functools.lru_cache(maxsize=MATCH_HUB_CACHE_SIZE)
+def hub_region_keys(origin_cell: str) -> Tuple[str, ...]:
+    """Version keys of every cell a hub's search may read routes from, however far it widens"""
+    keys = {ALL_REGIONS_VERSION_KEY, DISCOVERY_VERSION_KEY}
+    if MATCH_SEARCH == "adaptive":
+        keys.update(f"{DISCOVERY_VERSION_KEY}:{cell}" for cells in search_cells(geohash_center(origin_cell)) for cell in cells)
+    return tuple(sorted(keys))
+
+def discovery_region_keys(user_routes: List[Dict[str, Any]]) -> List[str]:
+    """Version keys of every region searched for the legs of these routes"""
+    legs = [leg for route in user_routes for leg in route_legs(Route(**route))]
+    return sorted({key for leg in legs for key in hub_region_keys(hub_key(leg)[0])})
+
+def own_match_keys(user_id: str) -> List[str]:
+    """Version keys of the user's own changes to their matches: their routes and their blocks"""
+    return [f"routes:{user_id}", f"matches:{user_id}"]
+
+def match_version_keys(user_id: str, user_routes: List[Dict[str, Any]]) -> List[str]:
+    """Version keys a user's matches may be computed from: their own and every cell their hubs may
+    search (which also moves when someone there changes their profile)"""
+    return [*own_match_keys(user_id), *discovery_region_keys(user_routes)]
+
+async def match_dependencies(user_id: str, user_routes: List[Dict[str, Any]], versions: Dict[str, int]) -> List[str]:
+    """The subset of match_version_keys the user's matches were computed from: the cells their
+    hubs' searches actually read"""
+    legs = [leg for route in user_routes for leg in route_legs(Route(**route))]
+    rankings = [await hub_matcher.matches(leg, versions) for leg in legs]
+    return [*own_match_keys(user_id), *sorted({key for ranking in rankings for key in ranking.regions})]
+
+class HubRanking:
+    """A hub's candidates: (other route, approximate match result) best first, routes per user,
+    the limits they were scored with and the version keys of the cells they were read from (with
+    those keys' versions before the read)"""
+    __slots__ = ('ranked', 'by_user', 'limits', 'regions', 'versions')
+    
+    def __init__(self, ranked: List[tuple], limits: MatchLimits = DEFAULT_MATCH_LIMITS,
+                 regions: Tuple[str, ...] = (ALL_REGIONS_VERSION_KEY, DISCOVERY_VERSION_KEY)):
+        self.ranked = ranked
+        self.limits = limits
+        self.regions = regions
+        self.versions: Tuple[int, ...] = ()
+        self.by_user: Dict[str, List[Route]] = {}
+        for other_route, _ in ranked:
+            self.by_user.setdefault(other_route.user_id, []).append(other_route)
+
+class HubMatcher:
+    """Ranked candidates per hub, cached until a route changes in one of the cells its search read"""
+    
+    def __init__(self, cache_size: int):
+        self.cache = LRUCache(cache_size)
+    
+    async def matches(self, leg: RouteLeg, versions: Dict[str, int]) -> HubRanking:
+        """The ranking shared by every leg in leg's hub; `versions` holds at least its hub_region_keys"""
+        hub = hub_key(leg)
+        ranking = self.cache.get(hub)
+        if ranking is None or ranking.versions != tuple(versions.get(key, 0) for key in ranking.regions):
+            # `versions` were read before the search, so a write landing during it leaves the ranking stale
+            searched = tuple(versions.get(key, 0) for key in hub_region_keys(hub[0]))
+            ranking = await single_flight.do(("hub", hub, searched), lambda: self.score_hub(hub))
+            ranking.versions = tuple(versions.get(key, 0) for key in ranking.regions)
+            self.cache.put(hub, ranking)
+        return ranking
+    
+    async def score_hub(self, key: tuple) -> HubRanking:
+        origin_cell, destination_cell, time, days = key
+        trip = RouteLeg(geohash_center(origin_cell), geohash_center(destination_cell), time, list(days))
+        
+        if MATCH_SEARCH == "adaptive":
+            return await search_nearby(trip)
+        
+        routes = [Route(**doc) async for doc in read_db.routes.find({"active": True}, {"_id": 0}).limit(1000)]
+        return HubRanking(rank_routes(routes, trip, DEFAULT_MATCH_LIMITS))
+
+hub_matcher = HubMatcher(MATCH_HUB_CACHE_SIZE)
+
+# ==================== ADAPTIVE SEARCH ====================
+
+# Downtown a fixed radius returns thousands of candidates and in the suburbs none. The adaptive
+# search reads only routes that start and end near the hub's endpoints, through prefix queries on
+# the routes' (start_tile, end_tile) index, departing within the time limit on a shared day, and
+# widens ring by ring until enough users match. Return legs are found the same way, through an
+# (end_tile, start_tile) index of the routes that have one, so both are led by the ring around the
+# origin. Right after the first ring come routes passing the trip on their way, through the
+# via_tiles index. Each search reads at most MATCH_MAX_CANDIDATES routes, however dense or sparse
+# the area. Routes saved before tiles existed are invisible to these queries, so until
+# migrate_route_tiles.py has backfilled them every search also scans for them.
+
+# Cleared once no route is left without tiles; new routes always get them, so it stays cleared
+untiled_routes_remain = True
+
+async def untiled_routes(trip: RouteLeg) -> List[Route]:
+    """Active routes without tiles that share a day with the trip, while any are left"""
+    global untiled_routes_remain
+    if not untiled_routes_remain:
         return []
     
-    # Get all other active routes
-    all_routes = await db.routes.find(
-        {"user_id": {"$ne": current_user.user_id}, "active": True},
-        {"_id": 0}
-    ).to_list(1000)
+    routes = [Route(**doc) async for doc in read_db.routes.find(
+        {"active": True, "start_tile": {"$exists": False}, "days_of_week": {"$in": trip.days}}, {"_id": 0}
+    ).limit(MATCH_MAX_CANDIDATES)]
+    if not routes:
+        untiled_routes_remain = await read_db.routes.find_one({"start_tile": {"$exists": False}}, {"_id": 1}) is not None
+    return routes
+
+def nearby_cells(point: Coordinates, radius_km: float, precision: int) -> List[str]:
+    """The point's cell at this precision and enough neighbours to contain every point within radius_km"""
+    width, height = geohash_cell_km(precision, point.lat)
+    reach_x, reach_y = ceil(radius_km / width), ceil(radius_km / height)
+    lng_bits, lat_bits = (5 * precision + 1) // 2, 5 * precision // 2
+    lat_step, lng_step = 180 / 2 ** lat_bits, 360 / 2 ** lng_bits
+    return sorted({
+        geohash(point.lat + dy * lat_step, point.lng + dx * lng_step, precision)
+        for dy in range(-reach_y, reach_y + 1) for dx in range(-reach_x, reach_x + 1)
+    })
+
+def prefix_cells(point: Coordinates, radius_km: float) -> List[str]:
+    """The cells that together contain every point within radius_km
+
+    That is the point's own cell and up to two rings of neighbours around it (at most 25
+    cells), at the finest precision where two rings reach radius_km.
+    """
+    precision = PLACE_TILE_PRECISION
+    while precision > 1:
+        width, height = geohash_cell_km(precision, point.lat)
+        if max(ceil(radius_km / width), ceil(radius_km / height)) <= 2:
+            break
+        precision -= 1
+    return nearby_cells(point, radius_km, precision)
+
+def tile_prefixes(point: Coordinates, radius_km: float) -> List[re.Pattern]:
+    """Prefix patterns for prefix_cells, to match the tiles inside them"""
+    return [re.compile(f"^{cell}") for cell in prefix_cells(point, radius_km)]
+
+def search_cells(origin: Coordinates) -> List[List[str]]:
+    """Per search tier, in order, cells holding a tile of every route the tier can return: the ring
+    around the origin (a route's start or end tile is in it) or, for pickups, the via cells around it"""
+    cells = [prefix_cells(origin, radius) for radius in MATCH_RADIUS_RINGS]
+    if MATCH_PICKUP_DISTANCE > 0:
+        cells.insert(1, nearby_cells(origin, MATCH_PICKUP_DISTANCE, MATCH_VIA_PRECISION))
+    return cells
+
+def departure_window(departure_time: str, lead: float = 0) -> Dict[str, str]:
+    """Range filter for departure times within MATCH_MAX_TIME_DIFF, or up to `lead` minutes earlier
+    still ("HH:MM" strings sort like times)"""
+    hours, minutes = map(int, departure_time.split(':'))
+    base, spread = hours * 60 + minutes, int(MATCH_MAX_TIME_DIFF)
+    low, high = max(0, base - spread - int(lead)), min(23 * 60 + 59, base + spread)
+    return {"$gte": f"{low // 60:02d}:{low % 60:02d}", "$lte": f"{high // 60:02d}:{high % 60:02d}"}
+
+def ring_limits(radius_km: float) -> MatchLimits:
+    """Limits for matches found within a ring: the defaults, with distances stretched for rings beyond them"""
+    distance = max(MATCH_MAX_DISTANCE, radius_km)
+    return MatchLimits(distance, distance, MATCH_MAX_TIME_DIFF)
+
+def rank_routes(routes, trip: RouteLeg, limits: MatchLimits) -> List[tuple]:
+    """(route, match result) for every route scoring above 30, best first"""
+    ranked = []
+    for other_route in routes:
+        match_result = trip_match_score(trip, other_route, limits)
+        if match_result and match_result["score"] > 30:  # Minimum 30% match
+            ranked.append((other_route, match_result))
+    
+    ranked.sort(key=lambda pair: pair[1]["score"], reverse=True)
+    return ranked
+
+def pickup_query(trip: RouteLeg) -> Dict[str, Any]:
+    """Routes passing near the trip's origin and then passing or ending near its destination,
+    leaving early enough to reach the origin"""
+    window = departure_window(trip.time, lead=MATCH_PICKUP_MAX_LEAD)
+    near_destination = tile_prefixes(trip.destination, MATCH_PICKUP_DISTANCE)
+    return {
+        "active": True,
+        "via_tiles": {"$in": nearby_cells(trip.origin, MATCH_PICKUP_DISTANCE, MATCH_VIA_PRECISION)},
+        "$and": [
+            {"$or": [
+                {"via_tiles": {"$in": nearby_cells(trip.destination, MATCH_PICKUP_DISTANCE, MATCH_VIA_PRECISION)}},
+                {"end_tile": {"$in": near_destination}},
+                {"start_tile": {"$in": near_destination}},
+            ]},
+            {"$or": [{"departure_time": window}, {"return_time": window}]},
+        ],
+        "days_of_week": {"$in": trip.days},
+    }
+
+def ring_query(trip: RouteLeg, radius: float) -> Dict[str, Any]:
+    """Routes with a leg from within `radius` of the trip's origin to near its destination"""
+    window = departure_window(trip.time)
+    near_origin = tile_prefixes(trip.origin, radius)
+    near_destination = tile_prefixes(trip.destination, ring_limits(radius).end_km)
+    return {
+        "active": True,
+        "$or": [
+            {"start_tile": {"$in": near_origin}, "end_tile": {"$in": near_destination}, "departure_time": window},
+            # "$type" lets the planner use the partial index of routes that have a return leg
+            {"start_tile": {"$in": near_destination}, "end_tile": {"$in": near_origin},
+             "return_time": {"$type": "string", **window}},
+        ],
+        "days_of_week": {"$in": trip.days},
+    }
+
+async def search_nearby(trip: RouteLeg) -> HubRanking:
+    """Rank routes with a leg near the trip's ends, widening the ring until MATCH_TARGET_COUNT users match"""
+    tiers = [(radius, functools.partial(ring_query, trip, radius)) for radius in MATCH_RADIUS_RINGS]
+    if MATCH_PICKUP_DISTANCE > 0:
+        # Pickups detour at most MATCH_PICKUP_DISTANCE, so they come right after the first ring
+        tiers.insert(1, (MATCH_RADIUS_RINGS[0], functools.partial(pickup_query, trip)))
+    
+    # Scores do not depend on the ring, so each route is scored once against the widest limits
+    # and every ring only filters by distance
+    widest = ring_limits(max(MATCH_RADIUS_RINGS))
+    untiled = await untiled_routes(trip)
+    examined: List[str] = [route.route_id for route in untiled]
+    scored: List[tuple] = rank_routes(untiled, trip, widest)
+    # The ranking only depends on routes in the cells of the tiers read, and on untiled routes if any
+    regions = {ALL_REGIONS_VERSION_KEY, DISCOVERY_VERSION_KEY} if untiled else {ALL_REGIONS_VERSION_KEY}
+    ranked, limits, radius = [], DEFAULT_MATCH_LIMITS, 0.0
+    for (radius, build_query), cells in zip(tiers, search_cells(trip.origin)):
+        budget = MATCH_MAX_CANDIDATES - len(examined)
+        if budget <= 0:
+            break
+        
+        regions.update(f"{DISCOVERY_VERSION_KEY}:{cell}" for cell in cells)
+        limits = ring_limits(radius)
+        query = build_query()
+        if examined:
+            query["route_id"] = {"$nin": examined}
+        routes = [Route(**doc) async for doc in read_db.routes.find(query, {"_id": 0}).limit(budget)]
+        examined.extend(route.route_id for route in routes)
+        scored.extend(rank_routes(routes, trip, widest))
+        
+        ranked = [
+            pair for pair in scored
+            if pair[1]["start_distance"] <= limits.start_km and pair[1]["end_distance"] <= limits.end_km
+        ]
+        if len({route.user_id for route, _ in ranked}) >= MATCH_TARGET_COUNT:
+            break
     
-    # Collect matching user IDs first
-    potential_matches = []
-    seen_users = set()
+    MATCH_SEARCH_RADIUS.observe(radius)
+    MATCH_CANDIDATES_EXAMINED.observe(len(examined))
+    ranked.sort(key=lambda pair: pair[1]["score"], reverse=True)
+    return HubRanking(ranked, limits, tuple(sorted(regions)))
+
+# ==================== DISCOVERY ENDPOINTS ====================
+
+async def iter_match_candidates(current_user: User, user_routes: List[Dict[str, Any]], versions: Dict[str, int]) -> AsyncIterator[Dict[str, Any]]:
+    """Yield each other user once, at their best hub score across the legs of the user's routes, best first
+
+    Each candidate carries the user's hub rankings, which hold every route of theirs that matched.
+    """
+    if not user_routes:
+        return
     
-    for user_route_dict in user_routes:
-        user_route = Route(**user_route_dict)
-        
-        for other_route_dict in all_routes:
-            other_route = Route(**other_route_dict)
-            
-            # Skip if already seen
-            if other_route.user_id in seen_users or other_route.user_id in current_user.blocked_users:
-                continue
-            
-            # Calculate match score
-            match_result = calculate_match_score(user_route, other_route)
-            
-            if match_result and match_result["score"] > 30:  # Minimum 30% match
-                potential_matches.append({
-                    "user_id": other_route.user_id,
-                    "match_result": match_result
-                })
-                seen_users.add(other_route.user_id)
+    user_routes = [Route(**route) for route in user_routes]
+    seen_users = set()
     
-    # Batch fetch all matched users in a single query
+    # Blocked users in either direction never come back out of the shared hub lists
+    hidden = await load_block_set(current_user.user_id)
+    hidden.add(current_user.user_id)
+    
+    legs = [leg for user_route in user_routes for leg in route_legs(user_route)]
+    hubs = [(leg, await hub_matcher.matches(leg, versions)) for leg in legs]
+    ranked_lists = [hub.ranked for _, hub in hubs]
+    
+    for other_route, match_result in heapq.merge(*ranked_lists, key=lambda pair: pair[1]["score"], reverse=True):
+        if other_route.user_id in seen_users or other_route.user_id in hidden:
+            continue
+        seen_users.add(other_route.user_id)
+        yield {
+            "user_id": other_route.user_id,
+            "match_result": match_result,
+            "hubs": hubs
+        }
+
+async def enrich_matches(current_user: User, potential_matches: List[Dict[str, Any]], min_score: float = 30) -> List[Dict[str, Any]]:
+    """Batch fetch matched users and build the public match rows"""
     if not potential_matches:
         return []
     
     user_ids = [m["user_id"] for m in potential_matches]
-    users = await db.users.find(
+    users = await read_db.users.find(
         {"user_id": {"$in": user_ids}},
-        {"_id": 0, "user_id": 1, "name": 1, "picture": 1, "bio": 1, "verified": 1, "blocked_users": 1}
+        {"_id": 0, "user_id": 1, "name": 1, "picture": 1, "bio": 1, "verified": 1}
     ).to_list(None)
     
     # Create user lookup dictionary
     users_dict = {u["user_id"]: u for u in users}
     
-    # Build final matches list
     matches = []
     for match in potential_matches:
         user_id = match["user_id"]
-        match_result = match["match_result"]
+        # Hub scores are measured from the cell center; report the exact best pair
+        match_result = max(
+            filter(None, (
+                trip_match_score(leg, route, hub.limits)
+                for leg, hub in match["hubs"] for route in hub.by_user.get(user_id, ())
+            )),
+            key=lambda result: result["score"], default=None
+        )
         
-        if user_id in users_dict:
+        if match_result and match_result["score"] > min_score and user_id in users_dict:
             other_user = users_dict[user_id]
-            if current_user.user_id not in other_user.get("blocked_users", []):
-                matches.append({
-                    "user_id": other_user["user_id"],
-                    "name": other_user["name"],
-                    "picture": other_user.get("picture"),
-                    "bio": other_user.get("bio"),
-                    "verified": other_user.get("verified", False),
-                    "route_match_score": round(match_result["score"], 1),
-                    "distance_to_start": round(match_result["start_distance"], 2),
-                    "distance_to_end": round(match_result["end_distance"], 2)
-                })
+            matches.append({
+                "user_id": other_user["user_id"],
+                "name": other_user["name"],
+                "picture": other_user.get("picture"),
+                "bio": other_user.get("bio"),
+                "verified": other_user.get("verified", False),
+                "route_match_score": round(match_result["score"], 1),
+                "distance_to_start": round(match_result["start_distance"], 2),
+                "distance_to_end": round(match_result["end_distance"], 2),
+                "match_type": match_result["match_type"]
+            })
+    
+    return matches
+
+async def stream_matches(current_user: User, selected: List[Dict[str, Any]], min_score: float) -> AsyncIterator[Dict[str, Any]]:
+    """Yield a selected page's enriched matches in small batches, best first"""
+    for start in range(0, len(selected), STREAM_BATCH_SIZE):
+        for match in await enrich_matches(current_user, selected[start:start + STREAM_BATCH_SIZE], min_score):
+            yield match
+
+# Match pages are ordered by (score, user_id) descending; a cursor is the last pair returned
+def encode_match_cursor(position: tuple) -> str:
+    """Opaque "load more" token for a (score, user_id) position"""
+    return base64.urlsafe_b64encode(orjson.dumps(position)).decode()
+
+def decode_match_cursor(cursor: str) -> tuple:
+    """Inverse of encode_match_cursor (400 on anything else)"""
+    try:
+        score, user_id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), str(user_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def select_top_candidates(candidates: AsyncIterator[Dict[str, Any]], limit: int, min_score: float,
+                                after: Optional[tuple] = None) -> List[Dict[str, Any]]:
+    """Best `limit` candidates past the cursor, kept in a bounded min-heap keyed by (score, user_id)"""
+    heap: List[tuple] = []
+    async for candidate in candidates:
+        position = (candidate["match_result"]["score"], candidate["user_id"])
+        if position[0] <= min_score:
+            break  # candidates arrive best first
+        if after is not None and position >= after:
+            continue  # already on an earlier page
+        if len(heap) < limit:
+            heapq.heappush(heap, (position, candidate))
+        elif position > heap[0][0]:
+            heapq.heapreplace(heap, (position, candidate))
+        elif position[0] < heap[0][0][0]:
+            break  # full, and everything still to come scores lower
+    return [candidate for _, candidate in sorted(heap, key=lambda entry: entry[0], reverse=True)]
+
+@api_router.get("/discovery/matches")
+async def get_matches(
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
+    min_score: Annotated[float, Query(ge=30, le=100)] = 30,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(require_auth)
+):
+    """Get matched users based on routes (X-Next-Cursor is set when another page may follow)"""
+    after = decode_match_cursor(cursor) if cursor else None
+    received_at = getattr(request.state, "received_at", None)
+    
+    # The default first page comes from the task queue's snapshot (see MATCH_SNAPSHOT_MAX_AGE), with an
+    # ETag from the versions it was computed from
+    snapshot = None
+    if after is None and (limit, min_score) == (50, 30) and not wants_ndjson(request):
+        snapshot = await single_flight.do(
+            ("match_snapshot", current_user.user_id),
+            lambda: load_match_snapshot(current_user.user_id),
+            not_before=received_at
+        )
+    if snapshot:
+        keys, computed_from = tuple(snapshot["keys"]), dict(zip(snapshot["keys"], snapshot["versions"]))
+        versions = await request_versions(request, keys, read_db)
+        changed = {key for key in keys if versions.get(key, 0) != computed_from[key]}
+        age = (datetime.now(timezone.utc) - snapshot["computed_at"].replace(tzinfo=timezone.utc)).total_seconds()
+        if changed & set(own_match_keys(current_user.user_id)) or (changed and age > MATCH_SNAPSHOT_MAX_AGE):
+            snapshot = None
+        elif changed:
+            # A route or profile its hubs read changed: keep serving the page while it is recomputed
+            await schedule_match_warmup(current_user.user_id)
+    if snapshot:
+        etag = versions_etag(request, current_user.user_id, keys, computed_from)
+    else:
+        # Otherwise the ETag covers every cell the user's hubs may read, so their routes come first
+        user_routes = await single_flight.do(
+            ("active_routes", current_user.user_id),
+            lambda: load_active_routes(current_user.user_id),
+            not_before=received_at
+        )
+        keys = match_version_keys(current_user.user_id, user_routes)
+        etag = await data_etag(request, current_user.user_id, *keys, source=read_db)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    # Only a request that has to compute something spends a token; revalidations are cheap
+    await enforce_rate_limit("discovery", current_user.user_id)
+    
+    if snapshot:
+        matches, next_position = snapshot["matches"], snapshot["next_position"]
+    elif wants_ndjson(request):
+        # The same page as the JSON response: only the enrichment is streamed
+        selected, next_position = await select_match_page(
+            current_user, limit, min_score, after, user_routes, request.state.data_versions
+        )
+        headers = etag_headers(etag)
+        if next_position:
+            headers["X-Next-Cursor"] = encode_match_cursor(next_position)
+        return ndjson_response(stream_matches(current_user, selected, min_score), headers=headers)
+    else:
+        # Keyed by version too, so a request made after a write never gets a page computed before it
+        versions = request.state.data_versions
+        matches, next_position = await single_flight.do(
+            ("matches", current_user.user_id, limit, min_score, after, versions_digest(keys, versions)),
+            lambda: compute_matches(current_user, limit, min_score, after, user_routes, versions)
+        )
+    headers = etag_headers(etag)
+    if next_position:
+        headers["X-Next-Cursor"] = encode_match_cursor(next_position)
+    return fast_json(matches, headers=headers)
+
+async def load_active_routes(user_id: str) -> List[Dict[str, Any]]:
+    """A user's active routes, from the primary so one they just saved is among them"""
+    return await db.routes.find({"user_id": user_id, "active": True}, {"_id": 0}).to_list(100)
+
+async def select_match_page(current_user: User, limit: int, min_score: float, after: Optional[tuple],
+                            user_routes: Optional[List[Dict[str, Any]]] = None,
+                            versions: Optional[Dict[str, int]] = None) -> tuple:
+    """A page's candidates, best first, and the cursor position for the next page (if any)"""
+    if user_routes is None:
+        user_routes = await load_active_routes(current_user.user_id)
+    
+    if not user_routes:
+        return [], None
+    
+    if versions is None:
+        versions = await load_versions(discovery_region_keys(user_routes), read_db)
+    selected = await select_top_candidates(
+        iter_match_candidates(current_user, user_routes, versions), limit, min_score, after
+    )
+    next_position = None
+    if len(selected) == limit:
+        last = selected[-1]
+        next_position = (last["match_result"]["score"], last["user_id"])
+    return selected, next_position
+
+async def compute_matches(current_user: User, limit: int = 50, min_score: float = 30,
+                          after: Optional[tuple] = None, user_routes: Optional[List[Dict[str, Any]]] = None,
+                          versions: Optional[Dict[str, int]] = None) -> tuple:
+    """One page of enriched matches, best first, and the cursor position for the next page (if any)
+
+    Callers that already hold the user's active routes and region versions pass them in.
+    """
+    selected, next_position = await select_match_page(current_user, limit, min_score, after, user_routes, versions)
+    
+    # Batch fetch all matched users in a single query
+    matches = await enrich_matches(current_user, selected, min_score)
     
     # Sort by score (highest first)
     matches.sort(key=lambda x: x["route_match_score"], reverse=True)
     
-    return matches[:50]  # Return top 50 matches
+    return matches, next_position
 
 # ==================== CONNECTION ENDPOINTS ====================
 
@@ -542,6 +1987,7 @@ async def create_connection_request(conn_request: ConnectionRequest, current_use
     }
     
     await db.connections.insert_one(connection)
+    await bump_versions(f"connections:{current_user.user_id}", f"connections:{conn_request.target_user_id}")
     
     return Connection(**connection)
 
@@ -560,25 +2006,13 @@ async def respond_to_connection(conn_response: ConnectionResponse, current_user:
         {"connection_id": conn_response.connection_id},
         {"$set": {"status": conn_response.action}}
     )
+    await bump_versions(f"connections:{connection['user1_id']}", f"connections:{current_user.user_id}")
     
     updated_connection = await db.connections.find_one({"connection_id": conn_response.connection_id}, {"_id": 0})
     return Connection(**updated_connection)
 
-@api_router.get("/connections/list")
-async def get_connections(status: Optional[str] = None, current_user: User = Depends(require_auth)):
-    """Get all connections (pending, accepted, rejected)"""
-    query = {
-        "$or": [
-            {"user1_id": current_user.user_id},
-            {"user2_id": current_user.user_id}
-        ]
-    }
-    
-    if status:
-        query["status"] = status
-    
-    connections = await db.connections.find(query, {"_id": 0}).to_list(1000)
-    
+async def enrich_connections(current_user: User, connections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Attach the other user's public info to each connection"""
     # Collect all other user IDs
     other_user_ids = []
     for conn in connections:
@@ -604,31 +2038,294 @@ async def get_connections(status: Optional[str] = None, current_user: User = Dep
         
         if other_user_id in users_dict:
             result.append({
-                **conn,
+                **public_fields(Connection, conn),
                 "other_user": users_dict[other_user_id]
             })
     
     return result
 
-# ==================== MESSAGE ENDPOINTS ====================
+async def stream_connections(current_user: User, query: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """Yield enriched connections batch by batch straight off the cursor"""
+    batch = []
+    async for conn in db.connections.find(query, {"_id": 0}).limit(1000):
+        batch.append(conn)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            for row in await enrich_connections(current_user, batch):
+                yield row
+            batch = []
+    
+    for row in await enrich_connections(current_user, batch):
+        yield row
 
-@api_router.get("/messages/conversation/{other_user_id}")
-async def get_conversation(other_user_id: str, current_user: User = Depends(require_auth)):
-    """Get conversation with another user"""
-    messages = await db.messages.find(
-        {
+@api_router.get("/connections/list")
+async def get_connections(request: Request, status: Optional[str] = None, current_user: User = Depends(require_auth)):
+    """Get all connections (pending, accepted, rejected)"""
+    query = {
+        "$or": [
+            {"user1_id": current_user.user_id},
+            {"user2_id": current_user.user_id}
+        ]
+    }
+    
+    if status:
+        query["status"] = status
+    
+    etag = await data_etag(request, current_user.user_id, f"connections:{current_user.user_id}")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    if wants_ndjson(request):
+        return ndjson_response(stream_connections(current_user, query), headers=etag_headers(etag))
+    
+    version = request.state.data_versions.get(f"connections:{current_user.user_id}", 0)
+    result = await single_flight.do(
+        ("connections", current_user.user_id, status, version),
+        lambda: load_connections(current_user, query)
+    )
+    return fast_json(result, headers=etag_headers(etag))
+
+async def load_connections(current_user: User, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Fetch and enrich a user's connections"""
+    connections = await db.connections.find(query, {"_id": 0}).to_list(1000)
+    return await enrich_connections(current_user, connections)
+
+# ==================== MESSAGE RETENTION ====================
+
+# Archive chunks hold a zlib-compressed JSON array of one conversation's messages (oldest first)
+# with first_ts/last_ts bounds. Read flags are frozen once a message is archived.
+
+def conversation_key(user_a: str, user_b: str) -> str:
+    """Order-independent id for the conversation between two users"""
+    return "|".join(sorted((user_a, user_b)))
+
+def naive_utc(value: datetime) -> datetime:
+    """Mongo hands back naive UTC datetimes; normalize aware ones so they compare"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def pack_messages(messages: List[Dict[str, Any]]) -> bytes:
+    """Serialize and compress messages for an archive chunk"""
+    return zlib.compress(orjson.dumps(messages))
+
+def unpack_messages(data: bytes) -> List[Dict[str, Any]]:
+    """Inverse of pack_messages, with timestamps restored to datetimes"""
+    messages = orjson.loads(zlib.decompress(data))
+    for message in messages:
+        message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+    return messages
+
+async def ensure_message_indexes():
+    """Indexes for conversation paging, the archiver's age scan and archive lookups"""
+    await db.messages.create_index([("sender_id", ASCENDING), ("receiver_id", ASCENDING), ("timestamp", DESCENDING)])
+    await db.messages.create_index([("timestamp", ASCENDING)])
+    await db.message_buckets.create_index([("conversation", ASCENDING), ("count", ASCENDING)])
+    await db.message_buckets.create_index([("conversation", ASCENDING), ("last_ts", DESCENDING)])
+    await db.message_buckets.create_index([("last_ts", ASCENDING)])
+    await db.message_archive.create_index([("conversation", ASCENDING), ("last_ts", DESCENDING)])
+
+async def acquire_lease(name: str, ttl: float) -> bool:
+    """Take or renew a named lease so only one worker runs a periodic job"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_leases.update_one(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:  # held by another worker
+        return False
+
+async def write_archive_chunks(chunks: List[Tuple[str, List[Dict[str, Any]]]]):
+    """Upsert (conversation, oldest-first messages) pairs as archive chunks"""
+    # Chunk ids derive from their first message, so a pass retried after a crash overwrites instead of duplicating
+    await db.message_archive.bulk_write([
+        UpdateOne(
+            {"_id": f"{conversation}:{messages[0]['message_id']}"},
+            {"$set": {
+                "conversation": conversation,
+                "first_ts": messages[0]["timestamp"],
+                "last_ts": messages[-1]["timestamp"],
+                "count": len(messages),
+                "data": pack_messages(messages),
+            }},
+            upsert=True
+        )
+        for conversation, messages in chunks
+    ], ordered=False)
+
+async def archive_messages_batch(cutoff: datetime, batch_size: int) -> int:
+    """Move up to batch_size message documents older than cutoff into archive chunks; returns how many moved"""
+    old = await db.messages.find({"timestamp": {"$lt": cutoff}}, {"_id": 0}).sort("timestamp", 1).limit(batch_size).to_list(None)
+    if not old:
+        return 0
+    
+    by_conversation: Dict[str, List[Dict[str, Any]]] = {}
+    for message in old:
+        by_conversation.setdefault(conversation_key(message["sender_id"], message["receiver_id"]), []).append(message)
+    
+    await write_archive_chunks(list(by_conversation.items()))
+    await db.messages.delete_many({"message_id": {"$in": [m["message_id"] for m in old]}})
+    
+    MESSAGES_ARCHIVED.inc(len(old))
+    return len(old)
+
+async def archive_buckets_batch(cutoff: datetime, batch_size: int) -> int:
+    """Move whole buckets whose newest message is older than cutoff into the archive; returns messages moved"""
+    buckets = await db.message_buckets.find({"last_ts": {"$lt": cutoff}}).sort("last_ts", 1).limit(
+        max(1, batch_size // MESSAGE_BUCKET_SIZE)
+    ).to_list(None)
+    if not buckets:
+        return 0
+    
+    await write_archive_chunks([
+        (b["conversation"], sorted(b["messages"], key=lambda m: m["timestamp"])) for b in buckets
+    ])
+    # A bucket that took a late append has a newer last_ts and stays hot; reads drop the duplicates
+    await db.message_buckets.delete_many({"_id": {"$in": [b["_id"] for b in buckets]}, "last_ts": {"$lt": cutoff}})
+    
+    moved = sum(b["count"] for b in buckets)
+    MESSAGES_ARCHIVED.inc(moved)
+    return moved
+
+async def archive_old_messages(hot_days: int = MESSAGE_HOT_DAYS, batch_size: int = MESSAGE_ARCHIVE_BATCH) -> int:
+    """Archive everything past the hot window, one batch at a time, from either storage layout"""
+    cutoff = naive_utc(datetime.now(timezone.utc) - timedelta(days=hot_days))
+    total = 0
+    for archive_batch in (archive_messages_batch, archive_buckets_batch):
+        while moved := await archive_batch(cutoff, batch_size):
+            total += moved
+    return total
+
+async def run_message_archiver():
+    """Periodically archive old messages on whichever worker holds the lease"""
+    while True:
+        try:
+            if await acquire_lease("message_archiver", MESSAGE_ARCHIVE_INTERVAL * 2):
+                moved = await archive_old_messages()
+                if moved:
+                    logger.info(f"Archived {moved} messages older than {MESSAGE_HOT_DAYS} days")
+        except Exception as e:
+            logger.error(f"Message archiving failed: {e}")
+        await asyncio.sleep(MESSAGE_ARCHIVE_INTERVAL)
+
+async def load_archived_messages(conversation: str, before: Optional[datetime], limit: int) -> List[Dict[str, Any]]:
+    """Newest-first archived messages of a conversation older than `before`"""
+    query: Dict[str, Any] = {"conversation": conversation}
+    if before:
+        query["first_ts"] = {"$lt": before}
+    
+    found: Dict[str, Dict[str, Any]] = {}
+    messages: List[Dict[str, Any]] = []
+    async for chunk in db.message_archive.find(query, {"_id": 0, "last_ts": 1, "data": 1}).sort("last_ts", -1):
+        # Chunks from different archive runs can overlap in time, so stop only once nothing newer can follow
+        if len(messages) >= limit and naive_utc(chunk["last_ts"]) < messages[limit - 1]["timestamp"]:
+            break
+        for message in unpack_messages(chunk["data"]):
+            if before is None or message["timestamp"] < before:
+                found[message["message_id"]] = message
+        messages = sorted(found.values(), key=lambda m: (m["timestamp"], m["message_id"]), reverse=True)
+    return messages[:limit]
+
+async def load_conversation_page(user_id: str, other_user_id: str, before: Optional[datetime], limit: int) -> List[Dict[str, Any]]:
+    """The latest `limit` messages before `before`, oldest first, continuing into the archive"""
+    if MESSAGE_BUCKETS:
+        messages = await load_bucketed_messages(conversation_key(user_id, other_user_id), before, limit)
+    else:
+        query: Dict[str, Any] = {
             "$or": [
-                {"sender_id": current_user.user_id, "receiver_id": other_user_id},
-                {"sender_id": other_user_id, "receiver_id": current_user.user_id}
+                {"sender_id": user_id, "receiver_id": other_user_id},
+                {"sender_id": other_user_id, "receiver_id": user_id}
             ]
+        }
+        if before:
+            query["timestamp"] = {"$lt": before}
+        messages = await db.messages.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(None)
+    
+    if len(messages) < limit:
+        boundary = messages[-1]["timestamp"] if messages else before
+        seen = {m["message_id"] for m in messages}
+        archived = await load_archived_messages(conversation_key(user_id, other_user_id), boundary, limit - len(messages))
+        messages.extend(m for m in archived if m["message_id"] not in seen)
+    
+    messages.reverse()
+    return messages
+
+# ==================== MESSAGE BUCKETS ====================
+
+# With MESSAGE_STORAGE=buckets a conversation lives in message_buckets documents:
+# {conversation, first_ts, last_ts, count, unread: {<receiver_id>: n}, messages: [oldest first]}.
+# Sends $push into the conversation's open bucket (count < MESSAGE_BUCKET_SIZE); once it is
+# full the upsert no longer matches it and starts the next bucket.
+
+async def append_to_bucket(message: Dict[str, Any]):
+    """Push a message into its conversation's open bucket"""
+    await fast_db.message_buckets.update_one(
+        {"conversation": conversation_key(message["sender_id"], message["receiver_id"]), "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+        {
+            "$push": {"messages": message},
+            "$inc": {"count": 1, f"unread.{message['receiver_id']}": 0 if message["read"] else 1},
+            "$min": {"first_ts": message["timestamp"]},
+            "$max": {"last_ts": message["timestamp"]},
         },
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(1000)
+        upsert=True
+    )
+
+async def load_bucketed_messages(conversation: str, before: Optional[datetime], limit: int) -> List[Dict[str, Any]]:
+    """Newest-first bucketed messages older than `before`, usually one or two bucket reads"""
+    query: Dict[str, Any] = {"conversation": conversation}
+    if before:
+        query["first_ts"] = {"$lt": before}
+    
+    messages: List[Dict[str, Any]] = []
+    async for bucket in db.message_buckets.find(query, {"_id": 0, "last_ts": 1, "messages": 1}).sort("last_ts", -1):
+        # Buckets opened concurrently can overlap in time, so stop only once nothing newer can follow
+        if len(messages) >= limit and bucket["last_ts"] < messages[limit - 1]["timestamp"]:
+            break
+        messages.extend(m for m in bucket["messages"] if before is None or m["timestamp"] < before)
+        messages.sort(key=lambda m: m["timestamp"], reverse=True)
+    return messages[:limit]
+
+async def store_message(message: Dict[str, Any]):
+    """Persist a new message in the configured storage layout"""
+    if MESSAGE_BUCKETS:
+        await append_to_bucket({**message})
+    else:
+        await fast_db.messages.insert_one({**message})  # keep Mongo's _id out of the caller's dict
+
+async def mark_conversation_read(reader_id: str, sender_id: str):
+    """Mark everything sender_id sent to reader_id as read"""
+    if MESSAGE_BUCKETS:
+        await fast_db.message_buckets.update_many(
+            {"conversation": conversation_key(reader_id, sender_id), f"unread.{reader_id}": {"$gt": 0}},
+            {"$set": {"messages.$[m].read": True, f"unread.{reader_id}": 0}},
+            array_filters=[{"m.receiver_id": reader_id, "m.read": False}]
+        )
+    else:
+        await fast_db.messages.update_many(
+            {"sender_id": sender_id, "receiver_id": reader_id, "read": False},
+            {"$set": {"read": True}}
+        )
+
+# ==================== MESSAGE ENDPOINTS ====================
+
+@api_router.get("/messages/conversation/{other_user_id}")
+async def get_conversation(
+    other_user_id: str,
+    before: Optional[datetime] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 1000,
+    current_user: User = Depends(require_auth)
+):
+    """Get conversation with another user (pass the oldest timestamp as `before` to load older messages)"""
+    messages = await load_conversation_page(
+        current_user.user_id, other_user_id, naive_utc(before) if before else None, limit
+    )
     
-    return [Message(**msg) for msg in messages]
+    return fast_json([public_fields(Message, message) for message in messages])
 
 @api_router.post("/messages/send")
-async def send_message(message_data: MessageCreate, current_user: User = Depends(require_auth)):
+async def send_message(message_data: MessageCreate, current_user: User = Depends(rate_limited("messaging"))):
     """Send a message"""
     message_id = f"msg_{uuid.uuid4().hex[:12]}"
     
@@ -641,23 +2338,276 @@ async def send_message(message_data: MessageCreate, current_user: User = Depends
         "read": False
     }
     
-    await db.messages.insert_one(message)
+    await store_message(message)
+    await notify_new_message(message)
     
     # Emit socket event
-    await sio.emit('new_message', Message(**message).dict(), room=message_data.receiver_id)
+    await emit_event('new_message', Message(**message).model_dump(mode="json"), room=message_data.receiver_id)
     
     return Message(**message)
 
 @api_router.post("/messages/mark-read/{other_user_id}")
 async def mark_messages_read(other_user_id: str, current_user: User = Depends(require_auth)):
     """Mark all messages from a user as read"""
-    await db.messages.update_many(
-        {"sender_id": other_user_id, "receiver_id": current_user.user_id, "read": False},
-        {"$set": {"read": True}}
-    )
+    await mark_conversation_read(current_user.user_id, other_user_id)
     
     return {"message": "Messages marked as read"}
 
+# ==================== NOTIFICATIONS ====================
+
+# Sending a message only upserts one queue entry per (recipient, collapse key); delivery happens
+# in run_notification_worker, so a slow or failing push provider never shows up in send latency.
+# Delivery is at-least-once: a claim whose worker dies is picked up again once its lease expires.
+
+class StubPushProvider:
+    """Local stand-in that records pushes instead of delivering them"""
+    name = "stub"
+    max_batch = 100
+
+    def __init__(self, fail_rate: float = 0.0):
+        self.fail_rate = fail_rate
+        self.sent: deque = deque(maxlen=1000)
+
+    async def send(self, messages: List[Dict[str, Any]]) -> List[str]:
+        results = []
+        for message in messages:
+            if message["to"].startswith("invalid"):
+                results.append("invalid")
+            elif random.random() < self.fail_rate:
+                results.append("retry")
+            else:
+                self.sent.append(message)
+                results.append("ok")
+        return results
+
+class ExpoPushProvider:
+    """Expo push service; one HTTP request per batch of up to 100 messages"""
+    name = "expo"
+    max_batch = 100
+
+    async def send(self, messages: List[Dict[str, Any]]) -> List[str]:
+        global http_client
+        if http_client is None:
+            http_client = create_http_client()
+
+        response = await http_client.post(EXPO_PUSH_URL, json=messages)
+        if response.status_code == 429 or response.status_code >= 500:
+            return ["retry"] * len(messages)
+        response.raise_for_status()
+
+        results = []
+        for ticket in response.json()["data"]:
+            error = ticket.get("details", {}).get("error")
+            if ticket.get("status") == "ok":
+                results.append("ok")
+            elif error == "DeviceNotRegistered":
+                results.append("invalid")
+            elif error == "MessageRateExceeded":
+                results.append("retry")
+            else:
+                logger.warning(f"Expo rejected push: {ticket.get('message')}")
+                results.append("rejected")
+        return results
+
+PUSH_PROVIDERS: Dict[str, Any] = {
+    "expo": ExpoPushProvider(),
+    "stub": StubPushProvider(PUSH_STUB_FAIL_RATE),
+}
+
+async def ensure_notification_indexes():
+    """Indexes for device lookups, collapsing and the worker's claim scan"""
+    await db.devices.create_index("token", unique=True)
+    await db.devices.create_index("user_id")
+    # At most one pending entry per collapse key, so concurrent enqueues cannot both insert one
+    try:
+        await db.notification_queue.create_index(
+            [("user_id", ASCENDING), ("collapse_key", ASCENDING)], unique=True, partialFilterExpression={"state": "pending"}
+        )
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        # Duplicates enqueued before the index existed; they are delivered within seconds, so a later start creates it
+        logger.warning("Notification queue holds duplicate pending entries; unique index not created yet")
+    await db.notification_queue.create_index([("state", ASCENDING), ("available_at", ASCENDING)])
+    await db.notification_queue.create_index("claim")
+
+async def enqueue_notification(user_id: str, collapse_key: str, data: Dict[str, Any]):
+    """Queue a push; pending pushes with the same collapse key merge and keep the latest data"""
+    now = datetime.now(timezone.utc)
+    merge = (
+        {"user_id": user_id, "collapse_key": collapse_key, "state": "pending"},
+        {
+            "$set": {"data": data, "updated_at": now},
+            "$inc": {"count": 1},
+            "$setOnInsert": {
+                "attempts": 0,
+                "created_at": now,
+                "available_at": now + timedelta(seconds=NOTIFICATION_COLLAPSE_SECONDS),
+            },
+        },
+    )
+    try:
+        await fast_db.notification_queue.update_one(*merge, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent enqueue inserted the pending entry between our match and insert; merge into it
+        await fast_db.notification_queue.update_one(*merge, upsert=True)
+
+async def notify_new_message(message: Dict[str, Any]):
+    """Queue a push for the receiver, collapsed per conversation"""
+    await enqueue_notification(
+        message["receiver_id"],
+        f"message:{message['sender_id']}",
+        {"kind": "message", "sender_id": message["sender_id"], "preview": message["content"][:100]}
+    )
+
+async def claim_notifications(limit: int) -> List[Dict[str, Any]]:
+    """Lease up to `limit` due queue entries (including ones whose previous lease expired)"""
+    now = datetime.now(timezone.utc)
+    due = {"$or": [
+        {"state": "pending", "available_at": {"$lte": now}},
+        {"state": "sending", "lease_until": {"$lt": now}},
+    ]}
+    ids = [doc["_id"] async for doc in db.notification_queue.find(due, {"_id": 1}).limit(limit)]
+    if not ids:
+        return []
+
+    claim = uuid.uuid4().hex
+    await db.notification_queue.update_many(
+        {"_id": {"$in": ids}, **due},
+        {"$set": {"state": "sending", "claim": claim, "lease_until": now + timedelta(seconds=NOTIFICATION_LEASE_SECONDS)}}
+    )
+    return await db.notification_queue.find({"claim": claim}).to_list(None)
+
+def render_push(jobs: List[Dict[str, Any]], names: Dict[str, str]) -> Dict[str, Any]:
+    """One push for everything a device has pending: the message itself, or a summary"""
+    total = sum(job["count"] for job in jobs)
+    if len(jobs) == 1:
+        data = jobs[0]["data"]
+        sender = names.get(data["sender_id"], "Someone")
+        body = data["preview"] if total == 1 else f"{total} new messages"
+        return {"title": sender, "body": body, "data": data}
+
+    senders = [names.get(job["data"]["sender_id"], "Someone") for job in jobs]
+    others = f" and {len(senders) - 3} more" if len(senders) > 3 else ""
+    return {
+        "title": "RouteBuddy",
+        "body": f"{total} new messages from {', '.join(senders[:3])}{others}",
+        "data": {"kind": "messages"},
+    }
+
+async def deliver_notifications(limit: int) -> int:
+    """Claim a batch, send one push per device grouped by provider, then settle the queue entries"""
+    jobs = await claim_notifications(limit)
+    if not jobs:
+        return 0
+
+    by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for job in jobs:
+        by_user.setdefault(job["user_id"], []).append(job)
+    devices = await db.devices.find({"user_id": {"$in": list(by_user)}}, {"_id": 0}).to_list(None)
+    sender_ids = list({job["data"]["sender_id"] for job in jobs})
+    names = {
+        user["user_id"]: user["name"]
+        async for user in read_db.users.find({"user_id": {"$in": sender_ids}}, {"_id": 0, "user_id": 1, "name": 1})
+    }
+
+    outgoing: Dict[str, List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]] = {}
+    for device in devices:
+        outgoing.setdefault(device["provider"], []).append((device, by_user[device["user_id"]]))
+
+    retry_ids: Set[Any] = set()
+    invalid_tokens = []
+    for provider_name, items in outgoing.items():
+        provider = PUSH_PROVIDERS.get(provider_name)
+        if provider is None:
+            continue
+        for start in range(0, len(items), provider.max_batch):
+            chunk = items[start:start + provider.max_batch]
+            messages = [{"to": device["token"], **render_push(user_jobs, names)} for device, user_jobs in chunk]
+            try:
+                results = await provider.send(messages)
+            except Exception as e:
+                logger.warning(f"Push via {provider_name} failed: {e!r}")
+                results = ["retry"] * len(chunk)
+            for (device, user_jobs), result in zip(chunk, results):
+                PUSH_NOTIFICATIONS.labels(provider=provider_name, result=result).inc()
+                if result == "retry":
+                    retry_ids.update(job["_id"] for job in user_jobs)
+                elif result == "invalid":
+                    invalid_tokens.append(device["token"])
+
+    if invalid_tokens:
+        await db.devices.delete_many({"token": {"$in": invalid_tokens}})
+
+    now = datetime.now(timezone.utc)
+    done = [job["_id"] for job in jobs if job["_id"] not in retry_ids]
+    retries = []
+    for job in jobs:
+        if job["_id"] not in retry_ids:
+            continue
+        attempts = job.get("attempts", 0) + 1
+        if attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            logger.warning(f"Dropping push for {job['user_id']} after {attempts} attempts")
+            done.append(job["_id"])
+            continue
+        # Exponential backoff with full jitter, as for auth retries
+        delay = random.uniform(0, NOTIFICATION_RETRY_BASE_DELAY * 2 ** attempts)
+        retries.append((job, UpdateOne(
+            {"_id": job["_id"], "claim": job["claim"]},
+            {"$set": {"state": "pending", "attempts": attempts, "available_at": now + timedelta(seconds=delay)},
+             "$unset": {"claim": "", "lease_until": ""}}
+        )))
+
+    if done:
+        await db.notification_queue.delete_many({"_id": {"$in": done}})
+    if retries:
+        try:
+            await db.notification_queue.bulk_write([op for _, op in retries], ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            # Messages arrived for these keys while they were being sent: fold the failed push into the
+            # newer pending entry, which already carries the latest data
+            for error in e.details["writeErrors"]:
+                job = retries[error["index"]][0]
+                await db.notification_queue.update_one(
+                    {"user_id": job["user_id"], "collapse_key": job["collapse_key"], "state": "pending"},
+                    {"$inc": {"count": job["count"]}}
+                )
+                await db.notification_queue.delete_one({"_id": job["_id"], "claim": job["claim"]})
+    return len(jobs)
+
+async def run_notification_worker():
+    """Deliver queued pushes; drains full batches back to back and polls when the queue is idle"""
+    while True:
+        try:
+            if await deliver_notifications(NOTIFICATION_BATCH_SIZE) == NOTIFICATION_BATCH_SIZE:
+                continue
+        except Exception as e:
+            logger.error(f"Push delivery failed: {e}")
+        await asyncio.sleep(NOTIFICATION_POLL_INTERVAL)
+
+@api_router.post("/notifications/devices")
+async def register_device(device: DeviceRegistration, current_user: User = Depends(require_auth)):
+    """Register a push token for the current user (re-registering moves it to this user)"""
+    if device.provider not in PUSH_PROVIDERS:
+        raise HTTPException(status_code=400, detail="Unknown push provider")
+
+    now = datetime.now(timezone.utc)
+    await db.devices.update_one(
+        {"token": device.token},
+        {"$set": {"user_id": current_user.user_id, "provider": device.provider, "updated_at": now},
+         "$setOnInsert": {"created_at": now}},
+        upsert=True
+    )
+    return {"message": "Device registered"}
+
+@api_router.delete("/notifications/devices/{token}")
+async def unregister_device(token: str, current_user: User = Depends(require_auth)):
+    """Stop pushes to a device (e.g. on logout)"""
+    await db.devices.delete_one({"token": token, "user_id": current_user.user_id})
+    return {"message": "Device unregistered"}
+
 # ==================== SAFETY ENDPOINTS ====================
 
 @api_router.post("/reports/create")
@@ -674,7 +2624,7 @@ async def create_report(report_data: ReportCreate, current_user: User = Depends(
         "timestamp": datetime.now(timezone.utc)
     }
     
-    await db.reports.insert_one(report)
+    await enqueue_task("create_report", report)
     
     return {"message": "Report submitted successfully", "report_id": report_id}
 
@@ -685,6 +2635,9 @@ async def block_user(user_id: str, current_user: User = Depends(require_auth)):
         {"user_id": current_user.user_id},
         {"$addToSet": {"blocked_users": user_id}}
     )
+    await add_block(current_user.user_id, user_id)
+    await bump_versions(f"matches:{current_user.user_id}", f"matches:{user_id}")
+    await schedule_match_warmup(current_user.user_id)
     
     return {"message": "User blocked successfully"}
 
@@ -695,35 +2648,379 @@ async def unblock_user(user_id: str, current_user: User = Depends(require_auth))
         {"user_id": current_user.user_id},
         {"$pull": {"blocked_users": user_id}}
     )
+    await remove_block(current_user.user_id, user_id)
+    await bump_versions(f"matches:{current_user.user_id}", f"matches:{user_id}")
+    await schedule_match_warmup(current_user.user_id)
     
     return {"message": "User unblocked successfully"}
 
+# ==================== TASK QUEUE ====================
+
+# Non-interactive work is queued in db.tasks and run by a pool of task_worker coroutines, inside
+# the API (TASK_WORKERS per process) or in worker.py. A claimed task stays hidden for
+# TASK_VISIBILITY_TIMEOUT seconds, renewed by a heartbeat while its handler runs; if the worker
+# dies it becomes visible again, so handlers must be safe to run more than once.
+
+class TaskRejected(Exception):
+    """Raised by a handler for input that can never succeed; the task fails without retries"""
+
+TASK_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {}
+
+def task_handler(kind: str):
+    """Register the coroutine that runs tasks of this kind"""
+    def register(fn):
+        TASK_HANDLERS[kind] = fn
+        return fn
+    return register
+
+async def ensure_task_indexes():
+    """Indexes for the claim scan, deduplication and expiry of failed tasks"""
+    await db.tasks.create_index([("state", ASCENDING), ("available_at", ASCENDING)])
+    await db.tasks.create_index(
+        [("dedupe_key", ASCENDING), ("state", ASCENDING)],
+        partialFilterExpression={"dedupe_key": {"$exists": True}}
+    )
+    await db.tasks.create_index("finished_at", expireAfterSeconds=TASK_FAILED_RETENTION_DAYS * 86400)
+
+async def enqueue_task(kind: str, payload: Dict[str, Any], dedupe_key: Optional[str] = None) -> str:
+    """Queue a task; with a dedupe_key, a task of the same key still waiting is updated instead"""
+    now = datetime.now(timezone.utc)
+    fields = {
+        "task_id": f"task_{uuid.uuid4().hex[:12]}",
+        "kind": kind,
+        "attempts": 0,
+        "available_at": now,
+        "created_at": now,
+    }
+    if dedupe_key is None:
+        await db.tasks.insert_one({**fields, "state": "queued", "payload": payload})
+        return fields["task_id"]
+
+    task = await db.tasks.find_one_and_update(
+        {"dedupe_key": dedupe_key, "state": "queued"},
+        {"$set": {"payload": payload}, "$setOnInsert": fields},
+        upsert=True,
+        projection={"_id": 0, "task_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return task["task_id"]
+
+async def claim_task() -> Optional[Dict[str, Any]]:
+    """Lease the oldest due task (or one whose lease expired) that this process can run"""
+    now = datetime.now(timezone.utc)
+    return await db.tasks.find_one_and_update(
+        {
+            "kind": {"$in": list(TASK_HANDLERS)},
+            "$or": [
+                {"state": "queued", "available_at": {"$lte": now}},
+                {"state": "running", "lease_until": {"$lt": now}},
+            ],
+        },
+        {
+            "$set": {
+                "state": "running",
+                "owner": WORKER_ID,
+                "claim": uuid.uuid4().hex,
+                "lease_until": now + timedelta(seconds=TASK_VISIBILITY_TIMEOUT),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("available_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def keep_task_leased(task: Dict[str, Any]):
+    """Push the lease forward while the handler is still running"""
+    while True:
+        await asyncio.sleep(TASK_VISIBILITY_TIMEOUT / 3)
+        await db.tasks.update_one(
+            {"_id": task["_id"], "claim": task["claim"]},
+            {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=TASK_VISIBILITY_TIMEOUT)}}
+        )
+
+async def run_task(task: Dict[str, Any]):
+    """Run one claimed task, then delete it, schedule a retry with backoff or mark it failed"""
+    error = None
+    if task["attempts"] > TASK_MAX_ATTEMPTS:
+        # Its worker kept dying mid-task
+        outcome, error = "rejected", "lease expired too many times"
+    else:
+        heartbeat = asyncio.create_task(keep_task_leased(task))
+        started = time.perf_counter()
+        try:
+            await TASK_HANDLERS[task["kind"]](task["payload"])
+            outcome = "ok"
+        except TaskRejected as e:
+            outcome, error = "rejected", str(e)
+        except Exception as e:
+            outcome, error = "error", repr(e)
+        finally:
+            heartbeat.cancel()
+            TASK_SECONDS.labels(task["kind"]).observe(time.perf_counter() - started)
+    TASKS_RUN.labels(kind=task["kind"], result=outcome).inc()
+
+    now = datetime.now(timezone.utc)
+    mine = {"_id": task["_id"], "claim": task["claim"]}
+    released = {"claim": "", "owner": "", "lease_until": ""}
+    if outcome == "ok":
+        await db.tasks.delete_one(mine)
+    elif outcome == "error" and task["attempts"] < TASK_MAX_ATTEMPTS:
+        # Exponential backoff with full jitter, as for auth retries
+        delay = random.uniform(0, TASK_RETRY_BASE_DELAY * 2 ** task["attempts"])
+        logger.warning(f"Task {task['task_id']} ({task['kind']}) failed, retrying in {delay:.0f}s: {error}")
+        await db.tasks.update_one(mine, {
+            "$set": {"state": "queued", "available_at": now + timedelta(seconds=delay), "last_error": error},
+            "$unset": released,
+        })
+    else:
+        logger.error(f"Task {task['task_id']} ({task['kind']}) failed for good: {error}")
+        await db.tasks.update_one(mine, {
+            "$set": {"state": "failed", "last_error": error, "finished_at": now},
+            "$unset": released,
+        })
+
+async def task_worker():
+    """Claim and run tasks one at a time, polling while the queue is empty"""
+    while True:
+        try:
+            task = await claim_task()
+            if task is not None:
+                await run_task(task)
+                continue
+        except Exception as e:
+            logger.error(f"Task worker error: {e}")
+        await asyncio.sleep(TASK_POLL_INTERVAL)
+
+async def run_task_workers(concurrency: int):
+    """Run `concurrency` task workers until cancelled"""
+    await asyncio.gather(*(task_worker() for _ in range(concurrency)))
+
+def normalize_image(data_url: str, max_side: int) -> str:
+    """Decode a base64 upload and re-encode it as a JPEG data URL no larger than max_side"""
+    _, _, encoded = data_url.rpartition(",")
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except ValueError:
+        raise TaskRejected("image is not valid base64")
+    if Image is None:
+        return data_url
+
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            if image.format == "JPEG" and max(image.size) <= max_side:
+                return data_url
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((max_side, max_side))
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, OSError) as e:
+        raise TaskRejected(f"unreadable image: {e}")
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode()
+
+@task_handler("verify_id")
+async def process_id_verification(payload: Dict[str, Any]):
+    """Check and shrink a user's pending ID image, then mark them verified"""
+    verification = await db.id_verifications.find_one({"_id": payload["user_id"], "status": "pending"})
+    if verification is None:  # already handled by an earlier run
+        return
+    
+    # Only settle the upload this run checked; a newer one is queued as its own task
+    this_upload = {"_id": payload["user_id"], "submitted_at": verification["submitted_at"]}
+    try:
+        image = await asyncio.to_thread(normalize_image, verification["image"], ID_IMAGE_MAX_SIDE)
+    except TaskRejected:
+        await db.id_verifications.update_one(this_upload, {"$set": {"status": "rejected"}, "$unset": {"image": ""}})
+        raise
+    await db.users.update_one(
+        {"user_id": payload["user_id"]},
+        {"$set": {"id_verification_image": image, "verified": True}}
+    )
+    await db.id_verifications.update_one(this_upload, {"$set": {"status": "verified"}, "$unset": {"image": ""}})
+    await bump_profile_versions(payload["user_id"])
+
+@task_handler("process_profile_images")
+async def process_profile_images(payload: Dict[str, Any]):
+    """Shrink newly uploaded profile images, dropping any that cannot be read"""
+    processed = []
+    for data_url in payload["images"]:
+        try:
+            processed.append(await asyncio.to_thread(normalize_image, data_url, PROFILE_IMAGE_MAX_SIDE))
+        except TaskRejected as e:
+            logger.warning(f"Dropping profile image of {payload['user_id']}: {e}")
+    if processed == payload["images"]:
+        return
+
+    # Only replace the set this task was queued for; a newer upload has its own task
+    result = await db.users.update_one(
+        {"user_id": payload["user_id"], "profile_images": payload["images"]},
+        {"$set": {"profile_images": processed}}
+    )
+    if result.modified_count:
+        await bump_profile_versions(payload["user_id"])
+
+@task_handler("create_report")
+async def process_report(payload: Dict[str, Any]):
+    """Record a report (keyed by report_id so a retry does not duplicate it)"""
+    await db.reports.update_one(
+        {"report_id": payload["report_id"]},
+        {"$setOnInsert": payload},
+        upsert=True
+    )
+
+async def schedule_match_warmup(user_id: str):
+    """Recompute a user's matches in the background after something that changes them"""
+    await enqueue_task("recompute_matches", {"user_id": user_id}, dedupe_key=f"matches:{user_id}")
+
+@task_handler("recompute_matches")
+async def recompute_matches(payload: Dict[str, Any]):
+    """Compute a user's first Discover page ahead of time, keep it as a snapshot and push it as matches_ready"""
+    user_doc = await db.users.find_one({"user_id": payload["user_id"]}, {"_id": 0})
+    if not user_doc:
+        return
+    # Versions are read before the matches: a write landing in between leaves the snapshot stale, never
+    # fresh with data it does not hold
+    user_routes = await load_active_routes(payload["user_id"])
+    versions = await load_versions(match_version_keys(payload["user_id"], user_routes))
+
+    matches, next_position = await compute_matches(User(**user_doc), user_routes=user_routes, versions=versions)
+    # Only the keys of the cells that were read, so writes beyond them leave the snapshot fresh
+    keys = await match_dependencies(payload["user_id"], user_routes, versions)
+    version = versions_digest(keys, versions)
+    await db.match_snapshots.replace_one(
+        {"_id": payload["user_id"]},
+        {
+            "keys": keys,
+            "versions": [versions.get(key, 0) for key in keys],
+            "matches": matches,
+            "next_position": list(next_position) if next_position else None,
+            "computed_at": datetime.now(timezone.utc),
+        },
+        upsert=True
+    )
+    await emit_event('matches_ready', {"matches": matches, "version": version}, room=payload["user_id"])
+
+async def load_match_snapshot(user_id: str) -> Optional[Dict[str, Any]]:
+    """The precomputed first page, with the version keys it depends on and their versions when it was
+    computed, if the queue produced one"""
+    return await read_db.match_snapshots.find_one({"_id": user_id, "versions": {"$exists": True}})
+
 # ==================== SOCKET.IO EVENTS ====================
 
+def socket_event_metrics(handler):
+    """Count and time a Socket.IO event handler"""
+    @functools.wraps(handler)
+    async def wrapper(sid, data):
+        SOCKET_EVENTS.labels(handler.__name__).inc()
+        started = time.perf_counter()
+        try:
+            return await handler(sid, data)
+        finally:
+            SOCKET_EVENT_SECONDS.labels(handler.__name__).observe(time.perf_counter() - started)
+    return wrapper
+
+async def emit_event(event: str, data: Dict[str, Any], room: str):
+    """Emit through the metrics so per-event outbound rates are visible"""
+    SOCKET_EMITS.labels(event).inc()
+    await sio.emit(event, data, room=room)
+
+async def drop_slow_consumer(eio_sid: str, eio_socket, depth: int):
+    """Abort a client that stopped reading and free the packets queued for it"""
+    logger.warning(f"Disconnecting slow Socket.IO client {eio_sid}: {depth} packets queued")
+    SOCKET_SLOW_DISCONNECTS.inc()
+    await eio_socket.close(wait=False, abort=True)
+    while not eio_socket.queue.empty():
+        eio_socket.queue.get_nowait()
+        eio_socket.queue.task_done()
+    eio_socket.queue.put_nowait(None)  # let the writer task exit
+
+async def monitor_socket_queues():
+    """Sample every client's outbound queue and drop the ones that exceed SOCKET_MAX_QUEUE"""
+    while True:
+        await asyncio.sleep(SOCKET_QUEUE_CHECK_INTERVAL)
+        deepest = 0
+        for eio_sid, eio_socket in list(sio.eio.sockets.items()):
+            depth = eio_socket.queue.qsize()
+            SOCKET_QUEUE_DEPTH.observe(depth)
+            deepest = max(deepest, depth)
+            if depth > SOCKET_MAX_QUEUE and not eio_socket.closed:
+                try:
+                    await drop_slow_consumer(eio_sid, eio_socket, depth)
+                except Exception as e:
+                    logger.error(f"Failed to drop slow client {eio_sid}: {e}")
+        SOCKET_QUEUE_MAX.set(deepest)
+
+async def monitor_event_loop_lag():
+    """Measure how late the loop wakes us up; admission control sheds load when it grows"""
+    global event_loop_lag
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_PROBE_INTERVAL)
+        event_loop_lag = max(0.0, time.perf_counter() - started - LOOP_LAG_PROBE_INTERVAL)
+        EVENT_LOOP_LAG.set(event_loop_lag)
+
+event_loop_lag = 0.0
+
+def socket_session_token(environ: Dict[str, Any], auth: Any) -> Optional[str]:
+    """Session token from the Socket.IO auth payload ({"token": ...}), a bearer header or the session cookie"""
+    if isinstance(auth, dict) and auth.get("token"):
+        return auth["token"]
+    auth_header = environ.get("HTTP_AUTHORIZATION", "")
+    if auth_header.startswith("Bearer "):
+        return auth_header.replace("Bearer ", "")
+    cookies = SimpleCookie(environ.get("HTTP_COOKIE", ""))
+    return cookies["session_token"].value if "session_token" in cookies else None
+
+async def socket_user_id(sid: str) -> Optional[str]:
+    """The user the socket authenticated as on connect (None for anonymous sockets)"""
+    return (await sio.get_session(sid)).get("user_id")
+
 @sio.event
-async def connect(sid, environ):
-    logger.info(f"Client connected: {sid}")
+async def connect(sid, environ, auth=None):
+    SOCKET_EVENTS.labels('connect').inc()
+    SOCKET_CONNECTIONS.inc()
+    session_token = socket_session_token(environ, auth)
+    user = await load_session_user(session_token) if session_token else None
+    if user:
+        await sio.save_session(sid, {"user_id": user.user_id})
+        await sio.enter_room(sid, user.user_id)
+    logger.info(f"Client connected: {sid} ({user.user_id if user else 'anonymous'})")
 
 @sio.event
 async def disconnect(sid):
+    SOCKET_EVENTS.labels('disconnect').inc()
+    SOCKET_CONNECTIONS.dec()
     logger.info(f"Client disconnected: {sid}")
 
 @sio.event
+@socket_event_metrics
 async def join_room(sid, data):
-    """Join a room (user's own user_id room)"""
-    user_id = data.get("user_id")
-    if user_id:
-        await sio.enter_room(sid, user_id)
-        logger.info(f"User {user_id} joined room")
+    """Join the socket's own user room (only the user it authenticated as on connect)"""
+    user_id = await socket_user_id(sid)
+    if not user_id:
+        return {"error": "Not authenticated"}
+    if data.get("user_id", user_id) != user_id:
+        return {"error": "Forbidden"}
+    await sio.enter_room(sid, user_id)
+    logger.info(f"User {user_id} joined room")
 
 @sio.event
+@socket_event_metrics
 async def send_message(sid, data):
-    """Send a real-time message"""
+    """Send a real-time message as the socket's authenticated user (a sender_id in the payload is ignored)"""
+    sender_id = await socket_user_id(sid)
+    if not sender_id:
+        await emit_event('unauthorized', {"event": "send_message"}, room=sid)
+        return
+    wait = await check_rate_limit("messaging", sender_id)
+    if wait > 0:
+        await emit_event('rate_limited', {"event": "send_message", "retry_after": round(wait, 1)}, room=sid)
+        return
+    
     message_id = f"msg_{uuid.uuid4().hex[:12]}"
     
     message = {
         "message_id": message_id,
-        "sender_id": data["sender_id"],
+        "sender_id": sender_id,
         "receiver_id": data["receiver_id"],
         "content": data["content"],
         "timestamp": datetime.now(timezone.utc),
@@ -731,26 +3028,220 @@ async def send_message(sid, data):
     }
     
     # Save to database
-    await db.messages.insert_one(message)
+    await store_message(message)
+    await notify_new_message(message)
     
     # Emit to receiver
     message["timestamp"] = message["timestamp"].isoformat()
-    await sio.emit('receive_message', message, room=data["receiver_id"])
+    await emit_event('receive_message', message, room=data["receiver_id"])
     
     # Confirm to sender
-    await sio.emit('message_sent', message, room=sid)
+    await emit_event('message_sent', message, room=sid)
 
 # Include the router in the main app
 app.include_router(api_router)
 
+class CompressionMiddleware:
+    """Brotli (or gzip) above COMPRESSION_MIN_SIZE, except for NDJSON streams that must flush per row"""
+    
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and NDJSON_MEDIA_TYPE not in Headers(scope=scope).get("accept", ""):
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+
+class InstrumentationMiddleware:
+    """Per-route latency and Mongo time histograms, reported back in a Server-Timing header"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        timing = RequestTiming()
+        token = request_timing.set(timing)
+        started = time.perf_counter()
+        scope.setdefault("state", {})["received_at"] = time.monotonic()  # see data_etag
+        status = 500
+        
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                server_timing = (
+                    f'app;dur={elapsed_ms:.1f}, '
+                    f'db;dur={timing.db_seconds * 1000:.1f};desc="{timing.db_commands} queries"'
+                )
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"server-timing", server_timing.encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timing.reset(token)
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            HTTP_REQUEST_SECONDS.labels(method, route_path, str(status)).observe(time.perf_counter() - started)
+            HTTP_REQUEST_DB_SECONDS.labels(method, route_path).observe(timing.db_seconds)
+            HTTP_REQUEST_DB_COMMANDS.labels(method, route_path).observe(timing.db_commands)
+
+app.add_middleware(InstrumentationMiddleware)
+
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def profile_token_valid(token: Optional[str]) -> bool:
+    return bool(PROFILING_TOKEN and token and hmac.compare_digest(token, PROFILING_TOKEN))
+
+class ProfilingMiddleware:
+    """Profile a single request when it carries X-Profile: <token> or ?profile=<token>.
+
+    Output lands in PROFILE_DIR as <request id>.speedscope.json (pyinstrument) or
+    <request id>.pstats (cProfile fallback), and the id is returned in X-Profile-Id.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = Headers(scope=scope)
+        token = headers.get("x-profile")
+        if token is None:
+            token = Request(scope).query_params.get("profile")
+        if not profile_token_valid(token):
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = headers.get("x-request-id", "")
+        profile_id = request_id if PROFILE_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+        
+        if Profiler is not None:
+            # async_mode only samples this request's task, not its neighbours on the loop
+            profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                profiler.stop()
+                output = profiler.output(SpeedscopeRenderer())
+                await asyncio.to_thread(self._write, f"{profile_id}.speedscope.json", output)
+        else:
+            # cProfile is deterministic and sees everything on the loop while the request runs
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                profiler.disable()
+                PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+                await asyncio.to_thread(profiler.dump_stats, PROFILE_DIR / f"{profile_id}.pstats")
+        
+        logger.info(f"Stored request profile {profile_id} for {scope['method']} {scope['path']}")
+    
+    @staticmethod
+    def _write(name: str, output: str):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        (PROFILE_DIR / name).write_text(output)
+
+class AdmissionControlMiddleware:
+    """Answer 429 + Retry-After while too many requests are in flight or the event loop is lagging"""
+    
+    EXEMPT_PATHS = ("/metrics",)
+    
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+    
+    def shed_reason(self) -> Optional[str]:
+        if ADMISSION_MAX_IN_FLIGHT and self.in_flight >= ADMISSION_MAX_IN_FLIGHT:
+            return "in_flight"
+        if ADMISSION_MAX_LOOP_LAG and event_loop_lag > ADMISSION_MAX_LOOP_LAG:
+            return "loop_lag"
+        return None
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        reason = self.shed_reason()
+        if reason:
+            REQUESTS_SHED.labels(reason).inc()
+            response = ORJSONResponse(
+                {"detail": "Server busy, retry shortly"}, status_code=429, headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        
+        self.in_flight += 1
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            REQUESTS_IN_FLIGHT.dec()
+
+if PROFILING_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+    
+    @app.get("/admin/profiles/{profile_id}", include_in_schema=False)
+    async def get_profile(profile_id: str, request: Request):
+        """Download a stored request profile"""
+        if not profile_token_valid(request.headers.get("x-profile")):
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            raise HTTPException(status_code=404, detail="Profile not found")
+        
+        for name in (f"{profile_id}.speedscope.json", f"{profile_id}.pstats"):
+            path = PROFILE_DIR / name
+            if path.exists():
+                return FileResponse(path, filename=name)
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus scrape endpoint"""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+app.add_middleware(AdmissionControlMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Export and import bulk snapshots of users, routes, connections and messages
+A snapshot is a directory holding a manifest.json and, per collection, numbered chunk files of
+--chunk-size documents: gzip-compressed NDJSON (Extended JSON for dates, ObjectIds and binary data), or Arrow
+IPC files with --format arrow (needs pyarrow). Collections are exported and imported in parallel;
+imports use unordered insert_many batches, skip documents that already exist (so an interrupted
+import can simply be re-run), build the app's indexes afterwards and bump every data version so
+cached ETags and match snapshots are discarded.
+
+Arrow has no ObjectId type, so Arrow snapshots keep ObjectId _ids as their 12 bytes, and fields a
+document did not have come back absent rather than null.
+
+Usage (from backend/):
+  python snapshot.py export DIR [--format ndjson|arrow] [--chunk-size 50000] [--collections users routes]
+  python snapshot.py import DIR [--drop] [--batch-size 1000] [--concurrency 4] [--collections users routes]
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import orjson
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from server import (
+    client, fast_db, read_db, bump_versions, ALL_REGIONS_VERSION_KEY, DISCOVERY_VERSION_KEY, ensure_block_indexes,
+    ensure_message_indexes, ensure_notification_indexes, ensure_place_indexes, ensure_task_indexes,
+)
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # NDJSON snapshots need nothing beyond the server's requirements
+    pyarrow = None
+
+# Routes reference places; messages live in messages, message_buckets or message_archive
+# depending on MESSAGE_STORAGE and age, so all three are exported
+COLLECTIONS = ["users", "routes", "places", "connections", "messages", "message_buckets", "message_archive"]
+SUFFIXES = {"ndjson": ".ndjson.gz", "arrow": ".arrow"}
+DUPLICATE_KEY = 11000
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, bytes):  # e.g. message_archive's compressed chunks
+        return {"$binary": base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if "$date" in value:
+                return datetime.fromisoformat(value["$date"])
+            if "$oid" in value:
+                return ObjectId(value["$oid"])
+            if "$binary" in value:
+                return base64.b64decode(value["$binary"])
+        return {key: decode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def write_ndjson(path, docs):
+    lines = [orjson.dumps(doc, default=encode_value, option=orjson.OPT_PASSTHROUGH_DATETIME) for doc in docs]
+    with gzip.open(path, "wb", compresslevel=3) as out:
+        out.write(b"\n".join(lines) + b"\n")
+
+
+def read_ndjson(path):
+    with gzip.open(path, "rb") as source:
+        return [decode_value(orjson.loads(line)) for line in source if line.strip()]
+
+
+def write_arrow(path, docs):
+    for doc in docs:
+        if isinstance(doc.get("_id"), ObjectId):
+            doc["_id"] = doc["_id"].binary
+    # Columns over the union of fields, each type inferred from every document rather than the first
+    fields = list(dict.fromkeys(field for doc in docs for field in doc))
+    table = pyarrow.table({field: [doc.get(field) for doc in docs] for field in fields})
+    options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+    with pyarrow.ipc.new_file(str(path), table.schema, options=options) as out:
+        out.write_table(table)
+
+
+def read_arrow(path):
+    with pyarrow.ipc.open_file(str(path)) as source:
+        rows = source.read_all().to_pylist()
+    docs = [{field: value for field, value in row.items() if value is not None} for row in rows]
+    for doc in docs:
+        if isinstance(doc.get("_id"), bytes):
+            doc["_id"] = ObjectId(doc["_id"])
+    return docs
+
+
+WRITERS = {"ndjson": write_ndjson, "arrow": write_arrow}
+READERS = {"ndjson": read_ndjson, "arrow": read_arrow}
+
+
+async def export_collection(directory, name, fmt, chunk_size):
+    files = []
+    documents = 0
+    pending = None
+
+    async def flush(docs):
+        nonlocal pending
+        path = directory / f"{name}-{len(files):05d}{SUFFIXES[fmt]}"
+        files.append(path.name)
+        # Compress one chunk in a thread while the cursor keeps reading the next
+        if pending:
+            await pending
+        pending = asyncio.create_task(asyncio.to_thread(WRITERS[fmt], path, docs))
+
+    chunk = []
+    async for doc in read_db[name].find({}, batch_size=min(chunk_size, 10000)):
+        chunk.append(doc)
+        documents += 1
+        if len(chunk) >= chunk_size:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+    if pending:
+        await pending
+    return {"documents": documents, "files": files}
+
+
+async def export_snapshot(directory, fmt, chunk_size, collections):
+    directory.mkdir(parents=True, exist_ok=True)
+    results = await asyncio.gather(*(export_collection(directory, name, fmt, chunk_size) for name in collections))
+    manifest = {
+        "format": fmt,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "collections": dict(zip(collections, results)),
+    }
+    # Written last, so a snapshot without a manifest is known to be incomplete
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest["collections"]
+
+
+async def insert_batch(collection, docs):
+    try:
+        result = await collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as exc:
+        # Documents already present are skipped, so re-running an interrupted import resumes it
+        if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+            raise
+        return exc.details["nInserted"]
+
+
+async def import_collection(directory, name, fmt, files, batch_size, concurrency, drop):
+    collection = fast_db[name]
+    if drop:
+        await collection.drop()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    inserted = 0
+
+    async def worker():
+        nonlocal inserted
+        while (batch := await queue.get()) is not None:
+            inserted += await insert_batch(collection, batch)
+
+    async def reader():
+        for file in files:
+            docs = await asyncio.to_thread(READERS[fmt], directory / file)
+            for i in range(0, len(docs), batch_size):
+                await queue.put(docs[i:i + batch_size])
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    tasks = [asyncio.create_task(reader())] + [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        # The first failed insert stops the reader too, instead of leaving it blocked on a full queue
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return inserted
+
+
+async def import_snapshot(directory, batch_size, concurrency, drop, collections):
+    manifest = json.loads((directory / "manifest.json").read_text())
+    fmt = manifest["format"]
+    if fmt == "arrow" and pyarrow is None:
+        raise SystemExit("This snapshot is in Arrow format, which needs pyarrow (pip install pyarrow)")
+    collections = collections or list(manifest["collections"])
+    results = await asyncio.gather(*(
+        import_collection(directory, name, fmt, manifest["collections"][name]["files"], batch_size, concurrency, drop)
+        for name in collections
+    ))
+    # Building indexes after the load is cheaper than maintaining them per insert
+    await ensure_block_indexes()
+    await ensure_message_indexes()
+    await ensure_place_indexes()
+    await ensure_notification_indexes()
+    await ensure_task_indexes()
+    await fast_db.data_versions.update_many({}, {"$inc": {"v": 1}})
+    await bump_versions(DISCOVERY_VERSION_KEY, ALL_REGIONS_VERSION_KEY)
+    return dict(zip(collections, results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the database to a snapshot directory")
+    export_parser.add_argument("directory", type=Path)
+    export_parser.add_argument("--format", choices=sorted(WRITERS), default="ndjson")
+    export_parser.add_argument("--chunk-size", type=int, default=50000, help="documents per chunk file")
+    export_parser.add_argument("--collections", nargs="+", default=COLLECTIONS)
+    import_parser = commands.add_parser("import", help="load a snapshot directory into the database")
+    import_parser.add_argument("directory", type=Path)
+    import_parser.add_argument("--drop", action="store_true", help="drop each collection before loading it")
+    import_parser.add_argument("--batch-size", type=int, default=1000, help="documents per insert_many")
+    import_parser.add_argument("--concurrency", type=int, default=4, help="insert batches in flight per collection")
+    import_parser.add_argument("--collections", nargs="+", help="subset of the snapshot's collections")
+    args = parser.parse_args()
+    if args.command == "export" and args.format == "arrow" and pyarrow is None:
+        parser.error("--format arrow needs pyarrow (pip install pyarrow)")
+
+    started = time.perf_counter()
+    try:
+        if args.command == "export":
+            results = asyncio.run(export_snapshot(args.directory, args.format, args.chunk_size, args.collections))
+            counts = {name: result["documents"] for name, result in results.items()}
+        else:
+            counts = asyncio.run(import_snapshot(
+                args.directory, args.batch_size, args.concurrency, args.drop, args.collections
+            ))
+    finally:
+        client.close()
+    elapsed = time.perf_counter() - started
+    verb = "Exported" if args.command == "export" else "Imported"
+    print(f"{verb} {sum(counts.values())} documents in {elapsed:.1f}s: "
+          + ", ".join(f"{name} {count}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads these at import time; the tests never reach a real MongoDB
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "routebuddy_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """An in-memory database behind every server handle"""
+    database = AsyncMongoMockClient()[os.environ["DB_NAME"]]
+    for handle in ("db", "read_db", "fast_db"):
+        monkeypatch.setattr(server, handle, database)
+    return database
@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+
+import auth_stub
+import server
+
+pytestmark = pytest.mark.anyio
+
+SESSION = {"id": "user_a", "email": "a@example.com", "name": "A", "picture": None, "session_token": "token_a"}
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """Point fetch_session_data at a scripted provider: returns (statuses still to answer, session ids it was called with)"""
+    script = []
+    calls = []
+
+    async def handler(request):
+        calls.append(request.headers["X-Session-ID"])
+        status = script.pop(0) if script else 200
+        if status == "hang":
+            await asyncio.Event().wait()
+        if status == "drop":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(status, json=SESSION if status == 200 else {"detail": "error"})
+
+    monkeypatch.setattr(server, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(server, "auth_breaker", server.CircuitBreaker(failure_threshold=2, reset_timeout=30))
+    monkeypatch.setattr(server, "AUTH_RETRIES", 2)
+    monkeypatch.setattr(server, "AUTH_RETRY_BASE_DELAY", 0)
+    return script, calls
+
+
+def cool_down(breaker):
+    """Move an open breaker past its reset timeout"""
+    breaker.opened_at -= breaker.reset_timeout
+
+
+async def test_transient_errors_are_retried(provider):
+    script, calls = provider
+    script.extend([503, "drop"])
+    assert await server.fetch_session_data("sess") == SESSION
+    assert len(calls) == 3
+    assert server.auth_breaker.state == "closed" and server.auth_breaker.failures == 0
+
+
+async def test_rejected_session_is_not_retried(provider):
+    script, calls = provider
+    script.append(404)
+    with pytest.raises(httpx.HTTPStatusError):
+        await server.fetch_session_data("sess")
+    assert len(calls) == 1
+    assert server.auth_breaker.state == "closed"
+
+
+async def test_breaker_opens_after_repeated_failures(provider):
+    script, calls = provider
+    breaker = server.auth_breaker
+    script.extend([503] * 3)
+    with pytest.raises(server.AuthProviderError):
+        await server.fetch_session_data("sess")
+    assert len(calls) == 3 and breaker.state == "closed"
+
+    script.extend([503] * 3)
+    with pytest.raises(server.AuthProviderError):
+        await server.fetch_session_data("sess")
+    assert breaker.state == "open"
+
+    # While open, calls fail fast without reaching the provider
+    with pytest.raises(server.AuthProviderError, match="circuit open"):
+        await server.fetch_session_data("sess")
+    assert len(calls) == 6
+
+
+async def test_half_open_probe_closes_on_success(provider):
+    script, calls = provider
+    breaker = server.auth_breaker
+    breaker.failures, breaker.opened_at = 2, server.time.monotonic()
+    cool_down(breaker)
+    assert breaker.state == "half-open"
+    assert await server.fetch_session_data("sess") == SESSION
+    assert breaker.state == "closed" and not breaker.probing
+
+
+async def test_half_open_probe_reopens_on_failure_and_lets_the_next_probe_out(provider):
+    script, calls = provider
+    breaker = server.auth_breaker
+    breaker.failures, breaker.opened_at = 2, server.time.monotonic()
+    cool_down(breaker)
+    script.extend([503] * 3)
+    with pytest.raises(server.AuthProviderError):
+        await server.fetch_session_data("sess")
+    assert breaker.state == "open" and not breaker.probing
+
+    cool_down(breaker)
+    assert await server.fetch_session_data("sess") == SESSION
+    assert breaker.state == "closed"
+
+
+async def test_cancelled_probe_is_released(provider):
+    script, calls = provider
+    breaker = server.auth_breaker
+    breaker.failures, breaker.opened_at = 2, server.time.monotonic()
+    cool_down(breaker)
+    script.append("hang")
+    probe = asyncio.ensure_future(server.fetch_session_data("sess"))
+    await asyncio.sleep(0.01)
+    # Only one probe at a time
+    with pytest.raises(server.AuthProviderError, match="circuit open"):
+        await server.fetch_session_data("sess")
+    probe.cancel()
+    await asyncio.gather(probe, return_exceptions=True)
+
+    assert not breaker.probing
+    assert await server.fetch_session_data("sess") == SESSION
+    assert breaker.state == "closed"
+
+
+async def test_stub_provider_answers_and_rejects(monkeypatch):
+    monkeypatch.setattr(server, "http_client", httpx.AsyncClient(transport=httpx.ASGITransport(app=auth_stub.stub_app)))
+    monkeypatch.setattr(server, "AUTH_API_URL", "http://auth/auth/v1/env/oauth/session-data")
+    monkeypatch.setattr(server, "auth_breaker", server.CircuitBreaker(failure_threshold=2, reset_timeout=30))
+    data = await server.fetch_session_data("sess_1")
+    assert data == await server.fetch_session_data("sess_1") and data["session_token"]
+    with pytest.raises(httpx.HTTPStatusError):
+        await server.fetch_session_data("invalid_1")
+    assert server.auth_breaker.state == "closed"
@@ -0,0 +1,315 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+import migrate_route_tiles
+import server
+from benchmarks.coalescing import make_request
+from benchmarks.fakedb import FakeDB
+from benchmarks.synthetic import generate_population
+from geo import geohash, via_tiles
+
+pytestmark = pytest.mark.anyio
+
+
+def route_doc(route_id, user_id, start, end, tiles=True):
+    doc = {
+        "route_id": route_id, "user_id": user_id,
+        "start_coords": {"lat": start[0], "lng": start[1]}, "end_coords": {"lat": end[0], "lng": end[1]},
+        "start_address": "Home", "end_address": "Work", "departure_time": "08:00",
+        "days_of_week": ["monday", "tuesday"], "active": True, "created_at": datetime.now(timezone.utc),
+    }
+    if tiles:
+        doc.update(start_tile=geohash(*start), end_tile=geohash(*end), via_tiles=via_tiles(start, end))
+    return doc
+
+
+@pytest.fixture
+def adaptive(mongo, monkeypatch):
+    monkeypatch.setattr(server, "MATCH_SEARCH", "adaptive")
+    monkeypatch.setattr(server, "untiled_routes_remain", True)
+    monkeypatch.setattr(server.hub_matcher, "cache", server.LRUCache(server.MATCH_HUB_CACHE_SIZE))
+    return mongo
+
+
+async def matched_users(viewer_route):
+    leg = server.route_legs(server.Route(**viewer_route))[0]
+    ranking = await server.search_nearby(leg)
+    return {route.user_id for route, _ in ranking.ranked}
+
+
+async def test_routes_without_tiles_still_match_until_migrated(adaptive):
+    home, work = (40.7000, -74.0000), (40.7500, -73.9800)
+    viewer = route_doc("route_viewer", "user_viewer", home, work)
+    await adaptive.routes.insert_many([
+        viewer,
+        route_doc("route_tiled", "user_tiled", (40.7010, -74.0005), (40.7505, -73.9795)),
+        route_doc("route_legacy", "user_legacy", (40.7005, -74.0010), (40.7495, -73.9805), tiles=False),
+    ])
+
+    assert await matched_users(viewer) >= {"user_tiled", "user_legacy"}
+    assert server.untiled_routes_remain
+
+    await adaptive.routes.update_one({"route_id": "route_legacy"}, {"$set": {
+        "start_tile": geohash(40.7005, -74.0010), "end_tile": geohash(40.7495, -73.9805),
+        "via_tiles": via_tiles((40.7005, -74.0010), (40.7495, -73.9805)),
+    }})
+    assert await matched_users(viewer) >= {"user_tiled", "user_legacy"}
+    # With every route tiled the scan is dropped for good
+    assert not server.untiled_routes_remain
+
+
+async def test_ranked_routes_fall_in_their_hubs_regions(monkeypatch):
+    fake = FakeDB()
+    _, routes, _ = generate_population(3000, seed=3)
+    await fake.routes.insert_many(routes)
+    monkeypatch.setattr(server, "read_db", fake)
+    monkeypatch.setattr(server, "untiled_routes_remain", False)
+
+    stored = {route["route_id"]: route for route in routes}
+    for route in routes[:40]:
+        leg = server.route_legs(server.Route(**route))[0]
+        hub = server.hub_key(leg)
+        ranking = await server.hub_matcher.score_hub(hub)
+        assert ranking.ranked
+        assert set(ranking.regions) <= set(server.hub_region_keys(hub[0]))
+        for other_route, _ in ranking.ranked:
+            # A change to any ranked route moves one of the keys the hub is cached under
+            assert server.route_region_keys(stored[other_route.route_id]) & set(ranking.regions)
+
+
+def commute(start, end, departure_time="08:00", return_time=None):
+    return server.RouteCreate(
+        start_coords=server.Coordinates(lat=start[0], lng=start[1]),
+        end_coords=server.Coordinates(lat=end[0], lng=end[1]),
+        start_address="Home", end_address="Work", departure_time=departure_time, return_time=return_time,
+        days_of_week=["monday"],
+    )
+
+
+async def add_users(db, *user_ids):
+    users = {}
+    for user_id in user_ids:
+        users[user_id] = server.User(user_id=user_id, email=f"{user_id}@example.com", name=user_id,
+                                     created_at=datetime.now(timezone.utc))
+        await db.users.insert_one(users[user_id].model_dump())
+    return users
+
+
+async def test_route_writes_only_rescore_hubs_in_their_regions(adaptive, monkeypatch):
+    users = await add_users(adaptive, "user_viewer", "user_near", "user_far")
+    scored = []
+    score_hub = server.hub_matcher.score_hub
+
+    async def counting_score_hub(key):
+        scored.append(key)
+        return await score_hub(key)
+
+    monkeypatch.setattr(server.hub_matcher, "score_hub", counting_score_hub)
+
+    async def viewer_matches():
+        matches, _ = await server.compute_matches(users["user_viewer"])
+        return {match["user_id"] for match in matches}
+
+    await server.create_route(commute((40.7000, -74.0000), (40.7500, -73.9800)), current_user=users["user_viewer"])
+    assert await viewer_matches() == set()
+    assert len(scored) == 1
+
+    # Boston is far outside every ring around the viewer's hub
+    far = await server.create_route(commute((42.3600, -71.0600), (42.3500, -71.0700)), current_user=users["user_far"])
+    assert await viewer_matches() == set()
+    assert len(scored) == 1
+
+    near = await server.create_route(commute((40.7010, -74.0005), (40.7505, -73.9795)), current_user=users["user_near"])
+    assert await viewer_matches() == {"user_near"}
+    assert len(scored) == 2
+
+    await server.update_route(near.route_id, commute((42.3610, -71.0610), (42.3510, -71.0710)),
+                              current_user=users["user_near"])
+    assert await viewer_matches() == set()
+    await server.delete_route(far.route_id, current_user=users["user_far"])
+    assert await viewer_matches() == set()
+    assert len(scored) == 3
+
+
+async def test_match_snapshot_stays_fresh_until_a_write_in_its_regions(adaptive, monkeypatch):
+    users = await add_users(adaptive, "user_viewer", "user_near", "user_across_town", "user_far", "user_other")
+    await server.create_route(commute((40.7000, -74.0000), (40.7500, -73.9800)), current_user=users["user_viewer"])
+    await server.create_route(commute((40.7010, -74.0005), (40.7505, -73.9795)), current_user=users["user_near"])
+    across_town = await server.create_route(commute((40.6000, -73.9000), (40.6200, -73.8800)),
+                                            current_user=users["user_across_town"])
+    far = await server.create_route(commute((42.3600, -71.0600), (42.3500, -71.0700)), current_user=users["user_far"])
+    # One match is enough, so the viewer's search stops at the first ring
+    monkeypatch.setattr(server, "MATCH_TARGET_COUNT", 1)
+    monkeypatch.setitem(server.RATE_LIMITS, "discovery", "off")
+    monkeypatch.setattr(server, "emit_event", lambda *args, **kwargs: asyncio.sleep(0))
+    await server.recompute_matches({"user_id": "user_viewer"})
+    await adaptive.tasks.delete_many({})
+
+    computed = []
+    compute_matches = server.compute_matches
+
+    async def counting_compute_matches(*args, **kwargs):
+        computed.append(args)
+        return await compute_matches(*args, **kwargs)
+
+    monkeypatch.setattr(server, "compute_matches", counting_compute_matches)
+
+    async def discover():
+        response = await server.get_matches(make_request("/api/discovery/matches"), current_user=users["user_viewer"])
+        return response.headers["etag"], [match["user_id"] for match in server.orjson.loads(response.body)]
+
+    etag, matches = await discover()
+    assert matches == ["user_near"] and not computed
+
+    # Writes outside the cells the viewer's hub read leave the snapshot and the ETag alone
+    await server.update_route(across_town.route_id, commute((40.6010, -73.9010), (40.6210, -73.8810)),
+                              current_user=users["user_across_town"])
+    await server.update_route(far.route_id, commute((42.3610, -71.0610), (42.3510, -71.0710)),
+                              current_user=users["user_far"])
+    await server.bump_profile_versions("user_far")
+    await server.block_user("user_far", current_user=users["user_other"])
+    assert await discover() == (etag, ["user_near"]) and not computed
+
+    viewer_warmup = {"kind": "recompute_matches", "payload": {"user_id": "user_viewer"}}
+    assert not await adaptive.tasks.find_one(viewer_warmup)
+
+    # A matched user's profile change leaves the page stale: it is served until MATCH_SNAPSHOT_MAX_AGE
+    # while a recomputation is queued
+    await server.bump_profile_versions("user_near")
+    assert await discover() == (etag, ["user_near"]) and not computed
+    assert await adaptive.tasks.find_one(viewer_warmup)
+    monkeypatch.setattr(server, "MATCH_SNAPSHOT_MAX_AGE", 0)
+    changed, matches = await discover()
+    assert changed != etag and matches == ["user_near"] and len(computed) == 1
+
+    # The user's own changes never get a stale page
+    monkeypatch.setattr(server, "MATCH_SNAPSHOT_MAX_AGE", 3600)
+    await server.block_user("user_near", current_user=users["user_viewer"])
+    assert (await discover())[1] == [] and len(computed) == 2
+
+
+async def test_every_route_write_queues_a_match_warmup(adaptive):
+    users = await add_users(adaptive, "user_viewer")
+    warmup = {"kind": "recompute_matches", "payload": {"user_id": "user_viewer"}}
+    route = await server.create_route(commute((40.7000, -74.0000), (40.7500, -73.9800)), current_user=users["user_viewer"])
+    assert await adaptive.tasks.find_one(warmup)
+
+    await adaptive.tasks.delete_many({})
+    await server.update_route(route.route_id, commute((40.7010, -74.0005), (40.7505, -73.9795)),
+                              current_user=users["user_viewer"])
+    assert await adaptive.tasks.find_one(warmup)
+
+    # The snapshot is skipped after the user's own route change, so without this Discover computes on the request
+    await adaptive.tasks.delete_many({})
+    await server.delete_route(route.route_id, current_user=users["user_viewer"])
+    assert await adaptive.tasks.find_one(warmup)
+
+
+async def test_route_times_are_stored_zero_padded(adaptive, monkeypatch):
+    users = await add_users(adaptive, "user_viewer")
+    route = await server.create_route(commute((40.7000, -74.0000), (40.7500, -73.9800), departure_time="8:00"),
+                                      current_user=users["user_viewer"])
+    assert route.departure_time == "08:00"
+    assert (await adaptive.routes.find_one({"route_id": route.route_id}))["departure_time"] == "08:00"
+
+    monkeypatch.setitem(server.app.dependency_overrides, server.require_auth, lambda: users["user_viewer"])
+    body = commute((40.7000, -74.0000), (40.7500, -73.9800)).model_dump()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        for departure_time in ("8am", "24:00", "08:60", ""):
+            response = await client.post("/api/routes/create", json={**body, "departure_time": departure_time})
+            assert response.status_code == 422, departure_time
+    assert await adaptive.routes.count_documents({}) == 1
+
+
+async def test_unpadded_times_are_found_once_migrated(adaptive, monkeypatch):
+    home, work = (40.7000, -74.0000), (40.7500, -73.9800)
+    viewer = route_doc("route_viewer", "user_viewer", home, work)
+    legacy = {**route_doc("route_legacy", "user_legacy", (40.7010, -74.0005), (40.7505, -73.9795)),
+              "departure_time": "8:05"}
+    await adaptive.routes.insert_many([viewer, legacy])
+    # "8:05" sorts after "08:30", outside the viewer's departure window
+    assert "user_legacy" not in await matched_users(viewer)
+
+    monkeypatch.setattr(migrate_route_tiles, "db", adaptive)
+    assert await migrate_route_tiles.migrate(batch_size=1) == (0, 1)
+    assert (await adaptive.routes.find_one({"route_id": "route_legacy"}))["departure_time"] == "08:05"
+    assert await adaptive.data_versions.find_one({"_id": "routes:user_legacy"})
+    assert "user_legacy" in await matched_users(viewer)
+    # Nothing is left to do on a second run
+    assert await migrate_route_tiles.migrate(batch_size=1) == (0, 0)
+
+
+async def test_return_times_are_checked_and_migrated_like_departures(adaptive, monkeypatch):
+    users = await add_users(adaptive, "user_viewer")
+    home, work = (40.7000, -74.0000), (40.7500, -73.9800)
+    route = await server.create_route(commute(home, work, return_time="9:30"), current_user=users["user_viewer"])
+    assert route.return_time == "09:30"
+    with pytest.raises(ValueError):
+        commute(home, work, return_time="9.30")
+
+    # Someone going the other way at 09:30 pairs with a return leg saved before times were padded
+    evening = route_doc("route_evening", "user_evening", work, home)
+    evening["departure_time"] = "09:30"
+    legacy = {**route_doc("route_legacy", "user_legacy", (40.7010, -74.0005), (40.7505, -73.9795)),
+              "departure_time": "06:00", "return_time": "9:30"}
+    await adaptive.routes.insert_many([evening, legacy])
+    assert "user_legacy" not in await matched_users(evening)
+
+    monkeypatch.setattr(migrate_route_tiles, "db", adaptive)
+    assert await migrate_route_tiles.migrate(batch_size=1000) == (0, 1)
+    assert (await adaptive.routes.find_one({"route_id": "route_legacy"}))["return_time"] == "09:30"
+    assert {"user_legacy", "user_viewer"} <= await matched_users(evening)
+
+
+async def test_streamed_matches_are_the_same_page_as_json(monkeypatch):
+    fake = FakeDB()
+    population, routes, _ = generate_population(2000, seed=5)
+    await fake.users.insert_many(population)
+    await fake.routes.insert_many(routes)
+    for handle in ("db", "read_db", "fast_db"):
+        monkeypatch.setattr(server, handle, fake)
+    monkeypatch.setattr(server, "untiled_routes_remain", False)
+    monkeypatch.setattr(server.hub_matcher, "cache", server.LRUCache(server.MATCH_HUB_CACHE_SIZE))
+    monkeypatch.setitem(server.RATE_LIMITS, "discovery", "off")
+    viewer = server.User(**population[0])
+
+    async def page(query, accept=None):
+        request = make_request("/api/discovery/matches", query, accept=accept)
+        params = dict(pair.split("=") for pair in query.split("&"))
+        response = await server.get_matches(request, limit=int(params["limit"]), cursor=params.get("cursor"),
+                                            current_user=viewer)
+        if accept:
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            rows = [server.orjson.loads(line) for line in body.splitlines()]
+        else:
+            rows = server.orjson.loads(response.body)
+        return {row["user_id"] for row in rows}, response.headers.get("x-next-cursor")
+
+    first, cursor = await page("limit=5")
+    assert len(first) == 5 and cursor
+    assert await page("limit=5", accept=server.NDJSON_MEDIA_TYPE) == (first, cursor)
+    second = await page(f"limit=5&cursor={cursor}")
+    assert second[0] and not second[0] & first
+    assert await page(f"limit=5&cursor={cursor}", accept=server.NDJSON_MEDIA_TYPE) == second
+
+
+async def test_blocks_only_in_the_legacy_field_are_backfilled_at_startup(adaptive, monkeypatch):
+    users = await add_users(adaptive, "user_viewer", "user_near", "user_blocker")
+    await adaptive.users.update_one({"user_id": "user_viewer"}, {"$set": {"blocked_users": ["user_near"]}})
+    await adaptive.users.update_one({"user_id": "user_blocker"}, {"$set": {"blocked_users": ["user_viewer"]}})
+    for user_id, start in (("user_viewer", (40.7000, -74.0000)), ("user_near", (40.7010, -74.0005)),
+                           ("user_blocker", (40.7005, -74.0010))):
+        await server.create_route(commute(start, (40.7500, -73.9800)), current_user=users[user_id])
+
+    assert await server.backfill_block_edges() == (2, 2)
+    assert await server.load_block_set("user_viewer") == {"user_near", "user_blocker"}
+    matches, _ = await server.compute_matches(users["user_viewer"])
+    assert matches == []
+
+    # Later startups skip the scan; unblocking goes through the edges as usual
+    assert await server.backfill_block_edges() == (0, 0)
+    await server.unblock_user("user_near", current_user=users["user_viewer"])
+    assert await server.load_block_set("user_viewer") == {"user_blocker"}
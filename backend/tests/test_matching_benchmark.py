@@ -0,0 +1,19 @@
+import json
+
+import pytest
+
+import server
+from benchmarks import matching
+
+# 100k routes take a minute to seed; `python -m benchmarks.matching` covers that size
+SIZES = [1000, 10000]
+BASELINE = json.loads(matching.DEFAULT_BASELINE.read_text())
+
+
+@pytest.mark.parametrize("name", [
+    *matching.PRIMITIVES, *(f"{kind}[{size}]" for size in SIZES for kind in matching.MATCH_BENCHMARKS)
+])
+def test_throughput_relative_to_the_reference_holds(name, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "discovery", "off")
+    assert name in BASELINE, "run python -m benchmarks.matching --save-baseline"
+    assert not matching.check(SIZES, 5, 20, BASELINE, 0.2, only={name})
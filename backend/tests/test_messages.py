@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def message(i, minutes):
+    return {
+        "message_id": f"msg_{i:02d}", "sender_id": "user_a", "receiver_id": "user_b", "content": f"hello {i}",
+        "timestamp": datetime(2024, 1, 1, 12, 0) + timedelta(minutes=minutes), "read": True,
+    }
+
+
+async def test_overlapping_archive_chunks_come_back_in_order(mongo):
+    conversation = server.conversation_key("user_a", "user_b")
+    # A later archive run picked up messages that fall inside an earlier chunk's time range
+    await server.write_archive_chunks([
+        (conversation, [message(0, 0), message(2, 20), message(4, 40)]),
+        (conversation, [message(1, 10), message(3, 30)]),
+    ])
+
+    archived = await server.load_archived_messages(conversation, None, 10)
+    assert [m["message_id"] for m in archived] == ["msg_04", "msg_03", "msg_02", "msg_01", "msg_00"]
+    page = await server.load_archived_messages(conversation, datetime(2024, 1, 1, 12, 35), 2)
+    assert [m["message_id"] for m in page] == ["msg_03", "msg_02"]
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class RecordingProvider:
+    """Push provider that records each batch and answers from a script (default "ok")"""
+
+    def __init__(self, name, max_batch=100):
+        self.name = name
+        self.max_batch = max_batch
+        self.batches = []
+        self.results = {}
+
+    async def send(self, messages):
+        self.batches.append(messages)
+        return [self.results.get(message["to"], "ok") for message in messages]
+
+
+@pytest.fixture
+async def queue(mongo, monkeypatch):
+    await server.ensure_notification_indexes()
+    providers = {"alpha": RecordingProvider("alpha", max_batch=2), "beta": RecordingProvider("beta")}
+    monkeypatch.setattr(server, "PUSH_PROVIDERS", providers)
+    monkeypatch.setattr(server, "NOTIFICATION_COLLAPSE_SECONDS", 0)
+    for user_id in ("user_a", "user_b", "user_c", "user_d"):
+        await mongo.users.insert_one({"user_id": user_id, "name": user_id.upper()})
+    return providers
+
+
+async def register(db, token, user_id, provider):
+    await db.devices.insert_one({"token": token, "user_id": user_id, "provider": provider})
+
+
+def message(sender_id, receiver_id, content="hi"):
+    return {"sender_id": sender_id, "receiver_id": receiver_id, "content": content}
+
+
+async def make_due(db):
+    await db.notification_queue.update_many({}, {"$set": {"available_at": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+
+async def test_messages_collapse_per_sender(mongo, queue):
+    for content in ("one", "two", "three"):
+        await server.notify_new_message(message("user_b", "user_a", content))
+    await server.notify_new_message(message("user_c", "user_a"))
+
+    entries = await mongo.notification_queue.find({}, {"_id": 0}).sort("collapse_key", 1).to_list(None)
+    assert [(entry["collapse_key"], entry["count"]) for entry in entries] == [("message:user_b", 3), ("message:user_c", 1)]
+    assert entries[0]["data"]["preview"] == "three"
+
+
+async def test_concurrent_insert_is_merged(mongo, queue, monkeypatch):
+    collection = mongo.notification_queue
+    update_one = collection.update_one
+    raced = []
+
+    async def racing_update_one(query, update, upsert=False):
+        if not raced:
+            # Another worker's enqueue for the conversation inserts the pending entry between this
+            # upsert's match and its insert
+            raced.append(True)
+            await update_one(query, update, upsert=upsert)
+            raise server.DuplicateKeyError("E11000 duplicate key")
+        return await update_one(query, update, upsert=upsert)
+
+    monkeypatch.setattr(collection, "update_one", racing_update_one)
+    monkeypatch.setattr(server, "fast_db", SimpleNamespace(notification_queue=collection))
+    await server.notify_new_message(message("user_b", "user_a"))
+    entries = await mongo.notification_queue.find({}).to_list(None)
+    assert len(entries) == 1 and entries[0]["count"] == 2
+
+
+async def test_one_push_per_device_batched_by_provider(mongo, queue):
+    await register(mongo, "alpha_a1", "user_a", "alpha")
+    await register(mongo, "beta_a2", "user_a", "beta")
+    await register(mongo, "alpha_c", "user_c", "alpha")
+    await register(mongo, "alpha_d", "user_d", "alpha")
+    await server.notify_new_message(message("user_b", "user_a", "first"))
+    await server.notify_new_message(message("user_c", "user_a", "second"))
+    await server.notify_new_message(message("user_b", "user_c"))
+    await server.notify_new_message(message("user_b", "user_d"))
+
+    assert await server.deliver_notifications(100) == 4
+    alpha, beta = queue["alpha"], queue["beta"]
+    # Three alpha devices in batches of at most two, one beta device
+    assert sorted(len(batch) for batch in alpha.batches) == [1, 2]
+    assert [push["to"] for push in beta.batches[0]] == ["beta_a2"]
+    # user_a's two pending conversations become one summary push per device
+    pushes = {push["to"]: push for batch in alpha.batches + beta.batches for push in batch}
+    assert pushes["alpha_a1"]["body"] == pushes["beta_a2"]["body"]
+    assert pushes["alpha_a1"]["body"] in ("2 new messages from USER_B, USER_C", "2 new messages from USER_C, USER_B")
+    assert pushes["alpha_c"]["title"] == "USER_B" and pushes["alpha_c"]["body"] == "hi"
+    assert await mongo.notification_queue.count_documents({}) == 0
+
+
+async def test_failed_send_is_retried_with_backoff(mongo, queue):
+    await register(mongo, "alpha_a", "user_a", "alpha")
+    await register(mongo, "invalid_a", "user_a", "beta")
+    queue["alpha"].results["alpha_a"] = "retry"
+    queue["beta"].results["invalid_a"] = "invalid"
+    await server.notify_new_message(message("user_b", "user_a"))
+
+    assert await server.deliver_notifications(100) == 1
+    entry = await mongo.notification_queue.find_one({})
+    assert entry["state"] == "pending" and entry["attempts"] == 1 and "claim" not in entry
+    # The provider said the token is gone, so the device is dropped
+    assert await mongo.devices.distinct("token") == ["alpha_a"]
+
+    # A message arriving while the retry waits merges into it
+    await server.notify_new_message(message("user_b", "user_a", "again"))
+    assert await mongo.notification_queue.count_documents({}) == 1
+
+    del queue["alpha"].results["alpha_a"]
+    await make_due(mongo)
+    assert await server.deliver_notifications(100) == 1
+    assert queue["alpha"].batches[-1][0]["body"] == "2 new messages"
+    assert await mongo.notification_queue.count_documents({}) == 0
+
+
+async def test_failed_send_folds_into_a_newer_pending_entry(mongo, queue, monkeypatch):
+    await register(mongo, "alpha_a", "user_a", "alpha")
+    queue["alpha"].results["alpha_a"] = "retry"
+    await server.notify_new_message(message("user_b", "user_a", "first"))
+
+    send = queue["alpha"].send
+
+    async def send_while_a_message_arrives(messages):
+        await server.notify_new_message(message("user_b", "user_a", "second"))
+        return await send(messages)
+
+    monkeypatch.setattr(queue["alpha"], "send", send_while_a_message_arrives)
+    await server.deliver_notifications(100)
+
+    entries = await mongo.notification_queue.find({}).to_list(None)
+    assert len(entries) == 1
+    assert entries[0]["state"] == "pending" and entries[0]["count"] == 2 and entries[0]["data"]["preview"] == "second"
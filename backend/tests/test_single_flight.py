@@ -0,0 +1,158 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from benchmarks import coalescing
+from benchmarks.fakedb import FakeDB
+
+pytestmark = pytest.mark.anyio
+
+BURST = 50
+
+
+async def test_concurrent_callers_share_one_call():
+    flight = server.SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    assert await asyncio.gather(*(flight.do("key", fetch) for _ in range(10))) == [1] * 10
+    assert calls == 1
+    assert not flight.calls
+
+
+async def test_not_before_skips_a_computation_that_started_earlier():
+    flight = server.SingleFlight()
+    release = asyncio.Event()
+    calls = []
+
+    async def fetch(n):
+        calls.append(n)
+        await release.wait()
+        return n
+
+    arrived = time.monotonic()
+    first = asyncio.ensure_future(flight.do("key", lambda: fetch(1), not_before=arrived))
+    await asyncio.sleep(0.001)
+    # Arrived before the first computation started, so it may share it
+    early = asyncio.ensure_future(flight.do("key", lambda: fetch(2), not_before=arrived))
+    # Arrived after it started, e.g. right after a write, so it needs a read of its own
+    late = asyncio.ensure_future(flight.do("key", lambda: fetch(3), not_before=time.monotonic()))
+    await asyncio.sleep(0.001)
+    release.set()
+
+    assert await asyncio.gather(first, early, late) == [1, 1, 3]
+    assert calls == [1, 3]
+    assert not flight.calls
+
+
+@pytest.mark.parametrize("scenario", ["session lookup", "discovery", "connections", "profile"])
+async def test_duplicate_burst_costs_one_request_of_reads(scenario, monkeypatch):
+    fake = FakeDB(latency=0.002)
+    viewer, token, profile_id = await coalescing.seed(fake, 200)
+    for handle in ("db", "read_db", "fast_db"):
+        monkeypatch.setattr(server, handle, fake)
+    monkeypatch.setitem(server.RATE_LIMITS, "discovery", "off")
+    monkeypatch.setattr(server, "untiled_routes_remain", False)  # every seeded route has tiles
+    call = coalescing.scenarios(viewer, token, profile_id)[scenario]
+
+    reads = {}
+    for mode, flight in (("single", coalescing.NoCoalescing()), ("off", coalescing.NoCoalescing()),
+                         ("on", server.SingleFlight())):
+        monkeypatch.setattr(server, "single_flight", flight)
+        # Every run starts from a cold hub cache so the modes pay for the same work
+        monkeypatch.setattr(server.hub_matcher, "cache", server.LRUCache(server.MATCH_HUB_CACHE_SIZE))
+        fake.counter.clear()
+        await asyncio.gather(*(call() for _ in range(1 if mode == "single" else BURST)))
+        reads[mode] = sum(fake.counter.values())
+
+    assert reads["off"] == BURST * reads["single"]
+    assert reads["on"] == reads["single"]
+
+
+async def test_request_after_a_write_does_not_join_an_older_read(mongo, monkeypatch):
+    now = datetime.now(timezone.utc)
+    for user_id in ("user_a", "user_b"):
+        await mongo.users.insert_one({
+            "user_id": user_id, "email": f"{user_id}@example.com", "name": user_id, "picture": None,
+            "verified": False, "created_at": now,
+        })
+    await mongo.connections.insert_one({
+        "connection_id": "conn_1", "user1_id": "user_a", "user2_id": "user_b", "status": "pending",
+        "created_at": now,
+    })
+    viewer = server.User(**await mongo.users.find_one({"user_id": "user_a"}, {"_id": 0}))
+    responder = server.User(**await mongo.users.find_one({"user_id": "user_b"}, {"_id": 0}))
+    monkeypatch.setattr(server, "single_flight", server.SingleFlight())
+
+    # Hold the first list read open after it has seen the pending connection
+    load_connections = server.load_connections
+    gate = asyncio.Event()
+
+    async def held_load(current_user, query):
+        result = await load_connections(current_user, query)
+        if not gate.is_set():
+            await gate.wait()
+        return result
+
+    monkeypatch.setattr(server, "load_connections", held_load)
+
+    async def list_connections():
+        return await server.get_connections(coalescing.make_request("/api/connections/list"), status=None,
+                                            current_user=viewer)
+
+    before = asyncio.ensure_future(list_connections())
+    await asyncio.sleep(0.01)
+    await server.respond_to_connection(
+        server.ConnectionResponse(connection_id="conn_1", action="accepted"), current_user=responder
+    )
+    after = asyncio.ensure_future(list_connections())
+    await asyncio.sleep(0.01)
+    gate.set()
+    before, after = await asyncio.gather(before, after)
+
+    assert server.orjson.loads(before.body)[0]["status"] == "pending"
+    assert server.orjson.loads(after.body)[0]["status"] == "accepted"
+    assert before.headers["etag"] != after.headers["etag"]
+
+
+async def test_request_after_logout_does_not_join_an_older_session_lookup(mongo, monkeypatch):
+    now = datetime.now(timezone.utc)
+    await mongo.users.insert_one({"user_id": "user_a", "email": "a@example.com", "name": "A", "created_at": now})
+    await mongo.user_sessions.insert_one({
+        "user_id": "user_a", "session_token": "token_a", "expires_at": now + timedelta(days=1), "created_at": now,
+    })
+    monkeypatch.setattr(server, "single_flight", server.SingleFlight())
+
+    # Hold the first lookup open after it has found the session
+    load_session_user = server.load_session_user
+    gate = asyncio.Event()
+
+    async def held_load(session_token):
+        user = await load_session_user(session_token)
+        if not gate.is_set():
+            await gate.wait()
+        return user
+
+    monkeypatch.setattr(server, "load_session_user", held_load)
+
+    def lookup():
+        return server.get_current_user(coalescing.make_request("/api/auth/me", cookie="token_a"))
+
+    before = asyncio.ensure_future(lookup())
+    await asyncio.sleep(0.01)
+    await mongo.user_sessions.delete_one({"session_token": "token_a"})
+    after = asyncio.ensure_future(lookup())
+    await asyncio.sleep(0.01)
+    gate.set()
+    before, after = await asyncio.gather(before, after)
+
+    assert before.user_id == "user_a"
+    assert after is None
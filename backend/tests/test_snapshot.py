@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+import snapshot
+
+pytestmark = pytest.mark.anyio
+
+COLLECTIONS = ["users", "message_buckets", "message_archive"]
+
+
+@pytest.fixture
+def snapshot_db(mongo, monkeypatch):
+    monkeypatch.setattr(snapshot, "fast_db", mongo)
+    monkeypatch.setattr(snapshot, "read_db", mongo)
+    return mongo
+
+
+async def seed(db):
+    old = datetime(2024, 1, 1, 12, 0)
+    conversation = server.conversation_key("user_a", "user_b")
+    await db.users.insert_one({"user_id": "user_a", "name": "A", "created_at": old, "blocked_users": []})
+    messages = [{
+        "message_id": f"msg_{i}", "sender_id": "user_a", "receiver_id": "user_b", "content": f"hello {i}",
+        "timestamp": old + timedelta(minutes=i), "read": False,
+    } for i in range(3)]
+    await db.message_buckets.insert_many([
+        {"conversation": conversation, "count": len(messages), "first_ts": messages[0]["timestamp"],
+         "last_ts": messages[-1]["timestamp"], "messages": messages},
+        {"conversation": conversation, "count": 1, "first_ts": datetime.utcnow(), "last_ts": datetime.utcnow(),
+         "messages": [{**messages[0], "message_id": "msg_hot", "timestamp": datetime.utcnow()}]},
+    ])
+    # The old bucket becomes an archive chunk holding zlib-compressed bytes
+    assert await server.archive_old_messages(hot_days=30) == len(messages)
+    return conversation
+
+
+async def dump(db):
+    return {name: await db[name].find().sort("_id", 1).to_list(None) for name in COLLECTIONS}
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "arrow"])
+async def test_snapshot_round_trip(fmt, snapshot_db, tmp_path):
+    if fmt == "arrow":
+        pytest.importorskip("pyarrow")
+    conversation = await seed(snapshot_db)
+    before = await dump(snapshot_db)
+    assert isinstance(before["message_archive"][0]["data"], bytes)
+
+    exported = await snapshot.export_snapshot(tmp_path, fmt, 2, COLLECTIONS)
+    assert {name: result["documents"] for name, result in exported.items()} == {
+        name: len(docs) for name, docs in before.items()
+    }
+    imported = await snapshot.import_snapshot(tmp_path, 100, 2, True, COLLECTIONS)
+    assert imported == {name: len(docs) for name, docs in before.items()}
+
+    assert await dump(snapshot_db) == before
+    archived = await server.load_archived_messages(conversation, None, 10)
+    assert [message["message_id"] for message in archived] == ["msg_2", "msg_1", "msg_0"]
+
+
+async def test_reimport_skips_existing_documents(snapshot_db, tmp_path):
+    await seed(snapshot_db)
+    before = await dump(snapshot_db)
+    await snapshot.export_snapshot(tmp_path, "ndjson", 2, COLLECTIONS)
+
+    assert await snapshot.import_snapshot(tmp_path, 100, 2, False, COLLECTIONS) == {name: 0 for name in COLLECTIONS}
+    assert await dump(snapshot_db) == before
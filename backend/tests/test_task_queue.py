@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def runs(mongo, monkeypatch):
+    """Task kinds for the checks below; returns how often each payload id ran"""
+    runs = {}
+
+    async def record(payload):
+        runs[payload["id"]] = runs.get(payload["id"], 0) + 1
+
+    async def flaky(payload):
+        await record(payload)
+        if runs[payload["id"]] < payload["fail_times"]:
+            raise RuntimeError("transient failure")
+
+    async def reject(payload):
+        raise server.TaskRejected("bad input")
+
+    async def slow(payload):
+        await asyncio.sleep(payload["seconds"])
+        await record(payload)
+
+    monkeypatch.setattr(server, "TASK_HANDLERS", {
+        "check_record": record, "check_flaky": flaky, "check_reject": reject, "check_slow": slow,
+    })
+    monkeypatch.setattr(server, "TASK_POLL_INTERVAL", 0.01)
+    return runs
+
+
+async def drain(limit=100):
+    """Run claimed tasks in this coroutine until nothing is due"""
+    for _ in range(limit):
+        task = await server.claim_task()
+        if task is None:
+            return
+        await server.run_task(task)
+    raise AssertionError("queue did not drain")
+
+
+async def make_due(kind):
+    await server.db.tasks.update_many({"kind": kind}, {"$set": {"available_at": datetime.now(timezone.utc)}})
+
+
+async def test_finished_task_is_removed(runs):
+    await server.enqueue_task("check_record", {"id": "complete"})
+    await drain()
+    assert runs["complete"] == 1
+    assert await server.db.tasks.count_documents({}) == 0
+
+
+async def test_dedupe_key_keeps_one_task_with_the_latest_payload(runs):
+    first = await server.enqueue_task("check_record", {"id": "dedupe", "n": 1}, dedupe_key="same")
+    second = await server.enqueue_task("check_record", {"id": "dedupe", "n": 2}, dedupe_key="same")
+    assert first == second
+    task = await server.db.tasks.find_one({"task_id": first})
+    assert task["payload"]["n"] == 2
+    await drain()
+    assert runs["dedupe"] == 1
+
+
+async def test_dedupe_key_queues_again_once_the_task_is_running(runs):
+    first = await server.enqueue_task("check_record", {"id": "again"}, dedupe_key="same")
+    await server.claim_task()
+    second = await server.enqueue_task("check_record", {"id": "again"}, dedupe_key="same")
+    assert first != second
+
+
+async def test_errors_retry_with_backoff_then_fail(runs):
+    await server.enqueue_task("check_flaky", {"id": "flaky", "fail_times": 3})
+    for _ in range(3):
+        await drain()
+        task = await server.db.tasks.find_one({"kind": "check_flaky"})
+        if task:
+            assert task["state"] == "queued" and task["last_error"] == "RuntimeError('transient failure')"
+        await make_due("check_flaky")
+    assert runs["flaky"] == 3
+    assert await server.db.tasks.count_documents({}) == 0
+
+    await server.enqueue_task("check_flaky", {"id": "hopeless", "fail_times": 1000})
+    for _ in range(server.TASK_MAX_ATTEMPTS):
+        task = await server.db.tasks.find_one({"kind": "check_flaky"})
+        assert task["state"] == "queued"
+        await make_due("check_flaky")
+        await drain()
+    task = await server.db.tasks.find_one({"kind": "check_flaky"})
+    assert task["state"] == "failed" and "transient failure" in task["last_error"]
+    assert runs["hopeless"] == server.TASK_MAX_ATTEMPTS
+
+
+async def test_rejected_task_is_not_retried(runs):
+    await server.enqueue_task("check_reject", {})
+    await drain()
+    task = await server.db.tasks.find_one({"kind": "check_reject"})
+    assert task["state"] == "failed" and task["attempts"] == 1
+
+
+async def test_expired_lease_is_taken_over(runs):
+    await server.enqueue_task("check_record", {"id": "orphan"})
+    task = await server.claim_task()
+    assert await server.claim_task() is None, "a leased task was claimed twice"
+    # The worker that claimed it never reports back; once the lease runs out another one takes over
+    await server.db.tasks.update_one(
+        {"_id": task["_id"]}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    await drain()
+    assert runs["orphan"] == 1
+    # A late report from the first worker must not touch the task again
+    await server.run_task(task)
+    assert await server.db.tasks.count_documents({}) == 0
+
+
+async def test_worker_pool_runs_each_task_once(runs):
+    for i in range(40):
+        await server.enqueue_task("check_slow", {"id": f"pool{i}", "seconds": 0.01})
+    pool = asyncio.create_task(server.run_task_workers(4))
+    try:
+        for _ in range(500):
+            if not await server.db.tasks.count_documents({}):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        pool.cancel()
+        await asyncio.gather(pool, return_exceptions=True)
+    assert runs == {f"pool{i}": 1 for i in range(40)}
+
+
+@pytest.fixture
+def user(mongo):
+    return server.User(user_id="user_a", email="a@example.com", name="A", created_at=datetime.now(timezone.utc))
+
+
+def jpeg_data_url():
+    if server.Image is None:  # without Pillow any valid base64 passes
+        return "data:image/jpeg;base64," + base64.b64encode(b"id card").decode()
+    out = io.BytesIO()
+    server.Image.new("RGB", (8, 8)).save(out, "JPEG")
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode()
+
+
+async def test_verify_id_queues_a_reference_not_the_image(mongo, user):
+    await mongo.users.insert_one(user.model_dump())
+    image = jpeg_data_url()
+    response = await server.verify_id(server.IDVerificationUpload(id_image=image), current_user=user)
+    assert response["status"] == "pending" and response["verified"] is False
+
+    task = await mongo.tasks.find_one({"kind": "verify_id"})
+    assert task["payload"] == {"user_id": "user_a"}
+    assert (await mongo.id_verifications.find_one({"_id": "user_a"}))["image"] == image
+
+    await drain()
+    assert (await mongo.users.find_one({"user_id": "user_a"}))["verified"] is True
+    verification = await mongo.id_verifications.find_one({"_id": "user_a"})
+    assert verification["status"] == "verified" and "image" not in verification
+
+
+async def test_verify_id_rejects_an_unreadable_image(mongo, user):
+    await mongo.users.insert_one(user.model_dump())
+    await server.verify_id(server.IDVerificationUpload(id_image="not base64!"), current_user=user)
+    await drain()
+    assert (await mongo.users.find_one({"user_id": "user_a"}))["verified"] is False
+    assert (await mongo.id_verifications.find_one({"_id": "user_a"}))["status"] == "rejected"
+    assert (await mongo.tasks.find_one({"kind": "verify_id"}))["state"] == "failed"
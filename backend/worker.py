@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Background worker for the RouteBuddy backend
+Runs queued tasks (db.tasks) outside the API processes, plus push delivery unless NOTIFICATION_WORKER=false
+
+Configuration (environment, on top of the backend's MONGO_URL / DB_NAME / TASK_* settings):
+  TASK_CONCURRENCY            tasks run at once (8)
+  SOCKETIO_MESSAGE_QUEUE      needed for tasks that emit socket events to reach clients
+
+Run the API with TASK_WORKERS=0 (and NOTIFICATION_WORKER=false) when this worker is deployed.
+
+Usage (from backend/): python worker.py [--concurrency N]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+
+import server
+
+logger = logging.getLogger("worker")
+
+
+async def run(concurrency):
+    await server.ensure_task_indexes()
+    await server.ensure_notification_indexes()
+
+    jobs = [asyncio.create_task(server.run_task_workers(concurrency))]
+    if server.NOTIFICATION_WORKER:
+        jobs.append(asyncio.create_task(server.run_notification_worker()))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info("Worker %s running %d task worker(s)", server.WORKER_ID, concurrency)
+    await stop.wait()
+
+    # Tasks interrupted here become visible again once their lease runs out
+    for job in jobs:
+        job.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    server.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run RouteBuddy background tasks")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("TASK_CONCURRENCY", "8")))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(run(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
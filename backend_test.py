@@ -290,10 +290,11 @@ class CommuteAppTester:
                 
                 if response.status_code == 200:
                     data = response.json()
-                    if data.get("verified") == True:
+                    # Verification is checked in the background, so the upload is only queued here
+                    if data.get("status") == "pending":
                         self.test_results["profile"]["verify_id"] = {
                             "status": "pass",
-                            "message": "Successfully verified ID"
+                            "message": "ID verification queued"
                         }
                     else:
                         self.test_results["profile"]["verify_id"] = {
@@ -12,6 +12,7 @@ import {
 import { useRouter } from 'expo-router';
 import { Ionicons } from '@expo/vector-icons';
 import { useAuth } from '../../contexts/AuthContext';
+import { useSocket } from '../../contexts/SocketContext';
 import { api } from '../../utils/api';
 
 interface MatchedUser {
@@ -23,11 +24,18 @@ interface MatchedUser {
   route_match_score: number;
   distance_to_start: number;
   distance_to_end: number;
+  match_type?: 'direct' | 'return' | 'pickup';
 }
 
+const MATCH_TYPE_LABELS: Record<string, string> = {
+  return: 'Return trip',
+  pickup: 'Passes your route',
+};
+
 export default function DiscoverScreen() {
   const router = useRouter();
   const { user } = useAuth();
+  const { socket } = useSocket();
   const [matches, setMatches] = useState<MatchedUser[]>([]);
   const [loading, setLoading] = useState(true);
   const [refreshing, setRefreshing] = useState(false);
@@ -38,6 +46,23 @@ export default function DiscoverScreen() {
     checkUserRoute();
   }, []);
 
+  useEffect(() => {
+    // Sent once matches for a new or edited route have been computed in the background
+    if (socket) {
+      socket.on('matches_ready', (data: { matches: MatchedUser[] }) => {
+        setMatches(data.matches);
+        setHasRoute(true);
+        setLoading(false);
+      });
+    }
+
+    return () => {
+      if (socket) {
+        socket.off('matches_ready');
+      }
+    };
+  }, [socket]);
+
   const checkUserRoute = async () => {
     try {
       const routes = await api.get('/api/routes/my-routes');
@@ -146,6 +171,9 @@ export default function DiscoverScreen() {
                         <Ionicons name="checkmark-circle" size={16} color="#10B981" />
                       )}
                     </View>
+                    {match.match_type && MATCH_TYPE_LABELS[match.match_type] && (
+                      <Text style={styles.matchType}>{MATCH_TYPE_LABELS[match.match_type]}</Text>
+                    )}
                     {match.bio && (
                       <Text style={styles.userBio} numberOfLines={2}>
                         {match.bio}
@@ -262,6 +290,12 @@ const styles = StyleSheet.create({
     color: '#6B7280',
     lineHeight: 20,
   },
+  matchType: {
+    fontSize: 12,
+    fontWeight: '600',
+    color: '#6366F1',
+    marginBottom: 2,
+  },
   matchStats: {
     flexDirection: 'row',
     justifyContent: 'space-around',
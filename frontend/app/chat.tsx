@@ -94,7 +94,6 @@ export default function ChatScreen() {
     try {
       if (socket) {
         socket.emit('send_message', {
-          sender_id: user!.user_id,
           receiver_id: userId,
           content: messageContent,
         });
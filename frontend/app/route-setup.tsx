@@ -31,6 +31,7 @@ export default function RouteSetupScreen() {
   const [startAddress, setStartAddress] = useState('');
   const [endAddress, setEndAddress] = useState('');
   const [departureTime, setDepartureTime] = useState('08:00');
+  const [returnTime, setReturnTime] = useState('');
   const [selectedDays, setSelectedDays] = useState<string[]>([]);
   const [loading, setLoading] = useState(false);
 
@@ -106,6 +107,7 @@ export default function RouteSetupScreen() {
         start_address: startAddress,
         end_address: endAddress,
         departure_time: departureTime,
+        return_time: returnTime || null,
         days_of_week: selectedDays,
       });
 
@@ -167,6 +169,17 @@ export default function RouteSetupScreen() {
           />
         </View>
 
+        <View style={styles.section}>
+          <Text style={styles.sectionTitle}>Return Time (optional)</Text>
+          <TextInput
+            style={styles.input}
+            value={returnTime}
+            onChangeText={setReturnTime}
+            placeholder="HH:MM (e.g., 17:30)"
+            placeholderTextColor="#9CA3AF"
+          />
+        </View>
+
         <View style={styles.section}>
           <Text style={styles.sectionTitle}>Days of Week</Text>
           <View style={styles.daysContainer}>
@@ -1,5 +1,6 @@
 import React, { createContext, useContext, useEffect, useState } from 'react';
 import { io, Socket } from 'socket.io-client';
+import AsyncStorage from '@react-native-async-storage/async-storage';
 import { useAuth } from './AuthContext';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
@@ -19,6 +20,10 @@ export const SocketProvider: React.FC<{ children: React.ReactNode }> = ({ childr
   useEffect(() => {
     if (user) {
       const newSocket = io(API_URL, {
+        // The server only lets a socket act as the user whose session token it presents
+        auth: (cb) => {
+          AsyncStorage.getItem('session_token').then((token) => cb({ token }));
+        },
         transports: ['websocket', 'polling'],
         reconnection: true,
         reconnectionAttempts: 5,